@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+'''compare submitting parametric tasks as separate jobs vs. one array job
+usage: bench-array.py [tasks=100000] [env=40] [running=64]
+measures submit time, State memory, and the size of a full sync of the jobs,
+with running tasks in progress as a pool would have them'''
+
+import sys
+import os
+import time
+import json
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.state import State
+from meeseeks.array import Array
+from meeseeks.util import cmdline_parser
+
+def submit_jobs(state,tasks,env,running):
+    for i in range(tasks): state.submit_job(pool='p1',node='n1',args=['/bin/process','%s'%i],env=env)
+    for jid in state.list_jobs()[:running]: state.update_job(jid,state='running',active=True)
+
+def submit_array(state,tasks,env,running):
+    jid=list(state.submit_job(pool='p1',node='n1',args=['/bin/process'],env=env,array='1-%s'%tasks))[0]
+    array=Array.from_job(state.get(ids=jid,records=True)[jid])
+    for i in range(1,running+1): array.set(i,'running')
+    state.update_job(jid,state='running',active=True,**array.update())
+
+def measure(submit,tasks,env,running):
+    tracemalloc.start()
+    start=tracemalloc.get_traced_memory()[0]
+    state=State('head')
+    t=time.time()
+    submit(state,tasks,env,running)
+    t=time.time()-t
+    used=tracemalloc.get_traced_memory()[0]-start
+    tracemalloc.stop()
+    sync=len(json.dumps(state.get(seq=0,records=True),default=dict))
+    state.shutdown.set()
+    return t,used,sync
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    tasks,env_size,running=int(cfg.get('tasks',100000)),int(cfg.get('env',40)),int(cfg.get('running',64))
+    env=dict(('VAR_%s'%i,'/some/path/value/%s'%i*4) for i in range(env_size))
+    print('%s tasks, %s env vars, %s running'%(tasks,env_size,running))
+    for name,submit in (('jobs',submit_jobs),('array',submit_array)):
+        t,used,sync=measure(submit,tasks,env,running)
+        print('%-6s submit %8.3fs %10.1f MB state %12s bytes sync'%(name,t,used/2**20,sync))
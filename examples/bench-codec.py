@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+'''compare encode/decode time and size of a sync payload with the available codecs
+usage: bench-codec.py [jobs=10000] [env=40] [rounds=5]
+the payload is a jid:job map as sent in sync/get requests, jobs are JobRecords as held in State'''
+
+import sys
+import os
+import time
+import uuid
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.codec import CODECS
+from meeseeks.record import JobRecord
+from meeseeks.util import cmdline_parser
+
+def make_payload(count,env_size):
+    env=dict(('VAR_%s'%i,'/some/path/value/%s'%i*4) for i in range(env_size))
+    jobs={}
+    for i in range(count):
+        now=time.time()
+        jobs[str(uuid.uuid1())]=JobRecord({
+            'submit_ts':now,'node':'node%s'%(i%100),'submit_node':'head','state':'running',
+            'start_count':1,'fail_count':0,'error':None,'active':True,'uid':1000,
+            'pool':'p%s'%(i%4),'args':['/bin/process','--input','file%s'%i],'env':env,
+            'tags':['batch','run%s'%(i%10)],'ts':now,'seq':i,'start_ts':now,'pid':10000+i})
+    return jobs
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    count,env_size,rounds=int(cfg.get('jobs',10000)),int(cfg.get('env',40)),int(cfg.get('rounds',5))
+    payload=make_payload(count,env_size)
+    print('%s jobs, %s env vars, codecs: %s'%(count,env_size,' '.join(CODECS)))
+    for name,codec in CODECS.items():
+        encode=decode=0
+        for i in range(rounds):
+            t=time.perf_counter()
+            data=codec.dumps(payload)
+            encode+=time.perf_counter()-t
+            t=time.perf_counter()
+            codec.loads(data)
+            decode+=time.perf_counter()-t
+        print('%-8s %8.1f MB encode %7.1f ms (%6.0f MB/s) decode %7.1f ms (%6.0f MB/s)'%(name,len(data)/2**20,
+            1000*encode/rounds,rounds*len(data)/2**20/encode,1000*decode/rounds,rounds*len(data)/2**20/decode))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''measure request throughput and latency of the threaded and asyncio listeners with many idle connections open
+each listener runs in its own process with a State of jobs, client processes hold the connections
+usage: bench-listener.py [idle=2000] [active=100] [procs=4] [jobs=10000] [seconds=10]'''
+
+import sys
+import os
+import time
+import asyncio
+import threading
+import resource
+import multiprocessing
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.state import State
+from meeseeks.service import Meeseeks,RequestListener,RequestHandler
+from meeseeks.listener import AsyncListener
+from meeseeks.protocol import AsyncConnection
+from meeseeks.util import cmdline_parser
+
+class Handler:
+    '''answers requests like Meeseeks does, from a State of jobs'''
+    handle=Meeseeks.handle
+    def __init__(self,jobs):
+        self.shutdown=threading.Event()
+        self.state=State('head')
+        for i in range(jobs): self.state.submit_job(pool='p1',node='node%s'%(i%100),args=['true'])
+
+def serve(name,jobs,port):
+    if name=='async': listener=AsyncListener(('localhost',0))
+    else: listener=RequestListener(('localhost',0),RequestHandler)
+    listener.handler=Handler(jobs)
+    port.put(listener.server_address[1])
+    listener.serve_forever()
+
+def threads(pid):
+    with open('/proc/%s/status'%pid) as fh:
+        for l in fh:
+            if l.startswith('Threads:'): return int(l.split()[1])
+
+async def clients(port,idle,active,seconds,frame,ready,go):
+    conns=[await AsyncConnection.open('localhost',port,timeout=60,frame=frame) for i in range(idle+active)]
+    ready.put(True)
+    await asyncio.get_running_loop().run_in_executor(None,go.wait)
+    stop=time.time()+seconds
+    latency=[]
+    async def client(conn,i):
+        while time.time() < stop:
+            t=time.time()
+            await conn.request([{'get':{'node':'node%s'%(i%100),'state':'new'}}])
+            latency.append(time.time()-t)
+    await asyncio.gather(*(client(conn,i) for i,conn in enumerate(conns[idle:])))
+    for conn in conns: conn.close()
+    return latency
+
+def client_proc(port,idle,active,seconds,frame,ready,go,results):
+    results.put(asyncio.run(clients(port,idle,active,seconds,frame,ready,go)))
+
+def run(name,idle,active,procs,jobs,seconds,frame=True):
+    ports,ready,results,go=multiprocessing.Queue(),multiprocessing.Queue(),multiprocessing.Queue(),multiprocessing.Event()
+    server=multiprocessing.Process(target=serve,args=(name,jobs,ports),daemon=True)
+    server.start()
+    port=ports.get()
+    #clients connect, then all start requests at once
+    t=time.time()
+    cprocs=[multiprocessing.Process(target=client_proc,daemon=True,
+        args=(port,idle//procs,active//procs,seconds,frame,ready,go,results)) for i in range(procs)]
+    for p in cprocs: p.start()
+    for p in cprocs: ready.get()
+    connect=time.time()-t
+    go.set()
+    time.sleep(seconds/2)
+    nthreads=threads(server.pid)
+    latency=sorted(sum((results.get() for p in cprocs),[]))
+    for p in cprocs: p.join()
+    server.kill()
+    return connect,nthreads,len(latency)/seconds,latency[len(latency)//2],latency[int(len(latency)*0.99)]
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    idle,active,procs=int(cfg.get('idle',2000)),int(cfg.get('active',100)),int(cfg.get('procs',4))
+    jobs,seconds=int(cfg.get('jobs',10000)),int(cfg.get('seconds',10))
+    #each connection is a file on both ends
+    soft,hard=resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,(max(soft,min(hard,(idle+active)*2+1024)),hard))
+    print('%s idle, %s active connections, %s jobs, %ss'%(idle,active,jobs,seconds))
+    for name in ('threaded','async'):
+        for frame in (False,True):
+            connect,nthreads,rate,p50,p99=run(name,idle,active,procs,jobs,seconds,frame)
+            print('%-8s %-6s connect %6.2fs %6s server threads %8.0f req/s latency p50 %.4fs p99 %.4fs'%(
+                name,'framed' if frame else 'line',connect,nthreads,rate,p50,p99))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+'''measure how long routing a burst of submitted jobs to nodes takes
+compares the batch pass (Meeseeks.route_jobs) with routing one job at a time against fresh pool status
+usage: bench-routing.py [jobs=50000] [nodes=1000] [slots=100] [pools=4] [single=5000]
+single is the number of jobs routed one at a time, as that is much slower'''
+
+import sys
+import os
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.service import Meeseeks
+from meeseeks.util import cmdline_parser
+
+def route_single(m):
+    '''route jobs one at a time, taking pool status and updating state for each job'''
+    jobs=m.state.get(state='new',node=False)
+    for jid,job in sorted(jobs.items(),key=lambda j:j[1]['submit_ts']):
+        if not job.get('submit_node'): m.state.update_job(jid,submit_node=m.name)
+        pool_status=m.state.get_pools().get(job['pool'],{})
+        placement=m.scheduler.placement(pool_status,{})
+        if not placement:
+            if not job['node']: m.state.update_job(jid,node=m.name)
+            continue
+        m.state.update_job(jid,node=placement.select(job))
+    return len(jobs)
+
+def setup(jobs,nodes,slots,pools):
+    m=Meeseeks(name='head')
+    m.apply_config()
+    for n in range(nodes):
+        m.state.update_node('node%s'%n,online=True,ts=time.time())
+        for p in range(pools): m.state.update_pool('p%s'%p,'node%s'%n,slots)
+    for i in range(jobs): m.state.submit_job(pool='p%s'%(i%pools),args=['true'])
+    return m
+
+def run(name,jobs,nodes,slots,pools):
+    m=setup(jobs,nodes,slots,pools)
+    t=time.time()
+    if name=='batch': m.route_jobs()
+    else: route_single(m)
+    elapsed=time.time()-t
+    assigned=len(m.state.get(state='new'))-len(m.state.get(state='new',node='head'))
+    errors=m.state.check()
+    m.state.shutdown.set()
+    return elapsed,assigned,errors
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    jobs,nodes,slots,pools=int(cfg.get('jobs',50000)),int(cfg.get('nodes',1000)),int(cfg.get('slots',100)),int(cfg.get('pools',4))
+    single=int(cfg.get('single',5000))
+    print('%s nodes, %s pools of %s slots per node'%(nodes,pools,slots))
+    for name,n in (('single',single),('batch',single),('batch',jobs)):
+        elapsed,assigned,errors=run(name,n,nodes,slots,pools)
+        print('%-6s %8s jobs %8.3fs %10.0f jobs/s %8s assigned %s'%(name,n,elapsed,n/elapsed,assigned,errors or ''))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+'''measure State query throughput with reader threads running against one writer thread
+compares the shared read lock with an exclusive lock
+usage: bench-state-contention.py [readers=8] [jobs=10000] [seconds=5]'''
+
+import sys
+import os
+import time
+import threading
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.state import State
+from meeseeks.util import cmdline_parser
+
+class ExclusiveLock:
+    '''plain lock with the RWLock interface, every reader is exclusive'''
+    def __init__(self): self.__lock=threading.Lock()
+    def read(self): return self.__lock
+    def __enter__(self): self.__lock.acquire()
+    def __exit__(self,*args): self.__lock.release()
+
+def run(readers,jobs,seconds,exclusive):
+    state=State('head')
+    if exclusive: state._State__lock=ExclusiveLock()
+    for n in range(10):
+        state.update_node('node%s'%n,online=True,ts=time.time())
+        state.update_pool('p1','node%s'%n,100)
+    jids=[]
+    for i in range(jobs): jids.extend(state.submit_job(pool='p1',node='node%s'%(i%10),args=['true']).keys())
+
+    stop=threading.Event()
+    counts=[0]*(readers+1)
+    latency=[0.0]*(readers+1)
+    def reader(i):
+        while not stop.is_set():
+            t=time.time()
+            state.get(node='node%s'%(i%10),pool='p1',state='new')
+            state.get_pools()
+            latency[i]=max(latency[i],time.time()-t)
+            counts[i]+=1
+    def writer():
+        i=0
+        while not stop.is_set():
+            state.update_job(jids[i%len(jids)],ts=time.time())
+            counts[readers]+=1
+            i+=1
+    threads=[threading.Thread(target=reader,args=(i,)) for i in range(readers)]+[threading.Thread(target=writer)]
+    for t in threads: t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads: t.join()
+    state.shutdown.set()
+    return sum(counts[:readers])/seconds,counts[readers]/seconds,max(latency[:readers])
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    readers,jobs,seconds=int(cfg.get('readers',8)),int(cfg.get('jobs',10000)),int(cfg.get('seconds',5))
+    print('%s readers, 1 writer, %s jobs, %ss'%(readers,jobs,seconds))
+    for name,exclusive in (('exclusive',True),('read/write',False)):
+        reads,writes,latency=run(readers,jobs,seconds,exclusive)
+        print('%-10s %10.0f reads/s %10.0f writes/s max read latency %.3fs'%(name,reads,writes,latency))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+'''compare memory used by jobs held as plain dicts vs. JobRecords
+usage: bench-state-memory.py [jobs=100000] [env=40] [nodes=100]
+jobs are decoded from JSON as they would be from a submit or sync request'''
+
+import sys
+import os
+import time
+import uuid
+import json
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','lib'))
+from meeseeks.record import JobRecord
+from meeseeks.util import cmdline_parser
+
+def make_jobs(count,env_size,nodes):
+    env=dict(('VAR_%s'%i,'/some/path/value/%s'%i*4) for i in range(env_size))
+    for i in range(count):
+        now=time.time()
+        yield str(uuid.uuid1()),json.dumps({
+            'submit_ts':now,'node':'node%s'%(i%nodes),'submit_node':'head','state':'done',
+            'start_count':1,'fail_count':0,'error':None,'active':False,'uid':1000,
+            'pool':'p%s'%(i%4),'args':['/bin/process','--input','file%s'%i],'env':env,
+            'tags':['batch','run%s'%(i%10)],'ts':now,'seq':i,'start_ts':now,'end_ts':now,'rc':0,'pid':None})
+
+def measure(count,env_size,nodes,convert):
+    tracemalloc.start()
+    start=tracemalloc.get_traced_memory()[0]
+    t=time.time()
+    jobs=dict((jid,convert(json.loads(data))) for (jid,data) in make_jobs(count,env_size,nodes))
+    t=time.time()-t
+    used=tracemalloc.get_traced_memory()[0]-start
+    tracemalloc.stop()
+    del jobs
+    return used,t
+
+if __name__=='__main__':
+    cfg,args=cmdline_parser(sys.argv[1:])
+    count,env_size,nodes=int(cfg.get('jobs',100000)),int(cfg.get('env',40)),int(cfg.get('nodes',100))
+    print('%s jobs, %s env vars, %s nodes'%(count,env_size,nodes))
+    for name,convert in (('dict',lambda job:job),('JobRecord',JobRecord)):
+        used,t=measure(count,env_size,nodes,convert)
+        print('%-10s %10.1f MB %8.0f bytes/job %6.2fs'%(name,used/2**20,used/count,t))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+class Array:
+    '''per-index state of an array job
+        the spec first-last:step (or first-last, or a single index) sets the indices of the array,
+        index states are kept as runs of [first,last,state], so a job with many tasks is one small record.
+        Tasks are started from the lowest new index, so the runs stay few:
+        finished runs, the window of running tasks, and the new indices after it.
+        Arrays are built from a job record and modified, the runs are then written back with update.
+    '''
+
+    #index states, as job states
+    STATES=['new','running','done','failed','killed']
+
+    def __init__(self,spec,runs=None):
+        self.first,self.last,self.step=self.parse(spec)
+        if runs: self.runs=[list(run) for run in runs]
+        else: self.runs=[[self.first,self.last,'new']]
+
+    @classmethod
+    def from_job(cls,job):
+        return cls(job['array'],job.get('array_runs'))
+
+    @staticmethod
+    def parse(spec):
+        '''returns (first,last,step) of an array spec, raises ValueError if it is not valid'''
+        spec,_,step=str(spec).partition(':')
+        first,_,last=spec.partition('-')
+        first,last,step=int(first),int(last or first),int(step or 1)
+        if first < 0 or step < 1 or last < first: raise ValueError('invalid array %s'%spec)
+        return first,first+(last-first)//step*step,step
+
+    def spec(self): return '%s-%s:%s'%(self.first,self.last,self.step)
+
+    def __len__(self): return (self.last-self.first)//self.step+1
+
+    def size(self,run): return (run[1]-run[0])//self.step+1
+
+    def __find(self,i):
+        '''returns the position of the run containing index i'''
+        lo,hi=0,len(self.runs)
+        while hi-lo > 1:
+            mid=(lo+hi)//2
+            if self.runs[mid][0] <= i: lo=mid
+            else: hi=mid
+        return lo
+
+    def get(self,i):
+        '''returns the state of index i'''
+        return self.runs[self.__find(i)][2]
+
+    def set(self,i,state):
+        '''set the state of index i, splitting its run and merging it with its neighbors'''
+        if (i-self.first)%self.step or not self.first <= i <= self.last: raise IndexError('%s not in array %s'%(i,self.spec()))
+        k=self.__find(i)
+        first,last,old=self.runs[k]
+        if old == state: return
+        runs=[[i,i,state]]
+        if i > first: runs.insert(0,[first,i-self.step,old])
+        if i < last: runs.append([i+self.step,last,old])
+        self.runs[k:k+1]=runs
+        #merge with the runs before and after
+        k+=runs.index([i,i,state])
+        if k+1 < len(self.runs) and self.runs[k+1][2] == state:
+            self.runs[k][1]=self.runs[k+1][1]
+            del self.runs[k+1]
+        if k > 0 and self.runs[k-1][2] == state:
+            self.runs[k-1][1]=self.runs[k][1]
+            del self.runs[k]
+
+    def next(self,state='new'):
+        '''returns the lowest index in state, or None'''
+        for run in self.runs:
+            if run[2] == state: return run[0]
+
+    def indices(self,state):
+        '''yields the indices in state'''
+        for first,last,s in self.runs:
+            if s == state: yield from range(first,last+1,self.step)
+
+    def replace(self,old,state):
+        '''set all indices in the old states to state'''
+        for run in self.runs:
+            if run[2] in old: run[2]=state
+        runs=[]
+        for run in self.runs:
+            if runs and runs[-1][2] == run[2]: runs[-1][1]=run[1]
+            else: runs.append(run)
+        self.runs=runs
+
+    def counts(self):
+        '''returns the state:count of the indices'''
+        counts={}
+        for run in self.runs: counts[run[2]]=counts.get(run[2],0)+self.size(run)
+        return counts
+
+    def update(self):
+        '''returns the job fields to update with the array state'''
+        return dict(array_runs=[list(run) for run in self.runs],array_counts=self.counts())
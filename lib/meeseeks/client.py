@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-from .state import State
+import base64
+
+from .state import State,Subscription
 from .node import Node
 
 '''
@@ -13,6 +15,7 @@ c.get_nodes() #get cluster status
 c.get_pools() #get pools
 c.get()             #get all jobs
 jid=c.submit_job(pool=...,args=[.....])  #submit a job, return the ID
+c.submit_many([{'pool':...,'args':[...]},...]) #submit many jobs in one request
 c.get_job(j)        #check the job
 c.kill_jobs(j)       #stop the job(s)
 c.close()           #disconnect client
@@ -80,16 +83,45 @@ class Client(State):
         if jid: return self.__node.request([{'kill':jid}])[0]['kill']
         else: return self.__node.request([{'kill':kwargs}])[0]['kill']
 
+    #bulk requests, each is applied by the node under one lock
+    # submit_many takes a list of submit specs, returns the jid:job map of all of them
+    # kill_many takes a list of job ids or query kwargs
+    # modify_many sets the keys in data on the jobs matching query kwargs (no sanity checks, use submit with id=... if possible)
+    def submit_many(self,specs): return self.__node.request([{'submit':list(specs)}])[0]['submit']
+    def kill_many(self,jids=None,**kwargs): return self.__node.request([{'kill':list(jids) if jids else kwargs}])[0]['kill']
+    def modify_many(self,data,**kwargs): return self.__node.request([{'modify':[{'query':kwargs,'data':data}]}])[0]['modify']
+
+    #get job output as bytes, from the spool of the node that ran the job
+    # stream is stdout or stderr, returns None if the job has no spooled output
+    def output(self,jid,stream='stdout',offset=0,length=None):
+        data=b''
+        while length is None or len(data) < length:
+            r=self.__node.request([{'output':{'id':jid,'stream':stream,'offset':offset+len(data),
+                'length':(length-len(data) if length else None)}}])[0]['output']
+            if not r: return None
+            chunk=base64.b64decode(r['data'])
+            data+=chunk
+            if not chunk or offset+len(data) >= r['size']: break
+        return data
+
     #return list of job ids for jobs matching kwargs criteria
     def ls(self,**kwargs): return self.__node.request([{'ls':kwargs}])[0]['ls']
     
     #get node and pool status, kwargs are sent but ignored (for now)
     def nodes(self,**kwargs): return self.__node.request([{'nodes':kwargs}])[0]['nodes']
     def pools(self,**kwargs): return self.__node.request([{'pools':kwargs}])[0]['pools']
+    def resources(self,**kwargs): return self.__node.request([{'resources':kwargs}])[0]['resources']
     
     #for sending raw requests
     def request(self,req): return self.__node.request([req])[0]
     
+    #change notifications need the local state, without it the subscriber falls back to polling
+    def subscribe(self,ids=None,event=None,**match):
+        if not self.__node.refresh: return Subscription(ids,event,**match)
+        return State.subscribe(self,ids,event,**match)
+    def unsubscribe(self,sub):
+        if self.__node.refresh: State.unsubscribe(self,sub)
+
     #blocks until next node sync
     def wait(self): self.__node.sync.wait()
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+
+try: import orjson
+except ImportError: orjson=None
+
+try: import msgpack
+except ImportError: msgpack=None
+
+'''codecs used for the node protocol, state files and history
+    json: stdlib json, always available
+    orjson: faster encoder/decoder for the same JSON, if orjson is importable
+    msgpack: binary encoding, if msgpack is importable
+    JobRecords are encoded as dicts by all codecs.
+    get_codec() falls back to json if a codec is not available.
+'''
+
+class Codec:
+    '''stdlib json codec, other codecs override dumps/loads'''
+    name='json'
+    binary=False #False if the encoding is JSON text
+    sep=b'\n' #separator for records written to a stream
+
+    def dumps(self,obj): return json.dumps(obj,default=dict).encode()
+    def loads(self,data): return json.loads(data)
+
+class ORJSONCodec(Codec):
+    name='orjson'
+    def dumps(self,obj): return orjson.dumps(obj,default=dict,option=orjson.OPT_NON_STR_KEYS)
+    def loads(self,data): return orjson.loads(data)
+
+class MsgPackCodec(Codec):
+    name='msgpack'
+    binary=True
+    sep=b'' #msgpack objects can be read back from a stream without a separator
+    def dumps(self,obj): return msgpack.packb(obj,default=dict)
+    def loads(self,data): return msgpack.unpackb(data,strict_map_key=False)
+
+CODECS={'json':Codec()}
+if orjson: CODECS['orjson']=ORJSONCodec()
+if msgpack: CODECS['msgpack']=MsgPackCodec()
+
+#fastest available codec that produces JSON text, for line mode and files that must stay JSON
+JSON=CODECS.get('orjson',CODECS['json'])
+
+#codecs offered when connecting, in order of preference
+PREFERRED=['msgpack','orjson','json']
+
+def get_codec(name=None):
+    '''return the named codec, or the json codec if it is not available'''
+    if not name: return CODECS['json']
+    codec=CODECS.get(name)
+    if codec is None:
+        logging.getLogger('codec').warning('codec %s not available, using json',name)
+        codec=CODECS['json']
+    return codec
+
+def negotiate(offered):
+    '''return the first codec in the offered list we have'''
+    if type(offered) is not list: offered=[offered]
+    for name in offered:
+        if name in CODECS: return CODECS[name]
+    return CODECS['json']
+
+def loads_any(data,codec=None):
+    '''decode data with codec, or the first codec that can decode it'''
+    codecs=[codec] if codec else []
+    codecs.extend(c for c in CODECS.values() if c is not codec)
+    for c in codecs:
+        try: return c.loads(data)
+        except Exception as e: error=e
+    raise error
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import threading
+
+class Delta:
+    '''tracks the version of each job a peer has, so only the changed keys of a job are sent
+        a delta is {delta:<ts of the version it applies to>,ts:<ts>,seq:<seq>,...changed keys}
+        State.sync applies deltas, and reports jobs it does not have the base version of
+        so they can be resent in full.
+        Each side of a connection keeps a Delta of what the other side has, updated when jobs are sent
+        and when they are received. Nodes keep it across reconnects while the peer's state epoch is the same.
+    '''
+
+    def __init__(self):
+        self.__lock=threading.Lock()
+        self.__has={} #jid:JobRecord the peer has
+
+    def encode(self,jobs):
+        '''return jid:job or jid:delta for jobs (a map of jid:JobRecord) and note the peer will have them'''
+        r={}
+        with self.__lock:
+            for jid,job in jobs.items():
+                old=self.__has.get(jid)
+                self.__has[jid]=job
+                d=job.diff(old) if old is not None else None
+                if d is None: r[jid]=job #peer does not have the job, or a key was removed
+                else:
+                    d.update(delta=old['ts'],ts=job['ts'],seq=job['seq']) #seq is always sent, peers track it
+                    r[jid]=d
+        return r
+
+    def received(self,jobs):
+        '''note the peer has these jobs (a map of jid:JobRecord), as it sent them to us'''
+        with self.__lock: self.__has.update(jobs)
+
+    def forget(self,jids):
+        '''the peer does not have these jobs, the next encode will send them in full'''
+        with self.__lock:
+            for jid in jids: self.__has.pop(jid,None)
+
+    def prune(self,state):
+        '''forget the jobs that are no longer in state, call periodically
+        only our keys are checked, so this does not copy the job table'''
+        with self.__lock: jids=list(self.__has)
+        self.forget(state.missing(jids))
+
+    def __len__(self): return len(self.__has) #note an empty Delta is false, test for None
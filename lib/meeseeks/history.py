@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+import logging
+import queue
+import gzip
+
+from .codec import get_codec
+
+try: import zstandard
+except ImportError: zstandard=None
+
+class History(threading.Thread):
+    '''job history writer thread
+        State queues finished jobs with put(), they are written to the history file in batches
+        so disk latency does not block the State lock.
+        config is:
+            file: <filename> history file, records are {jid:job}
+            codec: json|orjson|msgpack codec for records, json/orjson write one record per line, msgpack writes a stream
+            queue: 10000 max records waiting to be written, records are dropped if the queue is full
+            batch: 1000 max records per write
+            flush: 1 max seconds a record waits before being written
+            rotate: <bytes> if set, rotate the file when it reaches this size
+            daily: false if true, rotate the file when the date changes
+            compress: gzip|zstd if set, write compressed segments (zstd falls back to gzip if not available)
+        rotated files are renamed to <file>.<YYYYmmdd-HHMMSS>[.gz|.zst]
+    '''
+
+    def __init__(self,name='History',**cfg):
+        threading.Thread.__init__(self,daemon=True,name=name,target=self.__history_run)
+        self.logger=logging.getLogger(self.name)
+        self.shutdown=threading.Event()
+        self.__lock=threading.Lock() #lock on the open segment, held while writing and reconfiguring
+        self.__queue=queue.Queue()
+        self.__fh=None #open segment, may be a compressor writing to __raw
+        self.__raw=None #open segment file
+        self.__size=0 #bytes written to segment
+        self.__date=None #date segment was opened, for daily rotation
+        self.written=self.dropped=0
+        self.file=self.compress=None
+        self.codec=get_codec()
+        self.config(**cfg)
+        self.start()
+
+    def config(self,file=None,codec='json',queue=10000,batch=1000,flush=1,rotate=None,daily=False,compress=None,**cfg):
+        with self.__lock:
+            self.__queue.maxsize=int(queue) #resizing a Queue is safe, put() checks maxsize each call
+            self.batch=int(batch)
+            self.flush=float(flush)
+            self.rotate=int(rotate) if rotate else None
+            self.daily=daily
+            if compress=='zstd' and not zstandard:
+                self.logger.warning('zstandard not available, using gzip')
+                compress='gzip'
+            codec=get_codec(codec)
+            if self.__fh and codec.binary!=self.codec.binary: self.__rotate() #don't mix formats in a file
+            elif file!=self.file or compress!=self.compress: self.__close() #reopen on next write
+            self.codec=codec
+            self.file=file
+            self.compress=compress
+
+    def put(self,jid,job):
+        '''queue job for writing, returns False and counts the record as dropped if the queue is full'''
+        try:
+            self.__queue.put_nowait({jid:job})
+            return True
+        except queue.Full:
+            self.dropped+=1
+            return False
+
+    def stats(self):
+        '''return queue depth and written/dropped record counts'''
+        return {'queued':self.__queue.qsize(),'written':self.written,'dropped':self.dropped}
+
+    def __path(self):
+        if self.compress=='gzip': return self.file+'.gz'
+        if self.compress=='zstd': return self.file+'.zst'
+        return self.file
+
+    def __open(self):
+        path=self.__path()
+        fh=self.__raw=open(path,'ab')
+        self.__size=fh.tell()
+        self.__date=time.strftime('%Y%m%d')
+        if self.compress=='gzip': fh=gzip.GzipFile(fileobj=fh,mode='ab')
+        elif self.compress=='zstd': fh=zstandard.ZstdCompressor().stream_writer(fh,closefd=False)
+        self.__fh=fh
+
+    def __close(self):
+        for fh in (self.__fh,self.__raw):
+            if fh is None: continue
+            try: fh.close() #closing the raw file after a compressor is a no-op if it closed it
+            except Exception as e: self.logger.warning('%s:%s',self.file,e)
+        self.__fh=self.__raw=None
+
+    def __rotate(self):
+        self.__close()
+        path=self.__path()
+        rotated='%s.%s'%(self.file,time.strftime('%Y%m%d-%H%M%S'))
+        n=0
+        while os.path.exists(rotated+path[len(self.file):]): #don't clobber a segment rotated this second
+            n+=1
+            rotated='%s.%s-%s'%(self.file,time.strftime('%Y%m%d-%H%M%S'),n)
+        rotated+=path[len(self.file):] #keep compression suffix
+        try:
+            os.rename(path,rotated)
+            self.logger.info('rotated %s to %s',path,rotated)
+        except Exception as e: self.logger.warning('%s:%s',path,e)
+
+    def __write(self,batch):
+        with self.__lock:
+            if not self.file: return
+            try:
+                if self.__fh and ( (self.rotate and self.__size >= self.rotate) or \
+                        (self.daily and self.__date != time.strftime('%Y%m%d')) ):
+                    self.__rotate()
+                if not self.__fh: self.__open()
+                data=b''.join(self.codec.dumps(rec)+self.codec.sep for rec in batch)
+                self.__fh.write(data)
+                if self.compress=='zstd': self.__fh.flush(zstandard.FLUSH_FRAME)
+                else: self.__fh.flush()
+                self.__size+=len(data)
+                self.written+=len(batch)
+            except Exception as e:
+                self.logger.warning('%s:%s',self.file,e)
+                self.dropped+=len(batch)
+                self.__close()
+
+    def __history_run(self):
+        batch=[]
+        flush_ts=time.time()
+        while True:
+            try: batch.append(self.__queue.get(timeout=self.flush))
+            except queue.Empty: pass
+            #write if the batch is full, the oldest record has waited long enough, or we are shutting down
+            stop=self.shutdown.is_set() and self.__queue.empty()
+            if batch and (len(batch) >= self.batch or time.time()-flush_ts >= self.flush or stop):
+                self.__write(batch)
+                batch=[]
+            if not batch: flush_ts=time.time()
+            if stop: break
+        with self.__lock: self.__close()
+
+    def close(self):
+        '''write queued records and stop the thread'''
+        self.shutdown.set()
+        self.join()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import bisect
+
+from .util import add_resources
+
+class Index:
+    '''secondary indexes on job fields for State queries
+        field values are mapped to the set of job ids having that value,
+        (node,pool) is indexed as a pair for pool lookups,
+        each tag in tags is indexed,
+        active (not inactive state) jobs are counted per (node,pool) for slot accounting, and per node,
+        the resources of active jobs are summed per (node,pool),
+        array jobs count as one job per running task,
+        string values are also kept sorted per field for wildcard (prefix*) queries.
+        Jobs with unhashable values can't be indexed, they are always returned as candidates.
+    '''
+
+    #fields with an equality/prefix index
+    FIELDS=['node','pool','state','submit_node']
+    #changes to these keys require reindexing
+    KEYS=FIELDS+['tags','resources','array_counts']
+
+    def __init__(self,jobs={},inactive=[]):
+        self.inactive=inactive #states of inactive jobs, these don't use a slot
+        self.__values=dict((k,{}) for k in self.FIELDS) #field -> value -> set of jids
+        self.__sorted=dict((k,[]) for k in self.FIELDS) #field -> sorted list of str values
+        self.__node_pool={} #(node,pool) -> set of jids
+        self.__tags={} #tag -> set of jids
+        self.__active={} #(node,pool) -> count of active jobs
+        self.__active_nodes={} #node -> count of active jobs
+        self.__used={} #(node,pool) -> {resource:count} of active jobs
+        self.__unindexed=set() #jids with values we could not index
+        for jid,job in jobs.items(): self.add(jid,job)
+
+    def __add(self,d,k,jid):
+        try: d.setdefault(k,set()).add(jid)
+        except TypeError: #unhashable
+            self.__unindexed.add(jid)
+            return False
+        return True
+
+    def __remove(self,d,k,jid):
+        try:
+            s=d.get(k)
+            if s is None: return False
+            s.discard(jid)
+            if not s:
+                del d[k]
+                return True #last job with this value removed
+        except TypeError: pass
+        return False
+
+    def add(self,jid,job):
+        '''index job jid'''
+        for k in self.FIELDS:
+            v=job.get(k)
+            values=self.__values[k]
+            if self.__add(values,v,jid) and type(v) is str and len(values[v])==1:
+                bisect.insort(self.__sorted[k],v) #new string value
+        self.__add(self.__node_pool,(job.get('node'),job.get('pool')),jid)
+        for tag in self.tags(job): self.__add(self.__tags,tag,jid)
+        self.__count(job,1)
+
+    def remove(self,jid,job):
+        '''remove job jid from the indexes, job must be the data jid was indexed with'''
+        for k in self.FIELDS:
+            v=job.get(k)
+            if self.__remove(self.__values[k],v,jid) and type(v) is str:
+                l=self.__sorted[k]
+                i=bisect.bisect_left(l,v)
+                if i<len(l) and l[i]==v: del l[i]
+        self.__remove(self.__node_pool,(job.get('node'),job.get('pool')),jid)
+        for tag in self.tags(job): self.__remove(self.__tags,tag,jid)
+        self.__count(job,-1)
+        self.__unindexed.discard(jid)
+
+    def __count(self,job,n):
+        if job.get('state') in self.inactive: return
+        counts=job.get('array_counts')
+        if counts: 
+            try: n*=max(1,counts.get('running',0))
+            except (TypeError,AttributeError): pass
+        for d,k in ((self.__active,(job.get('node'),job.get('pool'))),(self.__active_nodes,job.get('node'))):
+            try: c=d.get(k,0)+n
+            except TypeError: return #unhashable
+            if c: d[k]=c
+            else: del d[k]
+        resources=job.get('resources')
+        if resources:
+            k=(job.get('node'),job.get('pool'))
+            try: 
+                used=add_resources(self.__used.get(k,{}),resources,n)
+                if used: self.__used[k]=used
+                else: self.__used.pop(k,None)
+            except (TypeError,AttributeError): pass #not a resource map
+
+    def active(self,node,pool=None):
+        '''return count of active jobs on node in pool, or on node if pool is None'''
+        if pool is None: return self.__active_nodes.get(node,0)
+        return self.__active.get((node,pool),0)
+
+    def used(self,node,pool):
+        '''return the resources of active jobs on node in pool, as {resource:count}'''
+        return self.__used.get((node,pool),{})
+
+    NAMES=['values','sorted','node_pool','tags','active','active_nodes','used','unindexed']
+    def __indexes(self):
+        return (self.__values,self.__sorted,self.__node_pool,self.__tags,self.__active,self.__active_nodes,self.__used,self.__unindexed)
+
+    def check(self,jobs):
+        '''rebuild the indexes from jobs and compare them to ours
+        returns a list of differences, empty if the indexes are consistent'''
+        r=[]
+        index=Index(jobs,self.inactive)
+        for name,ours,theirs in zip(self.NAMES,self.__indexes(),index.__indexes()):
+            if ours != theirs: r.append('%s index: %s != %s'%(name,ours,theirs))
+        return r
+
+    def tags(self,job):
+        tags=job.get('tags')
+        if type(tags) is list: return tags
+        return []
+
+    def prefix(self,field,prefix):
+        '''return set of jids where str value of field starts with prefix'''
+        l,values,r=self.__sorted[field],self.__values[field],set()
+        i=bisect.bisect_left(l,prefix)
+        while i<len(l) and l[i].startswith(prefix):
+            r.update(values[l[i]])
+            i+=1
+        return r
+
+    def select(self,tag=None,**query):
+        '''return the set of candidate jids for query, or None if the query can't use the indexes
+        candidates still need to be checked against the query'''
+        sets=[]
+        try:
+            #node and pool together use the pair index
+            node,pool=query.get('node'),query.get('pool')
+            if 'node' in query and 'pool' in query and not \
+                    ( (type(node) is str and node.endswith('*')) or (type(pool) is str and pool.endswith('*')) ):
+                sets.append(self.__node_pool.get((node,pool),set()))
+                query=dict((k,v) for (k,v) in query.items() if k not in ('node','pool'))
+            for k,v in query.items():
+                if k not in self.FIELDS: continue
+                if type(v) is str and v.endswith('*'): sets.append(self.prefix(k,v[:-1]))
+                else: sets.append(self.__values[k].get(v,set()))
+            if tag: sets.append(self.__tags.get(tag,set()))
+        except TypeError: return None #unhashable query value, scan
+        if not sets: return None
+        sets.sort(key=len)
+        r=sets[0].intersection(*sets[1:])
+        return r|self.__unindexed
@@ -107,20 +107,28 @@ class Job():
         '''returns info if a job finished, 
         waits forever if wait=True or for wait seconds, then returns None if running
         if multi, returns finished jobs or empty dict if none'''
-        t=0
-        while True:
-            #jobs are not finished if state='new' or active=True
-            if self.multi: 
-                self.__getattr__() #refresh cache
-                r=dict((jid,job) for (jid,job) in self.info.items() if not \
-                    (job.get('state') == 'new' or job.get('active')) )
-                if r: return r
-            elif not (self.state == 'new' or self.active): return self.info #refresh and get active flag
-            if wait:
-                if (wait is not True) and t==int(wait): break
-                time.sleep(1)
-                t+=1
-            else: break
+        if wait and wait is not True: deadline=time.time()+wait
+        sub=None
+        try:
+            while True:
+                #jobs are not finished if state='new' or active=True
+                if self.multi: 
+                    self.__getattr__() #refresh cache
+                    r=dict((jid,job) for (jid,job) in self.info.items() if not \
+                        (job.get('state') == 'new' or job.get('active')) )
+                    if r: return r
+                elif not (self.state == 'new' or self.active): return self.info #refresh and get active flag
+                if wait:
+                    timeout=1
+                    if wait is not True:
+                        timeout=min(timeout,deadline-time.time())
+                        if timeout <= 0: break
+                    #wake as soon as the job changes
+                    if sub is None: sub=self.client.subscribe(ids=self.jid)
+                    sub.wait(timeout)
+                else: break
+        finally:
+            if sub is not None: self.client.unsubscribe(sub)
 
     def kill(self,wait=None):
         '''stop running job(s)'''
@@ -137,6 +145,8 @@ class Notify(threading.Thread):
     calls the function set in Job.notify when job finishes'''
     def __init__(self):
         self.__jobs=set()
+        self.__subs={} #job:Subscription
+        self.__changed=threading.Event() #set when a tracked job changes
         self.__lock=threading.Lock()
         self.logger=logging.getLogger(name='Notify')
         threading.Thread.__init__(self,daemon=True)
@@ -159,16 +169,24 @@ class Notify(threading.Thread):
                                 job.notified.add(jid)
                         if not job.is_alive(): #if multi some jobs may still be alive
                             self.logger.debug('removing %s',job)
-                            self.__jobs.remove(job)
+                            self.__remove(job)
                             break #set size changed
-            time.sleep(1)
+            self.__changed.wait(1)
+            self.__changed.clear()
 
     def add(self,job):
         self.logger.debug('adding %s',job)
         job.notified=set()
-        with self.__lock: self.__jobs.add(job)
+        with self.__lock: 
+            self.__jobs.add(job)
+            self.__subs[job]=job.client.subscribe(ids=job.jid,event=self.__changed)
 
     def remove(self,job):
         self.logger.debug('removing %s',job)
         with self.__lock: 
-            if job in self.__jobs: self.__jobs.remove(job)
+            if job in self.__jobs: self.__remove(job)
+
+    def __remove(self,job):
+        self.__jobs.remove(job)
+        sub=self.__subs.pop(job,None)
+        if sub: job.client.unsubscribe(sub)
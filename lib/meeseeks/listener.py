@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import asyncio
+import socket
+import threading
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .protocol import AsyncFrames,MAX_WAIT,hello_response
+from .codec import JSON,get_codec
+from .manager import LoopEvent
+
+'''asyncio request listener
+    AsyncListener serves the same protocol and requests as RequestListener/RequestHandler (see the protocol module),
+    but connections are coroutines in one event loop instead of a thread each.
+    Requests are decoded, handled and encoded in a pool of worker threads.
+    Each connection has at most max_inflight requests queued for or running in the workers,
+    so a client that pipelines many requests cannot starve the others.
+    Get requests with wait are held in the event loop, so long-polls do not tie up workers.
+'''
+
+class AsyncListener:
+    '''control socket served from an asyncio event loop
+    set handler (and ssl_context) then call serve_forever in a thread, shutdown stops it'''
+    ssl_context=None
+    handler=None
+
+    def __init__(self,server_address,workers=32,max_inflight=4,max_pending=256,max_clients=10000,max_request=2**30,**cfg):
+        self.logger=logging.getLogger('AsyncListener')
+        self.socket=socket.create_server(server_address,backlog=1024)
+        self.server_address=self.socket.getsockname()
+        self.max_inflight=int(max_inflight) #requests per connection queued for or running in the workers
+        self.max_pending=int(max_pending) #requests per connection in progress before we stop reading from it
+        self.max_clients=int(max_clients) #connections over this are closed
+        self.max_request=int(max_request) #longest line mode request
+        self.clients=0
+        self.executor=ThreadPoolExecutor(int(workers),thread_name_prefix='AsyncListener')
+        self.loop=asyncio.new_event_loop()
+        self.__stop=asyncio.Event() #set in the loop by shutdown
+        self.__stopped=threading.Event()
+
+    def serve_forever(self):
+        loop=self.loop
+        asyncio.set_event_loop(loop)
+        try: loop.run_until_complete(self.__serve())
+        finally:
+            #disconnect clients
+            tasks=asyncio.all_tasks(loop)
+            while tasks: #cancelled clients may spawn tasks while cleaning up
+                for task in tasks: task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks,return_exceptions=True))
+                tasks=asyncio.all_tasks(loop)
+            loop.run_until_complete(asyncio.sleep(0)) #let closed connections clean up
+            self.executor.shutdown(wait=False)
+            loop.close()
+            self.__stopped.set()
+
+    async def __serve(self):
+        server=await asyncio.start_server(self.__client,sock=self.socket,ssl=self.ssl_context,limit=self.max_request)
+        try: await self.__stop.wait()
+        finally: server.close()
+
+    def shutdown(self):
+        '''stop serve_forever and wait for it to exit, like socketserver'''
+        self.loop.call_soon_threadsafe(self.__stop.set)
+        self.__stopped.wait()
+
+    def server_close(self): self.socket.close()
+
+    async def __client(self,reader,writer):
+        logger=logging.getLogger(str(writer.get_extra_info('peername')))
+        if self.clients >= self.max_clients:
+            logger.warning('too many clients (%s), disconnecting',self.clients)
+            writer.close()
+            return
+        self.clients+=1
+        logger.debug('connected')
+        peer={} #connection state for the request handler
+        slots=asyncio.Semaphore(self.max_inflight)
+        try:
+            while not self.handler.shutdown.is_set(): #client will be disconnected at shutdown
+                try: l=await reader.readline() #get line from client
+                except ValueError:
+                    writer.write(JSON.dumps([{'error':'request too large'}])+b'\n')
+                    break
+                if not l.strip(): break #will be empty if client disconnected
+                hello=None
+                try:
+                    async with slots: requests=await self.__run(JSON.loads,l)
+                    #the client will wait for the hello response before sending frames
+                    if requests and 'hello' in requests[0]:
+                        state=getattr(self.handler,'state',None)
+                        hello=hello_response(requests[0]['hello'],state and state.epoch)
+                        data=JSON.dumps([{'hello':hello}])
+                    else: data=await self.__handle(JSON,requests,peer,slots)
+                except Exception as e: data=JSON.dumps([{'error':str(e)}])
+                writer.write(data+b'\n')
+                await writer.drain()
+                if hello and hello.get('frame'):
+                    frames=AsyncFrames(reader,writer,compress=hello.get('compress'),
+                        compress_min=requests[0]['hello'].get('compress_min',1024))
+                    await self.__frames(frames,get_codec(hello['codec']),peer,slots,logger)
+                    break
+        except asyncio.CancelledError: pass #listener shut down
+        except Exception as e: logger.debug(e)
+        finally:
+            self.clients-=1
+            writer.close()
+            logger.debug('disconnected')
+
+    async def __frames(self,frames,codec,peer,slots,logger):
+        logger.debug('framed')
+        tasks=set()
+        try:
+            while not self.handler.shutdown.is_set():
+                #stop reading from a client that has too many requests in progress
+                if len(tasks) >= self.max_pending: await asyncio.wait(tasks,return_when=asyncio.FIRST_COMPLETED)
+                frame=await frames.recv()
+                if frame is None: break
+                rid,flags,data=frame
+                #requests are handled concurrently, so requests that block do not hold up the rest
+                task=asyncio.ensure_future(self.__frame(frames,codec,rid,data,peer,slots,logger))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks: task.cancel()
+
+    async def __frame(self,frames,codec,rid,data,peer,slots,logger):
+        try:
+            async with slots: requests=await self.__run(codec.loads,data)
+            data=await self.__handle(codec,requests,peer,slots)
+        except Exception as e: data=codec.dumps([{'error':str(e)}])
+        try: await frames.send(rid,data)
+        except Exception as e: logger.debug(e) #client went away
+
+    def __run(self,f,*args):
+        '''run f(*args) in a worker thread'''
+        return self.loop.run_in_executor(self.executor,f,*args)
+
+    async def __handle(self,codec,requests,peer,slots):
+        '''handle requests, returns the encoded responses'''
+        waits=await self.__long_poll(requests)
+        async with slots: return await self.__run(self.__process,codec,requests,peer,waits)
+
+    def __process(self,codec,requests,peer,waits):
+        #runs in a worker thread
+        responses=[]
+        try:
+            if requests:
+                for request in requests:
+                    response=self.handler.handle(request,peer)
+                    responses.append(response)
+        except Exception as e: responses.append({'error':str(e)})
+        #the seq long-polled get requests waited for, see Meeseeks.handle
+        for i,seq in waits.items():
+            if i < len(responses) and type(responses[i]) is dict: responses[i]['seq']=seq
+        return codec.dumps(responses)
+
+    async def __long_poll(self,requests):
+        '''wait for changes for get requests with wait, and remove wait from them
+        returns request index:seq of the latest change'''
+        waits={}
+        if type(requests) is not list: return waits
+        for i,request in enumerate(requests):
+            get=request.get('get') if type(request) is dict else None
+            if type(get) is dict and get.get('wait'):
+                get=dict(get)
+                wait=min(float(get.pop('wait')),MAX_WAIT)
+                requests[i]=dict(request,get=get)
+                waits[i]=await self.__wait_changes(get.get('seq',0),wait)
+        return waits
+
+    async def __wait_changes(self,seq,timeout):
+        '''State.wait_changes without blocking the event loop
+        the State calls take its lock, so they run in the workers, a writer holding it would stall every connection'''
+        state=self.handler.state
+        last=await self.__run(state.last_seq)
+        if last > seq: return last
+        event=LoopEvent(self.loop)
+        sub=await self.__run(state.subscribe,None,event)
+        try:
+            deadline=self.loop.time()+timeout
+            while True:
+                last=await self.__run(state.last_seq)
+                remaining=deadline-self.loop.time()
+                if last > seq or remaining <= 0 or self.handler.shutdown.is_set(): return last
+                await event.wait(min(remaining,1)) #check for shutdown every second
+        finally: self.executor.submit(state.unsubscribe,sub) #not awaited, so it runs if we are cancelled
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import logging
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import create_ssl_context
+from .protocol import AsyncConnection
+from .node import NodeBase
+
+'''asyncio node manager
+    NodeManager runs one event loop thread that drives the connections to all downstream nodes.
+    Each remote node is an AsyncNode, which has the same interface as the Node thread:
+    config(**cfg), request(requests) from any thread, the shutdown and sync Events, and join().
+    At most concurrency connects and sync requests are in flight at once, long-polls are not limited.
+    Nodes that cannot be reached are retried with exponential backoff, up to max_backoff seconds.
+    Building sync requests and applying responses locks State and is O(jobs), so it runs in a pool of worker threads,
+    as do the other State calls that take its lock, a writer holding it would stall every node.
+'''
+
+class LoopEvent:
+    '''stands in for the threading.Event of a State subscription and wakes a coroutine
+    set() can be called from any thread, wait() must be called from the event loop'''
+    def __init__(self,loop):
+        self.loop=loop
+        self.__event=asyncio.Event()
+        self.__pending=False #a wakeup is scheduled, so State does not flood the loop
+    def set(self):
+        if not self.__pending:
+            self.__pending=True
+            self.loop.call_soon_threadsafe(self.__event.set)
+    def is_set(self): return self.__event.is_set()
+    async def wait(self,timeout=None):
+        '''wait for a change or timeout, callers query State after this returns
+        returns True if woken by a change'''
+        try: 
+            await asyncio.wait_for(self.__event.wait(),timeout)
+            r=True
+        except asyncio.TimeoutError: r=False
+        #clear the pending flag before the event, a set() after this schedules a new wakeup
+        self.__pending=False
+        self.__event.clear()
+        return r
+
+class NodeManager(threading.Thread):
+    '''event loop thread for AsyncNodes'''
+    def __init__(self,name='NodeManager',**cfg):
+        threading.Thread.__init__(self,daemon=True,name=name,target=self.__run)
+        self.logger=logging.getLogger(self.name)
+        self.loop=asyncio.new_event_loop()
+        self.__ready=threading.Event()
+        self.config(**cfg)
+        self.executor=ThreadPoolExecutor(self.workers,thread_name_prefix=self.name)
+        self.start()
+        self.__ready.wait()
+
+    def config(self,concurrency=64,workers=8,max_backoff=60,**cfg):
+        self.concurrency=int(concurrency) #takes effect at startup
+        self.workers=int(workers) #threads that run sync work, takes effect at startup
+        self.max_backoff=max_backoff
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.limit=asyncio.Semaphore(self.concurrency)
+        self.__ready.set()
+        self.loop.run_forever()
+        self.logger.debug('stopped')
+
+    def submit(self,coro):
+        '''run coro in the event loop, returns a concurrent.futures.Future'''
+        return asyncio.run_coroutine_threadsafe(coro,self.loop)
+
+    def execute(self,f,*args):
+        '''run f(*args) in a worker thread, call from the event loop and await the result'''
+        return self.loop.run_in_executor(self.executor,f,*args)
+
+    def stop(self):
+        '''stop the event loop, AsyncNodes should be shut down first'''
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.executor.shutdown(wait=False)
+
+class AsyncNode(NodeBase):
+    '''node sync driven by a NodeManager's event loop, see Node'''
+    def __init__(self,this_node,remote_node,state,manager,**cfg):
+        self.node=this_node #node we are running on
+        self.remote_node=remote_node #node we connect to
+        self.state=state
+        self.manager=manager
+        NodeBase.__init__(self)
+        self.name='Node'
+        if self.node: self.name=self.node+'.'+self.name
+        if self.remote_node: self.name+='.'+self.remote_node
+        self.logger=logging.getLogger(self.name)
+        self.shutdown=threading.Event()
+        self.sync=threading.Event()
+        self.peer={} #sync position with the remote node, kept across reconnects to the same state epoch
+        self.refresh=0
+        self.config(**cfg)
+        self.__conn=None #AsyncConnection, or False if the last connect failed
+        self.__lock=None #asyncio.Lock so direct requests and sync don't open two connections
+        self.__task=manager.submit(self.__node_run())
+
+    def config(self,max_backoff=None,**cfg):
+        NodeBase.config(self,max_backoff=max_backoff or self.manager.max_backoff,**cfg)
+
+    def join(self,timeout=None):
+        try: self.__task.result(timeout)
+        except Exception as e: self.logger.debug(e)
+
+    def is_alive(self): return not self.__task.done()
+
+    def request(self,requests,conn=None,timeout=None):
+        '''send requests on the current connection from any thread, returns the responses or None if it failed'''
+        future=self.manager.submit(self.arequest(requests,timeout=timeout))
+        try: return future.result((timeout or self.timeout)*2)
+        except Exception as e:
+            self.logger.warning(e)
+            future.cancel()
+
+    async def connect(self):
+        '''return the AsyncConnection to the remote node, connecting if not connected, or None'''
+        if self.__lock is None: self.__lock=asyncio.Lock()
+        async with self.__lock:
+            if not self.__conn or self.__conn.closed:
+                self.logger.debug('connecting to %s:%s',self.address,self.port)
+                try:
+                    ssl=create_ssl_context(self.cfg.get('ssl')) if 'ssl' in self.cfg else None
+                    async with self.manager.limit:
+                        self.__conn=await AsyncConnection.open(self.address,self.port,ssl=ssl,timeout=self.timeout,
+                            frame=self.frame,codec=self.codec,compress=self.compress,compress_min=self.compress_min,
+                            compress_level=self.compress_level,name=self.name)
+                    self.failures=0
+                    self.logger.info('connected to %s:%s (%s)',self.address,self.port,
+                        self.__conn.codec.name if self.__conn.framed else 'line')
+                except Exception as e:
+                    self.logger.debug(e)
+                    if self.__conn is not False:
+                        self.logger.warning(e or type(e).__name__)
+                        self.__conn=False #suppress repeated warnings
+                    self.failures+=1
+            return self.__conn or None
+
+    async def arequest(self,requests,conn=None,timeout=None,limit=True):
+        '''send requests on conn or the current connection, returns the responses or None if it failed
+        if limit, wait for a slot if the manager has concurrency requests in flight'''
+        if not conn: conn=await self.connect()
+        if conn:
+            try:
+                if not limit: return await conn.request(requests,timeout)
+                async with self.manager.limit: return await conn.request(requests,timeout)
+            except Exception as e:
+                self.logger.warning(e or type(e).__name__)
+                conn.close()
+
+    async def __sleep(self,seconds,event=None):
+        '''sleep, or until the LoopEvent is set, checking for shutdown every second'''
+        loop=asyncio.get_running_loop()
+        end=loop.time()+seconds
+        while not self.shutdown.is_set() and loop.time() < end: 
+            if event is None: await asyncio.sleep(min(1,end-loop.time()))
+            elif await event.wait(min(1,end-loop.time())): break
+
+    async def __node_run(self):
+        loop=asyncio.get_running_loop()
+        #State calls that take its lock run in the manager's workers, see NodeManager
+        changed=await self.manager.execute(functools.partial(self.state.subscribe,event=LoopEvent(loop))) #wake on local changes to jobs we sync
+        routing=None
+        conn=watcher=None
+        try:
+            while not self.shutdown.is_set():
+                if not conn or conn.closed:
+                    conn=await self.connect()
+                    if conn: self.resync(conn.options)
+                    watch=bool(conn and conn.framed and conn.options.get('wait') and self.wait)
+                    if watch: watcher=asyncio.ensure_future(self.__watch_run(conn))
+                if self.node and routing is not self.routing():
+                    #resubscribe to the jobs of the nodes routed through the remote node
+                    routing=self.routing()
+                    await self.manager.execute(self.state.unsubscribe,changed)
+                    changed=await self.manager.execute(functools.partial(self.state.subscribe,event=changed.event,node=routing))
+                if conn:
+                    #sync work locks State, keep it off the event loop
+                    req,sync,local_seq=await self.manager.execute(self.sync_request,watch,self.poll_due())
+                    if len(req) > 1 or sync or not watch:
+                        responses=await self.arequest([req],conn)
+                        if responses: await self.manager.execute(self.sync_response,req,responses[0],sync,local_seq)
+                    await self.__sleep(self.next_sync(watch),changed.event)
+                else: await self.__sleep(self.backoff()) #not woken by changes, we can't send them
+        finally:
+            self.manager.executor.submit(self.state.unsubscribe,changed) #not awaited, so it runs if we are cancelled
+            if watcher: watcher.cancel()
+            if self.__conn: self.__conn.close()
+
+    async def __watch_run(self,conn):
+        '''long-poll the remote node for changes on conn until it is closed'''
+        while not self.shutdown.is_set() and not conn.closed:
+            responses=await self.arequest([self.watch_request()],conn,timeout=self.wait+self.timeout,limit=False)
+            if not responses: break
+            if not await self.manager.execute(self.watch_response,responses[0]):
+                conn.close()
+                break
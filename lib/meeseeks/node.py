@@ -3,115 +3,278 @@
 import time
 import threading
 import logging
-import json
 import socket
+import random
+import collections
 
 from .util import create_ssl_context
+from .protocol import Connection
+from .codec import PREFERRED
+from .delta import Delta
 
-class Node(threading.Thread):
+class NodeBase:
+    '''config and sync logic shared by the Node thread and AsyncNode (see the manager module)
+    the sync methods only use State, the subclass does the I/O'''
+    __routing=(None,frozenset()) #(routes version,nodes routed through the remote node)
+    interval=None #current sync interval, see next_sync
+    failures=0 #connects failed in a row, for backoff
+    __busy=False #jobs were synced since next_sync
+    __pending=0 #active jobs routed through the remote node
+    __backlog=0 #jobs to send
+    __poll_ts=0 #last time we got node status
+
+    def __init__(self):
+        self.__synced=collections.deque() #times of syncs in the last minute
+
+    def config(self,address=None,port=int('c137',16),timeout=10,refresh=1,max_refresh=None,poll=10,wait=60,max_backoff=60,frame=True,codec=PREFERRED,compress=None,compress_min=1024,compress_level=None,**cfg):
+        if address: self.address=address
+        elif self.remote_node: self.address=self.remote_node
+        else: self.address=self.node
+        if port: self.port=int(port)
+        if timeout: self.timeout=int(timeout)
+        if refresh: self.refresh=float(refresh) #how often we sync the remote node while it is busy
+        if poll: self.poll=int(poll) #how often we get node status
+        self.max_refresh=max(float(max_refresh or self.poll),self.refresh) #how often we sync the remote node while it is idle
+        self.max_backoff=max_backoff #longest wait between reconnects
+        self.wait=int(wait or 0) #long-poll the remote node for changes for this long, 0 to get changes every refresh
+        self.frame=frame #negotiate framed protocol, takes effect on the next connect
+        self.codec=codec #codec or list of codecs to offer in framed mode
+        self.compress=compress #compressor or list of compressors to offer in framed mode
+        self.compress_min=compress_min #frames smaller than this are not compressed
+        self.compress_level=compress_level
+        self.cfg=cfg
+
+    def next_sync(self,watch=False):
+        '''seconds to wait before the next sync
+        refresh while the remote node is busy (we sent or got jobs, or jobs routed through it are active),
+        doubling up to max_refresh while it is idle. If watching, active jobs are not busy, their changes are pushed to us'''
+        busy=self.__busy or (not watch and self.__pending)
+        self.__busy=False
+        if busy: self.interval=self.refresh
+        else: self.interval=min((self.interval or self.refresh)*2,self.max_refresh)
+        return self.interval
+
+    def backoff(self):
+        '''seconds to wait before reconnecting, doubles with each failed connect'''
+        if not self.failures: return self.refresh
+        delay=min(self.refresh*2**(self.failures-1),self.max_backoff)
+        return delay*random.uniform(0.5,1) #spread out reconnects to a node that went away
+
+    def poll_due(self):
+        '''returns True if it is time to get node status'''
+        if time.time()-self.__poll_ts < self.poll: return False
+        self.__poll_ts=time.time()
+        return True
+
+    def stats(self):
+        '''sync rate and backlog, for our node status'''
+        while self.__synced and time.time()-self.__synced[0] > 60: self.__synced.popleft()
+        return {
+            'interval':self.interval, #current sync interval
+            'rate':len(self.__synced)/60, #syncs per second over the last minute
+            'backlog':self.__backlog, #jobs we have not sent, or the remote node asked us to resend
+            'pending':self.__pending, #active jobs routed through the remote node
+            'failures':self.failures #failed connects in a row
+        }
+
+    def __synced_now(self,busy):
+        self.__synced.append(time.time())
+        if busy: self.__busy=True
+
+    def resync(self,options):
+        '''reset the sync position if the connection options are for a different state epoch than the last connection
+        if the remote node restarted, it may not have what we sent it and its seqs start over'''
+        self.__poll_ts=0 #get node status on connect
+        epoch=options.get('epoch')
+        if epoch and epoch==self.peer.get('epoch') and (self.peer['delta'] is not None)==bool(options.get('delta')):
+            self.logger.info('resuming sync at local seq %s, remote seq %s',self.peer['local_seq'],self.peer['remote_seq'])
+            return
+        self.peer=dict(
+            epoch=epoch,
+            local_seq=0, #highest seq of our jobs the remote node has acknowledged
+            remote_seq=0, #highest seq of remote jobs we have
+            #if the remote node supports deltas, track what it has so we only send changes
+            delta=Delta() if options.get('delta') else None,
+            resend=set(), #jobs the remote node needs in full
+            missing=[] #jobs we need in full
+        )
+
+    def routing(self):
+        '''frozenset of the nodes routed through the remote node, the same object until the routes change'''
+        version,routes=self.state.get_routes()
+        if version != self.__routing[0]:
+            self.__routing=(version,frozenset(node for (node,hops) in routes.items() if self.remote_node in hops))
+        return self.__routing[1]
+
+    def sync_request(self,watch=False,poll=False):
+        '''returns (request,jobs to send,local seq to resume from once the remote node answers)
+        if watch, remote changes are long-polled and the request does not get them'''
+        peer=self.peer
+        local_seq,delta,resend=peer['local_seq'],peer['delta'],peer['resend']
+        #we sync updates for all nodes that are routed through the remote node
+        #if self.node is None, we are are a client and always send updates
+        routing=self.routing()
+        jobs=self.state.get(seq=local_seq,records=True)
+        if resend: jobs.update(self.state.get(ids=list(resend),records=True))
+        sync=dict( (jid,job) for (jid,job) in jobs.items() if self.node is None or job['node'] in routing )
+        #get highest local sequence number, we resume from it once the remote node has it
+        if sync: local_seq=max(local_seq,max(job['seq'] for job in sync.values()))
+        self.__backlog=len(sync)
+        if self.node: self.__pending=self.state.active_jobs(routing)
+        #create the request
+        req={
+            #dump all jobs for this node updated more recently than the last sync
+            'sync':sync,
+        }
+        if not watch: req['get']={'seq':peer['remote_seq']}
+        if delta is not None:
+            delta.forget(resend)
+            req['sync']=delta.encode(sync)
+            if not watch: req['get'].update(delta=1,resend=peer['missing'])
+        #get status if poll interval, routing we already have is sent as a digest
+        if poll:
+            req.update(nodes={'digest':1,'resend':[node for node in self.state.routing_missing() if node in routing]})
+            if delta is not None: delta.prune(self.state)
+        return req,sync,local_seq
+
+    def sync_response(self,req,response,sync,local_seq):
+        '''apply the response to a sync_request'''
+        peer=self.peer
+        peer['local_seq']=local_seq
+        peer['resend']=set(response.get('resend',[]))
+        self.__backlog=len(peer['resend'])
+        jobs=response.get('get',{})
+        #get highest remote seq number
+        if jobs: peer['remote_seq']=max(job['seq'] for job in jobs.values())
+        #get node status
+        status=response.get('nodes',{})
+        if 'get' in req: peer['missing']=[]
+        updated=self.state.sync(jobs,status,peer['missing'])
+        if peer['delta'] is not None and updated: peer['delta'].received(self.state.get(ids=updated,records=True))
+        if sync or updated:
+            self.logger.debug('%s sent %s, updated %s, local_seq %s, remote_seq %s',
+                time.time(),len(sync),len(updated),local_seq,peer['remote_seq'])
+        self.__synced_now(sync or updated)
+        #toggle the sync Event to signal anything waiting for sync
+        self.sync.set()
+        self.sync.clear()
+
+    def watch_request(self):
+        '''long-poll request for remote changes'''
+        req={'get':{'seq':self.peer['remote_seq'],'wait':self.wait}}
+        if self.peer['delta'] is not None: req['get'].update(delta=1,resend=self.peer['missing'])
+        return req
+
+    def watch_response(self,response):
+        '''apply the response to a watch_request, returns False if the connection should be dropped'''
+        peer=self.peer
+        if 'error' in response:
+            self.logger.warning(response['error'])
+            return False
+        jobs=response.get('get',{})
+        #the remote node returns the seq it waited for, some changes may not be sent to us
+        peer['remote_seq']=max([peer['remote_seq'],response.get('seq',0)]+[job['seq'] for job in jobs.values()])
+        peer['missing']=[]
+        updated=self.state.sync(jobs,{},peer['missing'])
+        if peer['delta'] is not None and updated: peer['delta'].received(self.state.get(ids=updated,records=True))
+        if updated: self.logger.debug('%s updated %s, remote_seq %s',time.time(),len(updated),peer['remote_seq'])
+        self.__synced_now(updated)
+        self.sync.set()
+        self.sync.clear()
+        return True
+
+class Node(NodeBase,threading.Thread):
     '''node poller/state sync thread
     initially we try to push all state to the node (sync_ts of 0)'''
     def __init__(self,this_node,remote_node,state,start_node=True,**cfg):
-        self.node=this_node #node we are running on 
+        self.node=this_node #node we are running on
         self.remote_node=remote_node #node we connect to
         self.state=state
+        NodeBase.__init__(self)
         name='Node'
         if self.node:name=self.node+'.'+name
         if self.remote_node: name+='.'+self.remote_node
         threading.Thread.__init__(self,daemon=True,name=name,target=self.__node_run)
         self.logger=logging.getLogger(self.name)
-        self.__lock=threading.Lock() #to ensure direct request and sync don't clobber
-        self.__socket=None
+        self.__lock=threading.Lock() #to ensure direct requests and sync don't open two connections
+        self.__socket=None #Connection, or False if the last connect failed
         self.shutdown=threading.Event()
         self.sync=threading.Event()
+        self.peer={} #sync position with the remote node, kept across reconnects to the same state epoch
         self.refresh=0
         self.config(**cfg)
         if self.refresh: self.start() #if refresh=0, do not start thread
 
-    def config(self,address=None,port=int('c137',16),timeout=10,refresh=1,poll=10,**cfg):
-        if address: self.address=address
-        elif self.remote_node: self.address=self.remote_node
-        else: self.address=self.node
-        if port: self.port=int(port)
-        if timeout: self.timeout=int(timeout)
-        if refresh: self.refresh=int(refresh) #how often we sync the remote node
-        if self.refresh and poll: self.poll_count=int(poll)/self.refresh
-        self.cfg=cfg
-
-    def request(self,requests):
+    def connect(self):
+        '''return the Connection to the remote node, connecting if not connected, or None'''
         with self.__lock:
-            #connect and send/recieve request/response
-            if not self.__socket:
+            #connect and negotiate the protocol
+            if not self.__socket or self.__socket.closed:
                 self.logger.debug('connecting to %s:%s',self.address,self.port)
-                try: 
-                    self.__socket=socket.create_connection((self.address,self.port),timeout=self.timeout)
+                try:
+                    sock=socket.create_connection((self.address,self.port),timeout=self.timeout)
                     if 'ssl' in self.cfg:
-                        self.__socket = create_ssl_context(self.cfg.get('ssl')).wrap_socket(self.__socket)
+                        sock = create_ssl_context(self.cfg.get('ssl')).wrap_socket(sock)
+                    self.__socket=Connection(sock,timeout=self.timeout,frame=self.frame,codec=self.codec,
+                        compress=self.compress,compress_min=self.compress_min,compress_level=self.compress_level,name=self.name)
+                    self.failures=0
                 except Exception as e:
                     self.logger.debug(e)
+                    self.failures+=1
                     if self.__socket is not False:
                         self.logger.warning(e)
                         self.__socket=False #suppress repeated warnings
-                if self.__socket: self.logger.info('connected to %s:%s',self.address,self.port)
-            if self.__socket:
-                try:
-                    self.__socket.sendall(json.dumps(requests).encode())
-                    self.__socket.sendall('\n'.encode())
-                    l=''
-                    while True:
-                        d=self.__socket.recv(65535).decode()
-                        if not d: raise Exception('disconnected from %s:%s'%(self.address,self.port))
-                        l+=d
-                        if '\n' in l: return json.loads(l)
-                except Exception as e: 
-                    self.logger.warning(e)
-                    if self.__socket: 
-                        self.__socket.close()
-                        self.__socket=None
+                if self.__socket: self.logger.info('connected to %s:%s (%s)',self.address,self.port,
+                    self.__socket.codec.name if self.__socket.framed else 'line')
+            return self.__socket or None
+
+    def request(self,requests,conn=None,timeout=None):
+        '''send requests on conn or the current connection, returns the responses or None if it failed'''
+        if not conn: conn=self.connect()
+        if conn:
+            #send/recieve request/response, in framed mode requests from many threads can be in flight
+            try: return conn.request(requests,timeout)
+            except Exception as e:
+                self.logger.warning(e)
+                with self.__lock:
+                    conn.close()
+                    if self.__socket is conn: self.__socket=None
 
     def __node_run(self):
+        changed=self.state.subscribe() #wake on local changes to jobs we sync so they are sent right away
+        routing=None
+        conn=None
         while not self.shutdown.is_set():
-            if not self.__socket: #reset sync on disconnect
-                local_seq=remote_seq=0
-                poll=-1
-            
-            #we sync updates for all nodes that are routed through the remote node
-            #if self.node is None, we are are a client and always send updates
-            node_status=self.state.get_nodes()
-            sync=dict( (jid,job) for (jid,job) in self.state.get(seq=local_seq).items() \
-                        if self.node is None or \
-                            job['node'] in node_status.get(self.remote_node,{}).get('routing',[])
-                    )
-            #get highest local sequence number
-            if sync: local_seq=max(job['seq'] for job in sync.values())
-            #create the request
-            req={
-                #dump all jobs for this node updated more recently than the last sync
-                'sync':sync,
-                'get':{'seq':remote_seq}
-            }
-
-            #get status if poll interval
-            poll=(poll+1)%self.poll_count
-            if not poll: req.update(nodes={}) 
-            
-            #make request
-            responses=self.request([req])
-            updated=None
-            #sync incoming state
-            if responses:
-                response=responses[0]
-                jobs=response.get('get',{})
-                #get highest remote seq number
-                if jobs: remote_seq=max(job['seq'] for job in jobs.values())
-                #get node status
-                status=response.get('nodes',{})
-                updated=self.state.sync(jobs,status)
-                if sync or updated:
-                    self.logger.debug('%s sent %s, updated %s, local_seq %s, remote_seq %s',
-                        time.time(),len(sync),len(updated),local_seq,remote_seq)    
-                #toggle the sync Event to signal anything waiting for sync
-                self.sync.set()
-                self.sync.clear()
-            time.sleep(self.refresh) 
+            if not conn or conn.closed:
+                conn=self.connect()
+                if conn: self.resync(conn.options)
+                #if the remote node supports long-polling, a watcher gets its changes as they happen
+                #and we only send requests when we have something to send
+                watch=bool(conn and conn.framed and conn.options.get('wait') and self.wait)
+                if watch: threading.Thread(target=self.__watch_run,args=(conn,),daemon=True,
+                    name=self.name+'.watch').start()
+            if self.node and routing is not self.routing():
+                #resubscribe to the jobs of the nodes routed through the remote node
+                routing=self.routing()
+                self.state.unsubscribe(changed)
+                changed=self.state.subscribe(event=changed.event,node=routing)
+            if conn:
+                req,sync,local_seq=self.sync_request(watch,self.poll_due())
+                #make request, if watching only when there is something to send
+                if len(req) > 1 or sync or not watch:
+                    responses=self.request([req],conn)
+                    if responses: self.sync_response(req,responses[0],sync,local_seq)
+                #wait for local changes, poll the remote node more often while it is busy
+                changed.wait(self.next_sync(watch))
+            else: self.shutdown.wait(self.backoff()) #not woken by changes, we can't send them
+        self.state.unsubscribe(changed)
         if self.__socket:self.__socket.close()
+
+    def __watch_run(self,conn):
+        '''long-poll the remote node for changes on conn until it is closed'''
+        while not self.shutdown.is_set() and not conn.closed:
+            responses=self.request([self.watch_request()],conn,timeout=self.wait+self.timeout)
+            if not responses: break
+            if not self.watch_response(responses[0]): #drop the connection, the main loop will reconnect
+                conn.close()
+                break
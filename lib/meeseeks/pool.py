@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import threading
 import logging
+import multiprocessing.connection
 
 from .task import Task
+from .scheduler import priority_key
+from .array import Array
+from .util import get_resources,add_resources,fits
 
 '''PLUGIN API
     The Pool class can be inherited to create a pool that does something other than spawn processes.
@@ -21,8 +26,36 @@ from .task import Task
         TASK_CLASS=MyTask
         #we don't change anything else in Pool
 
+    The pool waits on the sentinel of tasks that have one (as multiprocessing.Process does), so their exit wakes it,
+    other tasks are polled every second.
 '''
 
+class TaskEvent:
+    '''stands in for the threading.Event of the pool's State subscription, so one wait also wakes on task exit
+    set() can be called from any thread, it writes to a pipe that wait() selects on with the task sentinels'''
+    def __init__(self):
+        self.__r,self.__w=os.pipe()
+        os.set_blocking(self.__r,False)
+        os.set_blocking(self.__w,False) #a full pipe is already set
+        self.__lock=threading.Lock() #so set() can't write to a closed fd that was reused
+    def set(self):
+        with self.__lock:
+            if self.__w is None: return
+            try: os.write(self.__w,b'\0')
+            except BlockingIOError: pass
+    def clear(self):
+        try: 
+            while os.read(self.__r,4096): pass
+        except BlockingIOError: pass
+    def wait(self,timeout=None,sentinels=()):
+        '''wait for set() or for a process in sentinels to exit, returns True if set'''
+        return self.__r in multiprocessing.connection.wait([self.__r,*sentinels],timeout)
+    def close(self):
+        with self.__lock:
+            os.close(self.__r)
+            os.close(self.__w)
+            self.__w=None
+
 class Pool(threading.Thread):
     '''job queue manager'''
     POOL_TYPE='Pool'
@@ -36,10 +69,12 @@ class Pool(threading.Thread):
         self.logger=logging.getLogger(self.name)
         self.shutdown=threading.Event()
         self.__tasks={} #map of job_id -> Task object
+        self.__arrays={} #map of array job_id -> {index:(Task object,start ts)}
+        self.__changed=self.state.subscribe(node=self.node,pool=self.pool,event=TaskEvent()) #wakes us when our jobs change
         self.config(**cfg)
         self.start()
 
-    def config(self,slots=0,update=None,runtime=None,drain=False,hold=False,**cfg):
+    def config(self,slots=0,resources=None,update=None,runtime=None,drain=False,hold=False,**cfg):
         if update: self.update=int(update) #how often we update the state of running jobs
         else: self.update=None
         if runtime: self.max_runtime=int(runtime)
@@ -47,6 +82,7 @@ class Pool(threading.Thread):
         if slots==0: self.slots=True
         else: self.slots=int(slots) 
         if drain: self.slots=0 #set free slots to 0 to avoid new jobs
+        self.resources=get_resources(resources) #{resource:count} for jobs that request resources
         self.hold=hold
 
     def update_job(self,jid,**data):
@@ -56,10 +92,30 @@ class Pool(threading.Thread):
             else: data['active']=True
         return self.state.update_job(jid,**data)
 
+    def running(self):
+        '''count of running tasks'''
+        return len(self.__tasks)+sum(len(tasks) for tasks in self.__arrays.values())
+
+    def free_slot(self):
+        return (self.slots is True) or (self.running() < self.slots)
+
+    def has_resources(self,need,used=None):
+        '''True if need fits the pool's resources, less the used resources if given
+        a pool with no resources configured does not account them, so anything fits'''
+        if not self.resources: return True
+        return fits(need,self.resources if used is None else add_resources(dict(self.resources),used,-1))
+
+    def sentinels(self):
+        '''the sentinels of the running tasks, which are ready when the task exits
+        tasks that are not processes (see PLUGIN API) have none and are polled every tick'''
+        tasks=list(self.__tasks.values())+[task for tasks in self.__arrays.values() for (task,start_ts) in tasks.values()]
+        return [task.sentinel for task in tasks if getattr(task,'sentinel',None) is not None]
+
     def start_job(self,jid):
         '''caaaaaaan do!'''
         job=self.state.get_job(jid)
         job.update(id=jid) #put jid in job spec for task class
+        if self.state.spool: job.update(spool=self.state.spool) #task output goes to the node's spool
         try: 
             self.__tasks[jid]=self.TASK_CLASS(job)
             self.update_job(jid,
@@ -85,12 +141,97 @@ class Pool(threading.Thread):
             except Exception as e: self.logger.warning(e,exc_info=True)
         return self.update_job(jid,state=state,**info)
 
+    def array_task(self,jid,job,i):
+        '''returns the job spec for the task of index i of array job jid
+        {index} in stdin/stdout/stderr is replaced with the index, output that is not redirected is discarded'''
+        task=dict(job,id=jid,array_index=i)
+        task.pop('array_runs',None)
+        for stream in ('stdin','stdout','stderr'):
+            path=job.get(stream) or (stream != 'stdin' and os.devnull)
+            if path: task[stream]=path.replace('{index}',str(i))
+        return task
+
+    def run_array(self,jid,job,used):
+        '''poll, kill and start the tasks of array job jid, tasks are started from the lowest new index as slots free up
+        the job is updated once per call with the index states and the task count'''
+        state=job['state']
+        tasks=self.__arrays.setdefault(jid,{})
+        if not tasks and state in self.state.JOB_INACTIVE and not job.get('active'): 
+            del self.__arrays[jid]
+            return job
+        array=Array.from_job(job)
+        need=job.get('resources') or {}
+        update={}
+        #check running tasks
+        for i,(task,start_ts) in list(tasks.items()):
+            r=task.poll()
+            if r is not None: s='done' if r else 'failed'
+            else:
+                runtime=min(t for t in (job.get('runtime'),self.max_runtime,float('inf')) if t)
+                if state == 'killed': s='killed'
+                elif time.time()-start_ts > runtime:
+                    self.logger.warning('job %s[%s] exceeded runtime of %s',jid,i,runtime)
+                    s='failed'
+                else: continue
+                try:
+                    task.kill()
+                    task.join()
+                except Exception as e: self.logger.warning(e,exc_info=True)
+            if s == 'failed': update['error']=task.info.get('error') or 'index %s rc %s'%(i,task.info.get('rc'))
+            self.logger.info('task %s[%s] %s',jid,i,s)
+            array.set(i,s)
+            add_resources(used,need,-1)
+            del tasks[i]
+
+        if state == 'killed': array.replace(('new',),'killed')
+        elif state in ('new','running') and not job.get('hold') and not self.hold:
+            #fail the indices if we don't have the resources, they would never start
+            if not self.has_resources(need):
+                self.logger.warning('job %s needs resources %s, pool has %s',jid,need,self.resources)
+                array.replace(('new',),'failed')
+                update['error']='resources'
+            #start tasks while we have a free slot and the resources
+            while self.free_slot() and self.has_resources(need,used):
+                i=array.next()
+                if i is None: break
+                try: tasks[i]=(self.TASK_CLASS(self.array_task(jid,job,i)),time.time())
+                except Exception as e:
+                    self.logger.warning(e)
+                    array.set(i,'failed')
+                    update['error']=str(e)
+                    continue
+                array.set(i,'running')
+                add_resources(used,need)
+
+        counts=array.counts()
+        if tasks: 
+            if state == 'new': update.update(state='running',start_ts=time.time(),start_count=job['start_count']+1)
+        elif state == 'killed': update.update(state='killed',end_ts=time.time())
+        elif not counts.get('new'): #all indices finished
+            if counts.get('failed') or counts.get('killed'): 
+                update.update(state='failed',end_ts=time.time(),fail_count=job['fail_count']+1)
+            else: update.update(state='done',end_ts=time.time())
+        elif not job.get('active'): update['active']=True #claim it until we have a free slot
+        if update or array.runs != job.get('array_runs'):
+            update.update(array.update())
+            job.update(self.update_job(jid,**update))
+        if 'state' in update: self.logger.info('array job %s %s %s',jid,update['state'],counts)
+        return job
+
     def __pool_run(self):
         while not self.shutdown.is_set():
             try:
                 #get jobs assigned to this node and pool
-                pool_jobs=self.state.get(node=self.node,pool=self.pool)
-                for jid,job in sorted(pool_jobs.items(),key=lambda j:j[1]['submit_ts']):
+                pool_jobs=self.state.get(node=self.node,pool=self.pool,indices=True)
+                #resources used by running tasks
+                used={}
+                for jid in self.__tasks: add_resources(used,pool_jobs.get(jid,{}).get('resources') or {})
+                for jid,tasks in self.__arrays.items(): add_resources(used,pool_jobs.get(jid,{}).get('resources') or {},len(tasks))
+                #start jobs by highest priority, then oldest submitted
+                for jid,job in sorted(pool_jobs.items(),key=lambda j:priority_key(j[1])):
+                    if job.get('array'): 
+                        self.run_array(jid,job,used)
+                        continue
                     #check running jobs
                     if jid in self.__tasks: 
                         state=job['state']
@@ -141,11 +282,17 @@ class Pool(threading.Thread):
                     #  set job active if not
                     #  start job if not on hold and a slot is free
                     if job['state'] == 'new':
-                        #do we have a free slot, and is the job/pool not on hold?
-                        if not job.get('hold') and not self.hold and ((self.slots is True) or (len(self.__tasks) < self.slots)):
+                        need=job.get('resources') or {}
+                        #fail jobs that need more resources than we have, they would never start
+                        if not self.has_resources(need):
+                            self.logger.warning('job %s needs resources %s, pool has %s',jid,need,self.resources)
+                            job=self.update_job(jid,state='failed',error='resources',fail_count=job.get('fail_count',0)+1)
+                        #do we have a free slot and the resources, and is the job/pool not on hold?
+                        elif not job.get('hold') and not self.hold and self.free_slot() and self.has_resources(need,used):
                             self.start_job(jid) #start it
+                            add_resources(used,need)
                         #if on hold in pool, claim it without running it yet
-                        else: job=self.update_job(jid,active=True) #activate it
+                        elif not job.get('active'): job=self.update_job(jid,active=True) #activate it
 
                 #check for orphaned tasks. This shouldn't happen but it can if time jumps.
                 for jid in list(self.__tasks.keys()):
@@ -153,19 +300,38 @@ class Pool(threading.Thread):
                         self.logger.warning('job %s not in state',jid)
                         self.kill_job(jid,None) #just kill it
                         del self.__tasks[jid] #recover the slot
+                for jid in list(self.__arrays.keys()):
+                    if jid not in pool_jobs:
+                        self.logger.warning('array job %s not in state',jid)
+                        for task,start_ts in self.__arrays.pop(jid).values(): 
+                            task.kill()
+                            task.join()
                         
                 #update pool status
-                self.state.update_pool(self.pool,self.node,self.slots)
+                self.state.update_pool(self.pool,self.node,self.slots,self.resources)
 
             except Exception as e: self.logger.error(e,exc_info=True)
-            time.sleep(1)
+            #wait for a job change or for a task to exit, so its slot is reused right away instead of on the next tick
+            self.__changed.event.wait(1,self.sentinels())
+            self.__changed.event.clear()
 
         #at shutdown, kill all jobs, mark as failed
-        pool_jobs=self.state.get(node=self.node,pool=self.pool)
+        pool_jobs=self.state.get(node=self.node,pool=self.pool,indices=True)
         for jid in list(self.__tasks.keys()):
             job=pool_jobs[jid]
             self.kill_job(jid,job)
             self.update_job( jid, state='failed', error='pool')
+        for jid,tasks in self.__arrays.items():
+            job=pool_jobs.get(jid)
+            if job is None: continue
+            array=Array.from_job(job)
+            for i,(task,start_ts) in tasks.items():
+                task.kill()
+                task.join()
+                array.set(i,'failed')
+            self.update_job( jid, state='failed', error='pool', **array.update())
 
         #at shutdown remove self from pool status
         self.state.update_pool(self.pool,self.node,False)
+        self.state.unsubscribe(self.__changed)
+        self.__changed.event.close()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import socket
+import asyncio
+import threading
+import logging
+import struct
+import time
+import zlib
+
+try: import zstandard
+except ImportError: zstandard=None
+
+from .codec import CODECS,JSON,PREFERRED,get_codec,negotiate
+
+'''node protocol
+    line mode: each request is a line of JSON [{request},...] and gets a line of JSON [{response},...] back.
+        This is the default and can be used with netcat.
+    framed mode: requests and responses are sent as HEADER+payload frames.
+        The response has the id of its request, so many requests can be in flight on one connection.
+    A client connection starts in line mode and sends [{"hello":{"frame":1,"codec":[codecs we have],"delta":1}}].
+    A peer that supports framing answers [{"hello":{"frame":1,"codec":<codec>,"delta":1}}] and both sides switch
+    to framed mode, encoding payloads with the first offered codec the peer has (see the codec module).
+    delta:1 means the peer accepts deltas in sync and get requests (see the delta module).
+    wait:1 means the peer will hold a get request with wait:<seconds> open until there are changes after its seq.
+    The peer answers with the epoch of its state, a reconnect to the same epoch resumes syncing from the last seqs.
+    If the hello has "compress":[zstd,zlib] and "compress_min":<bytes>, the peer answers with the first
+    compressor it has and frames of at least compress_min bytes are compressed (flag COMPRESSED) in each direction.
+    Compression is a stream per direction, so later frames reuse the keys and values seen in earlier ones.
+    An old peer answers [{}] and the connection stays in line mode.
+'''
+
+HEADER=struct.Struct('!IIB') #payload length, request id, flags
+MAX_FRAME=2**31
+COMPRESSED=0x80 #frame flag, payload is compressed
+MAX_WAIT=300 #longest a get request with wait will be held open
+
+class ZlibStream:
+    '''zlib compressor/decompressor pair for one connection, each frame is flushed'''
+    name='zlib'
+    def __init__(self,level=None):
+        self.__c=zlib.compressobj(1 if level is None else int(level))
+        self.__d=zlib.decompressobj()
+    def compress(self,data): return self.__c.compress(data)+self.__c.flush(zlib.Z_SYNC_FLUSH)
+    def decompress(self,data): return self.__d.decompress(data)
+
+class ZstdStream:
+    name='zstd'
+    def __init__(self,level=None):
+        self.__c=zstandard.ZstdCompressor(level=3 if level is None else int(level)).compressobj()
+        self.__d=zstandard.ZstdDecompressor().decompressobj()
+    def compress(self,data): return self.__c.compress(data)+self.__c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    def decompress(self,data): return self.__d.decompress(data)
+
+COMPRESSORS={'zlib':ZlibStream}
+if zstandard: COMPRESSORS['zstd']=ZstdStream
+
+class CompressionStats:
+    '''compression totals for all connections in this process'''
+    def __init__(self):
+        self.__lock=threading.Lock()
+        self.raw=self.wire=0 #bytes before and after compression, sent and received
+        self.cpu=0.0 #thread CPU seconds spent compressing and decompressing
+    def add(self,raw,wire,cpu):
+        with self.__lock:
+            self.raw+=raw
+            self.wire+=wire
+            self.cpu+=cpu
+    def get(self):
+        '''return {raw,wire,ratio,cpu} or None if nothing was compressed'''
+        if not self.wire: return None
+        return {'raw':self.raw,'wire':self.wire,'ratio':round(self.raw/self.wire,2),'cpu':round(self.cpu,3)}
+
+STATS=CompressionStats()
+
+def negotiate_compress(offered):
+    '''return the name of the first offered compressor we have, or None'''
+    if type(offered) is not list: offered=[offered]
+    for name in offered:
+        if name in COMPRESSORS: return name
+
+def hello_request(codec,compress=None,compress_min=1024):
+    '''the hello a client sends to negotiate framing, only offers the codecs and compressors we have'''
+    if type(codec) is not list: codec=[codec]
+    hello={'frame':1,'codec':[c for c in codec if c in CODECS],'delta':1,'wait':1}
+    if compress:
+        if type(compress) is not list: compress=[compress]
+        hello.update(compress=[c for c in compress if c in COMPRESSORS],compress_min=compress_min)
+    return hello
+
+def hello_response(hello,epoch=None):
+    '''the listener's answer to a hello, the options both sides will use'''
+    if not hello.get('frame'): return {}
+    r={'frame':1,'codec':negotiate(hello.get('codec','json')).name}
+    if hello.get('delta'): r['delta']=1
+    if hello.get('wait'): r['wait']=1
+    compress=negotiate_compress(hello.get('compress'))
+    if compress: r['compress']=compress
+    #the epoch of our state, so a peer that reconnects can resume syncing from the seqs it has
+    if epoch: r['epoch']=epoch
+    return r
+
+class Frames:
+    '''reads and writes frames on a socket, frames are received into a reused buffer
+        if compress is set, payloads of at least compress_min bytes are compressed'''
+    def __init__(self,sock,size=2**16,compress=None,compress_min=1024,level=None):
+        self.sock=sock
+        self.__size=size
+        self.__buf=bytearray(size)
+        self.__lock=threading.Lock() #so frames from different threads are not interleaved
+        self.__stream=COMPRESSORS[compress](level) if compress else None
+        self.compress_min=int(compress_min)
+
+    def send(self,rid,data,flags=0):
+        with self.__lock:
+            #compress under the lock, the peer must decompress frames in the order they were compressed
+            if self.__stream and len(data) >= self.compress_min:
+                t=time.thread_time()
+                raw=len(data)
+                data=self.__stream.compress(data)
+                flags|=COMPRESSED
+                STATS.add(raw,len(data),time.thread_time()-t)
+            self.sock.sendall(HEADER.pack(len(data),rid,flags)+data)
+
+    def __read(self,n):
+        '''read n bytes into the buffer, returns False on EOF before the first byte'''
+        if n > len(self.__buf): self.__buf=bytearray(max(n,2*len(self.__buf)))
+        with memoryview(self.__buf) as view:
+            pos=0
+            while pos < n:
+                r=self.sock.recv_into(view[pos:n])
+                if not r:
+                    if pos: raise ConnectionError('disconnected in frame')
+                    return False
+                pos+=r
+        return True
+
+    def recv(self):
+        '''returns (rid,flags,payload) of the next frame or None if the peer disconnected'''
+        if not self.__read(HEADER.size): return None
+        length,rid,flags=HEADER.unpack_from(self.__buf)
+        if length >= MAX_FRAME: raise ConnectionError('frame too large (%s)'%length)
+        if length and not self.__read(length): raise ConnectionError('disconnected in frame')
+        if flags & COMPRESSED:
+            if not self.__stream: raise ConnectionError('compressed frame without compression')
+            t=time.thread_time()
+            with memoryview(self.__buf) as view: data=self.__stream.decompress(view[:length])
+            STATS.add(len(data),length,time.thread_time()-t)
+            self.__shrink()
+            return rid,flags&~COMPRESSED,data
+        data=bytes(self.__buf[:length])
+        self.__shrink()
+        return rid,flags,data
+
+    def __shrink(self):
+        '''drop a buffer grown for a large frame once it is consumed, so the connection does not keep it'''
+        if len(self.__buf) > self.__size: self.__buf=bytearray(self.__size)
+
+    def buffer_size(self): return len(self.__buf)
+
+class Connection:
+    '''client side of a node protocol connection, negotiates framing if frame=True'''
+    def __init__(self,sock,timeout=None,frame=True,codec=PREFERRED,compress=None,compress_min=1024,compress_level=None,name='Connection'):
+        self.logger=logging.getLogger(name)
+        self.sock=sock
+        self.timeout=timeout
+        self.framed=False
+        self.options={} #options the peer agreed to in the hello
+        self.codec=JSON #line mode is always JSON
+        self.closed=False
+        self.__lock=threading.Lock() #line mode: one request at a time, framed mode: protects __pending
+        self.__pending={} #framed mode: rid:[Event,response] of requests in flight
+        self.__rid=0
+        if frame: self.__hello(codec,compress,compress_min,compress_level)
+
+    def __hello(self,codec,compress,compress_min,compress_level):
+        r=self.__line_request([{'hello':hello_request(codec,compress,compress_min)}])
+        hello=self.options=r[0].get('hello',{}) if r else {}
+        if hello.get('frame'):
+            self.framed=True
+            self.codec=get_codec(hello.get('codec'))
+            self.__frames=Frames(self.sock,compress=negotiate_compress(hello.get('compress')),
+                compress_min=compress_min,level=compress_level)
+            #the reader thread blocks on the socket, requests time out on their own
+            self.sock.settimeout(None)
+            threading.Thread(target=self.__reader,daemon=True,name=self.logger.name+'.reader').start()
+
+    def __line_request(self,requests):
+        self.sock.sendall(JSON.dumps(requests)+b'\n')
+        #the response ends with the only newline, collect the chunks and decode once
+        chunks=[]
+        while True:
+            d=self.sock.recv(2**16)
+            if not d: raise ConnectionError('disconnected')
+            chunks.append(d)
+            if b'\n' in d: return JSON.loads(b''.join(chunks))
+
+    def request(self,requests,timeout=None):
+        '''send a list of requests and return the list of responses
+        raises an exception if the connection fails, it should then be closed'''
+        if not self.framed:
+            with self.__lock: return self.__line_request(requests)
+        slot=[threading.Event(),None]
+        with self.__lock:
+            if self.closed: raise ConnectionError('disconnected')
+            self.__rid=(self.__rid+1) % 2**32
+            rid=self.__rid
+            self.__pending[rid]=slot
+        self.__frames.send(rid,self.codec.dumps(requests))
+        if not slot[0].wait(timeout or self.timeout):
+            with self.__lock: self.__pending.pop(rid,None)
+            raise TimeoutError('request timed out')
+        if slot[1] is None: raise ConnectionError('disconnected')
+        return slot[1]
+
+    def __reader(self):
+        try:
+            while True:
+                frame=self.__frames.recv()
+                if frame is None: break
+                rid,flags,data=frame
+                with self.__lock: slot=self.__pending.pop(rid,None)
+                if slot:
+                    slot[1]=self.codec.loads(data)
+                    slot[0].set()
+        except Exception as e:
+            if not self.closed: self.logger.debug(e)
+        self.close()
+
+    def close(self):
+        with self.__lock:
+            if self.closed: return
+            self.closed=True
+            pending,self.__pending=self.__pending,{}
+        for slot in pending.values(): slot[0].set() #wake requests in flight, they will see no response
+        try: self.sock.shutdown(socket.SHUT_RDWR) #unblock the reader
+        except Exception: pass
+        self.sock.close()
+
+class AsyncFrames:
+    '''reads and writes frames on asyncio streams, see Frames'''
+    def __init__(self,reader,writer,compress=None,compress_min=1024,level=None):
+        self.reader,self.writer=reader,writer
+        self.__lock=asyncio.Lock() #frames are written in order
+        self.__stream=COMPRESSORS[compress](level) if compress else None
+        self.compress_min=int(compress_min)
+
+    async def send(self,rid,data,flags=0):
+        async with self.__lock:
+            #compress and write without yielding, the peer must decompress frames in the order they were compressed
+            if self.__stream and len(data) >= self.compress_min:
+                t=time.thread_time()
+                raw=len(data)
+                data=self.__stream.compress(data)
+                flags|=COMPRESSED
+                STATS.add(raw,len(data),time.thread_time()-t)
+            self.writer.write(HEADER.pack(len(data),rid,flags)+data)
+            await self.writer.drain()
+
+    async def recv(self):
+        '''returns (rid,flags,payload) of the next frame or None if the peer disconnected'''
+        try: header=await self.reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial: raise ConnectionError('disconnected in frame')
+            return None
+        length,rid,flags=HEADER.unpack(header)
+        if length >= MAX_FRAME: raise ConnectionError('frame too large (%s)'%length)
+        try: data=await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError: raise ConnectionError('disconnected in frame')
+        if flags & COMPRESSED:
+            if not self.__stream: raise ConnectionError('compressed frame without compression')
+            t=time.thread_time()
+            raw=self.__stream.decompress(data)
+            STATS.add(len(raw),length,time.thread_time()-t)
+            return rid,flags&~COMPRESSED,raw
+        return rid,flags,data
+
+class AsyncConnection:
+    '''asyncio client side of a node protocol connection, see Connection
+    create with AsyncConnection.open, all methods must be called from the event loop'''
+    def __init__(self,reader,writer,timeout=None,name='Connection'):
+        self.logger=logging.getLogger(name)
+        self.reader,self.writer=reader,writer
+        self.timeout=timeout
+        self.framed=False
+        self.options={} #options the peer agreed to in the hello
+        self.codec=JSON #line mode is always JSON
+        self.closed=False
+        self.__lock=asyncio.Lock() #line mode: one request at a time
+        self.__pending={} #framed mode: rid:Future of requests in flight
+        self.__rid=0
+        self.__reader=None
+
+    @classmethod
+    async def open(cls,address,port,ssl=None,timeout=None,frame=True,codec=PREFERRED,
+            compress=None,compress_min=1024,compress_level=None,name='Connection'):
+        '''connect and negotiate framing if frame=True'''
+        reader,writer=await asyncio.wait_for(asyncio.open_connection(address,port,ssl=ssl,limit=MAX_FRAME),timeout)
+        self=cls(reader,writer,timeout,name)
+        try:
+            if frame: await asyncio.wait_for(self.__hello(codec,compress,compress_min,compress_level),timeout)
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    async def __hello(self,codec,compress,compress_min,compress_level):
+        r=await self.__line_request([{'hello':hello_request(codec,compress,compress_min)}])
+        hello=self.options=r[0].get('hello',{}) if r else {}
+        if hello.get('frame'):
+            self.framed=True
+            self.codec=get_codec(hello.get('codec'))
+            self.__frames=AsyncFrames(self.reader,self.writer,compress=negotiate_compress(hello.get('compress')),
+                compress_min=compress_min,level=compress_level)
+            self.__reader=asyncio.ensure_future(self.__read_frames())
+
+    async def __line_request(self,requests):
+        self.writer.write(JSON.dumps(requests)+b'\n')
+        await self.writer.drain()
+        return JSON.loads(await self.reader.readuntil(b'\n'))
+
+    async def request(self,requests,timeout=None):
+        '''send a list of requests and return the list of responses
+        raises an exception if the connection fails, it should then be closed'''
+        if not self.framed:
+            async with self.__lock: return await asyncio.wait_for(self.__line_request(requests),timeout or self.timeout)
+        if self.closed: raise ConnectionError('disconnected')
+        self.__rid=(self.__rid+1) % 2**32
+        rid=self.__rid
+        future=self.__pending[rid]=asyncio.get_running_loop().create_future()
+        try:
+            await self.__frames.send(rid,self.codec.dumps(requests))
+            return await asyncio.wait_for(future,timeout or self.timeout)
+        finally: self.__pending.pop(rid,None)
+
+    async def __read_frames(self):
+        try:
+            while True:
+                frame=await self.__frames.recv()
+                if frame is None: break
+                rid,flags,data=frame
+                future=self.__pending.pop(rid,None)
+                if future and not future.done(): future.set_result(self.codec.loads(data))
+        except asyncio.CancelledError: return
+        except Exception as e:
+            if not self.closed: self.logger.debug(e)
+        self.close()
+
+    def close(self):
+        if self.closed: return
+        self.closed=True
+        pending,self.__pending=self.__pending,{}
+        for future in pending.values(): #fail requests in flight
+            if not future.done(): future.set_exception(ConnectionError('disconnected'))
+        if self.__reader and self.__reader is not asyncio.current_task(): self.__reader.cancel()
+        self.writer.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import sys
+import weakref
+
+class Env(dict):
+    '''environment dict shared by all records with the same environment
+    it is read-only, as changing it would change every job that shares it, copy it with dict(env) to change it'''
+    __slots__=('__weakref__',)
+    def __readonly(self,*args,**kwargs): raise TypeError('job env is shared and read-only, copy it with dict(env)')
+    __setitem__=__delitem__=__ior__=update=pop=popitem=setdefault=clear=__readonly
+    def __reduce__(self): return (Env,(dict(self),)) #pickle sets items on the new object otherwise
+
+class JobRecord:
+    '''compact, read-only job record used for jobs held in State
+        common job keys are stored by position in a tuple, other keys go in an extra dict.
+        Node/pool/state/user/tag strings are interned and identical env dicts are shared.
+        Records are never modified, replace() returns an updated copy.
+        Records act as a read-only dict, copy() returns a plain dict of the job
+        and JSON encoders can convert them with default=dict
+    '''
+
+    #keys stored in the tuple, MISSING marks keys the job does not have
+    FIELDS=(    'node','submit_node','pool','state','active','uid','gid','args','env','tags',
+                'ts','seq','submit_ts','start_ts','end_ts','start_count','fail_count','error','rc','pid',
+                'filter','stdin','stdout','stderr','restart','retries','resubmit','runtime','hold','config' )
+    __slots__=('_v','_extra')
+
+    #string values of these keys are interned
+    INTERN=frozenset(('node','submit_node','pool','state','uid','gid'))
+
+    MISSING=object()
+    __pos=dict((k,i) for (i,k) in enumerate(FIELDS))
+    __empty=(MISSING,)*len(FIELDS)
+    __envs=weakref.WeakValueDictionary() #env items -> shared Env
+
+    def __init__(self,job={},**kwargs):
+        self._v=self.__empty
+        self._extra=None
+        self.__set(job)
+        if kwargs: self.__set(kwargs)
+
+    def __set(self,data):
+        v=None
+        for k,value in data.items():
+            i=self.__pos.get(k)
+            if i is not None:
+                if k in self.INTERN:
+                    if type(value) is str: value=sys.intern(value)
+                elif k=='env': value=self.__env(value)
+                elif k=='tags' and type(value) is list: value=[sys.intern(t) if type(t) is str else t for t in value]
+                if v is None: v=list(self._v)
+                v[i]=value
+            else:
+                if self._extra is None: self._extra={}
+                self._extra[k]=value
+        if v is not None: self._v=tuple(v)
+
+    @classmethod
+    def __env(cls,env):
+        if type(env) is Env or not isinstance(env,dict): return env
+        try: key=frozenset(env.items())
+        except TypeError: return env #unhashable values, don't share it
+        shared=cls.__envs.get(key)
+        if shared is None:
+            shared=Env(env)
+            cls.__envs[key]=shared
+        return shared
+
+    def replace(self,**data):
+        '''return a copy of this record updated with data'''
+        r=JobRecord.__new__(JobRecord)
+        r._v=self._v
+        r._extra=self._extra.copy() if self._extra else None
+        r.__set(data)
+        return r
+
+    def diff(self,old):
+        '''return a dict of the keys that changed from old, or None if old has keys this record does not'''
+        missing=self.MISSING
+        d={}
+        for k,v,o in zip(self.FIELDS,self._v,old._v):
+            if v is not o and v!=o:
+                if v is missing: return None
+                d[k]=v
+        if self._extra or old._extra:
+            extra,old_extra=self._extra or {},old._extra or {}
+            if any(k not in extra for k in old_extra): return None
+            for k,v in extra.items():
+                if k not in old_extra or (v is not old_extra[k] and v!=old_extra[k]): d[k]=v
+        return d
+
+    #read-only dict interface
+
+    def __getitem__(self,k):
+        i=self.__pos.get(k)
+        if i is not None:
+            v=self._v[i]
+            if v is self.MISSING: raise KeyError(k)
+            return v
+        if self._extra is None: raise KeyError(k)
+        return self._extra[k]
+
+    def get(self,k,default=None):
+        i=self.__pos.get(k)
+        if i is not None:
+            v=self._v[i]
+            if v is self.MISSING: return default
+            return v
+        if self._extra is None: return default
+        return self._extra.get(k,default)
+
+    def __contains__(self,k):
+        i=self.__pos.get(k)
+        if i is not None: return self._v[i] is not self.MISSING
+        return self._extra is not None and k in self._extra
+
+    def keys(self): return self.copy().keys()
+    def __iter__(self): return iter(self.copy())
+    def __len__(self): return len(self.copy())
+    def items(self): return self.copy().items()
+    def values(self): return self.copy().values()
+
+    def copy(self):
+        '''return the job as a dict'''
+        missing=self.MISSING
+        d={k:v for (k,v) in zip(self.FIELDS,self._v) if v is not missing}
+        if self._extra: d.update(self._extra)
+        return d
+
+    def __eq__(self,other):
+        if isinstance(other,JobRecord): other=other.copy()
+        return self.copy()==other
+
+    def __repr__(self): return 'JobRecord(%r)'%self.copy()
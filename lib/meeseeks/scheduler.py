@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import bisect
+import random
+import logging
+
+from .util import add_resources,fits
+
+'''PLUGIN API
+    Meeseeks.route_jobs assigns new jobs to nodes with a Scheduler, set by the scheduler config section.
+    For each pool the Scheduler makes a Queue of the new jobs, which orders them,
+    and a Placement of the pool's free slots and resources, which chooses the node for each job.
+    Jobs are placed until the queue is empty or the pool has no free slots,
+    jobs that need resources no node has free are left for the next pass.
+    To add a policy, inherit Queue or Placement and add it to a Scheduler:
+
+    from meeseeks.scheduler import Scheduler,Queue
+
+    class ShortestFirst(Queue):
+        def key(self,job): return (job.get('runtime') or 0,job['submit_ts']) #lowest key first
+
+    class MyScheduler(Scheduler):
+        QUEUES=dict(Scheduler.QUEUES,shortest=ShortestFirst)
+
+    and configure scheduler: {plugin: mymodule.MyScheduler, order: shortest}
+    Queues and Placements are made for one routing pass, so they can keep state for it.
+    A decision (Queue.pop, Placement.select) should not cost more than O(log n).
+    Jobs that need resources are placed by Placement.best on a node that fits, which is O(n).
+'''
+
+def priority_key(job):
+    '''highest priority first, then oldest first'''
+    return (-(job.get('priority') or 0),job['submit_ts'])
+
+class Queue:
+    '''new jobs of a pool, oldest first'''
+    def __init__(self,scheduler,jobs):
+        self.scheduler=scheduler
+        self.jobs=jobs #jid:job
+        self.__heap=[(self.key(job),jid) for (jid,job) in jobs.items()]
+        heapq.heapify(self.__heap)
+
+    def key(self,job): return job['submit_ts']
+
+    def __len__(self): return len(self.__heap)
+
+    def pop(self):
+        '''returns (jid,job) of the next job, which will be placed'''
+        key,jid=heapq.heappop(self.__heap)
+        return jid,self.jobs[jid]
+
+    def unplaced(self,jid,job):
+        '''the job from pop could not be placed'''
+        pass
+
+class PriorityQueue(Queue):
+    '''new jobs of a pool, highest priority first'''
+    def key(self,job): return priority_key(job)
+
+class FairShareQueue(Queue):
+    '''new jobs of a pool, from the uid with the least decayed usage (see Scheduler.usage) first,
+    each uid's jobs by priority'''
+    def __init__(self,scheduler,jobs):
+        self.scheduler=scheduler
+        self.jobs=jobs
+        self.now=time.time() #usage is decayed to the start of the pass, so equal usage ties
+        self.__jobs={} #uid:heap of (priority_key,jid)
+        for jid,job in jobs.items(): self.__jobs.setdefault(job.get('uid'),[]).append((priority_key(job),jid))
+        self.__uids=[] #heap of (usage,n,uid), n breaks ties as uids may not compare
+        for n,(uid,heap) in enumerate(self.__jobs.items()):
+            heapq.heapify(heap)
+            self.__uids.append((scheduler.usage(uid,self.now),n,uid))
+        heapq.heapify(self.__uids)
+        self.__len=len(jobs)
+
+    def __len__(self): return self.__len
+
+    def pop(self):
+        usage,n,uid=heapq.heappop(self.__uids)
+        heap=self.__jobs[uid]
+        key,jid=heapq.heappop(heap)
+        self.__len-=1
+        #the job will be placed, so charge the uid before it is considered again
+        self.scheduler.charge(uid,now=self.now)
+        if heap: heapq.heappush(self.__uids,(self.scheduler.usage(uid,self.now),n,uid))
+        return jid,self.jobs[jid]
+
+    def unplaced(self,jid,job):
+        self.scheduler.charge(job.get('uid'),-1,self.now) #it will be charged when it is placed
+
+class Placement:
+    '''free slots of a pool's nodes, chooses nodes for jobs favoring the nodes with the most free slots
+    nodes with slot limits are kept sorted by free slots, so taking a slot is a bisect instead of a sort'''
+    def __init__(self,scheduler,pool_status,node_status,resources=None):
+        self.scheduler=scheduler
+        self.pool_status=pool_status #node:free slots, or True if the node has no limit, updated as slots are taken
+        self.node_status=node_status
+        self.resources=resources or {} #node:{resource:free} of nodes with resources, updated as jobs take them
+        #nodes without resources configured do not account them, jobs that need resources no other node has free go there
+        self.unfit=set() #resource needs no node could fit, free resources only go down in a pass
+        #we need to select nodes:
+        # with open slots (slots > 0)
+        # or full (slots is < 1)
+        # or without defined slots (slots is True)
+        # or we are configured to assign jobs to full nodes
+        self.nodes=sorted(node for node,free_slots in pool_status.items() if free_slots > 0 or scheduler.wait_in_pool)
+        #(free slots,node) of nodes with free slots and a limit
+        self.ranked=sorted((free_slots,node) for node,free_slots in pool_status.items() if free_slots > 0 and free_slots is not True)
+
+    def __bool__(self):
+        '''False if no jobs can be placed'''
+        return bool(self.nodes)
+
+    def select(self,job):
+        '''returns the node to place job on'''
+        #favor the nodes with the most open slots:
+        #take a random number of nodes from the most open, and pick one of them
+        if self.ranked: return self.ranked[-random.randint(1,random.randint(1,len(self.ranked)))][1]
+        #if no nodes have open slots, pick a random node from the pool
+        return random.choice(self.nodes)
+
+    def best(self,nodes,need):
+        '''returns the node to place a job that needs resources on, from the nodes that fit it'''
+        return max(nodes,key=lambda node:self.free(node,need))
+
+    def free(self,node,need):
+        '''free counts of the resources in need on node'''
+        free=self.resources[node]
+        return tuple(free.get(k,0) for k in sorted(need))
+
+    def fit(self,need):
+        '''returns the node to place a job that needs resources on, or None if no node has them free'''
+        key=frozenset(need.items())
+        if key in self.unfit: return None
+        nodes=[node for node in self.nodes if node in self.resources and fits(need,self.resources[node])]
+        if nodes: return self.best(nodes,need)
+        #nodes with no resources configured take any job, favor the ones with the most free slots
+        nodes=[node for node in self.nodes if node not in self.resources]
+        if nodes: return max(nodes,key=lambda node:(self.pool_status[node] is True,self.pool_status[node]))
+        self.unfit.add(key)
+
+    def place(self,job):
+        '''choose a node for job and take a slot and the job's resources on it
+        returns the node, or None if the job needs resources no node has free'''
+        need=job.get('resources')
+        if need and self.resources: 
+            node=self.fit(need)
+            if node is None: return None
+            if node in self.resources: add_resources(self.resources[node],need,-1)
+        else: node=self.select(job)
+        self.take(node)
+        return node
+
+    def take(self,node):
+        slots=self.pool_status[node]
+        if slots is True: return
+        i=bisect.bisect_left(self.ranked,(slots,node))
+        if i < len(self.ranked) and self.ranked[i]==(slots,node): del self.ranked[i]
+        self.pool_status[node]=slots-1
+        if slots > 1: bisect.insort(self.ranked,(slots-1,node))
+        elif not self.scheduler.wait_in_pool: self.remove(node)
+
+    def remove(self,node):
+        '''node has no free slots'''
+        del self.nodes[bisect.bisect_left(self.nodes,node)]
+
+class LoadavgPlacement(Placement):
+    '''chooses nodes favoring the lowest load average'''
+    def __init__(self,scheduler,pool_status,node_status,resources=None):
+        Placement.__init__(self,scheduler,pool_status,node_status,resources)
+        #loadavg,node sorted low to high
+        self.loaded=sorted((node_status[node].get('loadavg'),node) for node in self.nodes \
+            if node_status.get(node,{}).get('loadavg') is not None)
+
+    def select(self,job):
+        #do we have any valid load averages?
+        if self.loaded: return self.loaded[random.randrange(random.randint(1,len(self.loaded)))][1]
+        #if we have no valid load averages, pick a random node from the pool
+        return random.choice(self.nodes)
+
+    def best(self,nodes,need):
+        return min(nodes,key=lambda node:(self.node_status.get(node,{}).get('loadavg') or 0,node))
+
+    def remove(self,node):
+        Placement.remove(self,node)
+        loadavg=self.node_status.get(node,{}).get('loadavg')
+        if loadavg is not None:
+            i=bisect.bisect_left(self.loaded,(loadavg,node))
+            if i < len(self.loaded) and self.loaded[i][1]==node: del self.loaded[i]
+
+class PackPlacement(Placement):
+    '''fills the nodes with the fewest free slots first, leaving the other nodes free'''
+    def select(self,job):
+        if self.ranked: return self.ranked[0][1]
+        return self.nodes[0]
+
+    def best(self,nodes,need):
+        return min(nodes,key=lambda node:self.free(node,need))
+
+class SpreadPlacement(Placement):
+    '''places each job on the node with the most free slots,
+    or if no node has free slots, on the node with the fewest jobs placed this pass'''
+    def __init__(self,scheduler,pool_status,node_status,resources=None):
+        Placement.__init__(self,scheduler,pool_status,node_status,resources)
+        #nodes we place on once no node has free slots: without a limit, or all nodes if jobs wait in pools
+        self.counts=dict((node,0) for node in self.nodes if scheduler.wait_in_pool or pool_status[node] is True)
+        self.placed=[(0,node) for node in self.counts] #heap of (jobs placed,node), entries are stale if the count changed
+
+    def select(self,job):
+        if self.ranked: return self.ranked[-1][1]
+        while True:
+            count,node=self.placed[0]
+            if count==self.counts[node]: return node
+            heapq.heappop(self.placed)
+
+    def take(self,node):
+        Placement.take(self,node)
+        if node in self.counts:
+            self.counts[node]+=1
+            heapq.heappush(self.placed,(self.counts[node],node))
+
+class Scheduler:
+    '''orders new jobs and places them on nodes, see Meeseeks.route_jobs'''
+    QUEUES={'fifo':Queue,'priority':PriorityQueue,'fairshare':FairShareQueue}
+    PLACEMENTS={'available':Placement,'loadavg':LoadavgPlacement,'pack':PackPlacement,'spread':SpreadPlacement}
+
+    def __init__(self,node,**cfg):
+        self.node=node
+        self.logger=logging.getLogger(node+'.Scheduler')
+        self.__usage={} #uid:(usage,ts)
+        self.config(**cfg)
+
+    def config(self,order='fifo',place=None,half_life=3600,shares=None,wait_in_pool=False,use_loadavg=False,**cfg):
+        if not place: place='loadavg' if use_loadavg else 'available'
+        if order not in self.QUEUES: raise ValueError('unknown scheduler order %s'%order)
+        if place not in self.PLACEMENTS: raise ValueError('unknown scheduler placement %s'%place)
+        self.order,self.place=order,place
+        self.half_life=float(half_life) #seconds for usage to decay by half
+        self.shares=shares or {} #uid:share, usage is divided by the share of the uid, the default share is 1
+        self.wait_in_pool=wait_in_pool #assign jobs to full nodes to wait for a slot
+
+    def queue(self,jobs):
+        '''returns the Queue of a pool's new jobs (jid:job)'''
+        return self.QUEUES[self.order](self,jobs)
+
+    def placement(self,pool_status,node_status,resources=None):
+        '''returns the Placement for a pool's free slots (node:free slots) and resources (node:{resource:free})'''
+        return self.PLACEMENTS[self.place](self,pool_status,node_status,resources)
+
+    def usage(self,uid,now=None):
+        '''jobs placed for uid, decayed by half every half_life seconds until now, divided by the share of uid'''
+        usage,ts=self.__usage.get(uid,(0,0))
+        if usage: usage*=0.5**(((now or time.time())-ts)/self.half_life)
+        return usage/self.shares.get(str(uid),1)
+
+    def charge(self,uid,jobs=1,now=None):
+        '''add jobs placed for uid to its usage'''
+        usage,ts=self.__usage.get(uid,(0,0))
+        now=max(now or time.time(),ts) #usage is not decayed backwards
+        if usage: usage*=0.5**((now-ts)/self.half_life)
+        self.__usage[uid]=(usage+jobs,now)
+
+    def stats(self):
+        '''decayed usage by uid, for our node status'''
+        return dict((str(uid),self.usage(uid)) for uid in list(self.__usage))
@@ -4,42 +4,92 @@ import time
 import logging
 import threading
 import uuid
-import random
 import json
+import base64
 import socket
 import socketserver
 
 from .state import State
 from .node import Node
+from .manager import NodeManager,AsyncNode
+from .listener import AsyncListener
 from .pool import Pool
+from .scheduler import Scheduler
+from .protocol import Frames,STATS,MAX_WAIT,hello_response
+from .codec import JSON,get_codec
+from .delta import Delta
 from .util import *
 from .config import Config
 
 class RequestHandler(socketserver.StreamRequestHandler):
-    '''control socket request handler'''
+    '''control socket request handler, see the protocol module'''
     def handle(self):
         self.logger=logging.getLogger(str(self.client_address))
         self.logger.debug('connected')
+        self.peer={} #connection state for the request handler
         while not self.server.handler.shutdown.is_set(): #client will be disconnected at shutdown
             l=self.rfile.readline() #get line from client
             if not l.strip(): break #will be None if client disconnected
-            responses=[]
+            framed=False
             try:
-                requests=json.loads(l) #apply initial config
-                if requests:
-                    for request in requests:
-                        response=self.server.handler.handle(request)
-                        responses.append(response)
-            except Exception as e: responses.append({'error':str(e)})
-            self.wfile.write(json.dumps(responses).encode())
+                requests=JSON.loads(l) #apply initial config
+                #the client will wait for the hello response before sending frames
+                if requests and 'hello' in requests[0]:
+                    hello=self.hello(requests[0]['hello'])
+                    framed=hello.get('frame')
+                    responses=[{'hello':hello}]
+                else: responses=self.process(requests)
+            except Exception as e: responses=[{'error':str(e)}]
+            self.wfile.write(JSON.dumps(responses))
             self.wfile.write('\n'.encode())
             self.wfile.flush() #flush
+            if framed: 
+                self.handle_frames()
+                break
         self.logger.debug('disconnected')
 
+    def hello(self,hello):
+        '''negotiate connection options, returns the options we will use'''
+        state=getattr(self.server.handler,'state',None)
+        r=hello_response(hello,state and state.epoch)
+        self.codec=get_codec(r.get('codec'))
+        self.compress,self.compress_min=r.get('compress'),hello.get('compress_min',1024)
+        return r
+
+    def process(self,requests):
+        responses=[]
+        try:
+            if requests:
+                for request in requests:
+                    response=self.server.handler.handle(request,self.peer)
+                    responses.append(response)
+        except Exception as e: responses.append({'error':str(e)})
+        return responses
+
+    def handle_frames(self):
+        self.logger.debug('framed')
+        frames=Frames(self.request,compress=self.compress,compress_min=self.compress_min)
+        #at most max_inflight requests of the connection run at once, we stop reading from it until one finishes
+        slots=threading.BoundedSemaphore(self.server.max_inflight)
+        while not self.server.handler.shutdown.is_set():
+            frame=frames.recv()
+            if frame is None: break
+            #each request gets a thread so requests that block do not hold up the rest
+            slots.acquire()
+            threading.Thread(target=self.handle_frame,args=(frames,slots,*frame),daemon=True).start()
+
+    def handle_frame(self,frames,slots,rid,flags,data):
+        try: data=self.codec.dumps(self.process(self.codec.loads(data)))
+        except Exception as e: data=self.codec.dumps([{'error':str(e)}])
+        finally: slots.release()
+        try: frames.send(rid,data)
+        except Exception as e: self.logger.debug(e) #client went away
+
 class RequestListener (socketserver.ThreadingMixIn, socketserver.TCPServer):
     '''control socket'''
     allow_reuse_address=True
     ssl_context=None
+    max_inflight=8 #requests per framed connection running at once, long-polls included
     def get_request(self):
         newsocket, fromaddr = self.socket.accept()
         if self.ssl_context:
@@ -54,6 +104,9 @@ class Meeseeks:
         self.state=self.listener=None
         self.pools={}
         self.nodes={}
+        self.node_manager=None #event loop for AsyncNodes
+        self.scheduler=None #orders and places new jobs, see route_jobs
+        self.routed=None #stats of the last route_jobs pass that had jobs
         self.shutdown=threading.Event()
         self.restart=threading.Event()        
         #get our nodename
@@ -88,8 +141,24 @@ class Meeseeks:
                 self.pools[p]=pool_class(self.name,p,self.state,**pcfg)
             else: self.pools[p].config(**pcfg)
 
+        #init scheduler, load plugin if specified
+        scfg={'wait_in_pool':self.cfg.get('wait_in_pool'),'use_loadavg':self.cfg.get('use_loadavg'),**self.cfg.get('scheduler',{})}
+        try:
+            if 'plugin' in scfg:
+                scheduler_class=import_plugin(scfg['plugin'])
+                del scfg['plugin']
+            else: scheduler_class=Scheduler
+            if type(self.scheduler) is not scheduler_class: self.scheduler=scheduler_class(self.name,**scfg)
+            else: self.scheduler.config(**scfg)
+        except Exception as e: 
+            #a bad plugin or option should not stop us, keep the scheduler we have or use the default
+            self.logger.error('scheduler config: %s',e,exc_info=True)
+            if not self.scheduler: self.scheduler=Scheduler(self.name)
+
         #stop/init nodes
         nodes=self.cfg.get('nodes',{})
+        mcfg=self.cfg.get('node_manager',{})
+        if self.node_manager: self.node_manager.config(**mcfg)
         for n in self.nodes.copy(): 
             if n!=self.name and n not in nodes: self.stop_node(n)
         for n in nodes.keys():
@@ -97,8 +166,14 @@ class Meeseeks:
             ncfg={**self.defaults, **nodes[n]}
             if n not in self.nodes:
                 self.logger.info('adding node %s',n)
-                self.nodes[n]=Node(self.name,n,self.state,**ncfg)
+                #sync all nodes from one event loop, or with a thread per node
+                if mcfg.get('async',True):
+                    if not self.node_manager: self.node_manager=NodeManager(self.name+'.NodeManager',**mcfg)
+                    self.nodes[n]=AsyncNode(self.name,n,self.state,self.node_manager,**ncfg)
+                else: self.nodes[n]=Node(self.name,n,self.state,**ncfg)
             else: self.nodes[n].config(**ncfg)
+        #jobs are synced to the nodes that route to their node
+        self.state.update_peers(list(self.nodes))
 
     #stop and remove pool
     def stop_pool(self,p):
@@ -123,35 +198,63 @@ class Meeseeks:
                 return float(fh.readline().split()[0])
         except: return 0.0 #only works on linux... ignore it.
 
-    def biased_random(self,l,reverse=False):
-        #this is probably a stupid way to pick a random item while favoring the first of the sorted items 
-        #first we pick a range between the first item and a randomly selected item
-        #them we pick a random item from that range
-        if l: 
-            l=sorted(l,reverse=reverse)
-            if len(l) > 1: return random.choice( l[ 0:random.randint(1,len(l)) ] )
-            else: return l[0] #only one item...
-
-    def select_by_loadavg(self,node_status,nodes):
-        #loadvg,node sorted low to high
-        loadavg_nodes=[ (node_status[node].get('loadavg'), node) for node in nodes \
-            if node_status[node].get('loadavg') is not None ] 
-        #do we have any valid load averages?
-        if loadavg_nodes: return self.biased_random(loadavg_nodes)[1]
-        #if we have no valid load averages, pick a random node from the pool
-        else: return random.choice( nodes )
-    
-    def select_by_available(self,pool_status,nodes):
-        #get nodes in this pool sorted from most to least open slots
-        #exclude nodes in pool with no free or unlimited slots unless we have no free slots
-        nodes_slots=[ (pool_status[node], node) for node in nodes if \
-            (pool_status[node]>0 and pool_status[node] is not True) ]
-        #do we have any nodes with pool slots?
-        if nodes_slots: 
-            s,node=self.biased_random(nodes_slots,reverse=True)
-            return node
-        #if not, pick a random node from the pool
-        else: return random.choice( nodes )
+    def route_jobs(self):
+        '''assign new jobs that need routing to nodes in one pass
+        for each pool the scheduler orders the jobs and places them on nodes,
+        free slots are counted down from one snapshot of the pools as jobs are assigned,
+        the assignments are committed with one state update. returns the number of jobs routed'''
+        t=time.time()
+        #get cluster state
+        node_status=self.state.get_nodes()
+        pools=self.state.get_pools()
+        resources=self.state.get_resources()
+        #get new jobs assigned to us but to a pool we don't have
+        #these need to be assigned to a node that can service them
+        jobs=dict( (jid,job) for (jid,job) in \
+            self.state.get(state='new',node=self.name,records=True).items() \
+            if job['pool'] not in self.pools.keys() )
+        #add new jobs without node assigned, these were just submitted and need routing
+        jobs.update(self.state.get(state='new',node=False,records=True))
+        if not jobs: return 0
+
+        updates={}
+        wait_in_pool=self.cfg.get('wait_in_pool')
+        pool_jobs={} #pool:{jid:job} of the jobs we can route
+        for jid,job in jobs.items():
+            #if no submit node, it must have been submitted to us
+            if not job.get('submit_node'): updates[jid]={'submit_node':self.name}
+            #if job in hold, we can't route this job yet unless we are configured to assign to full
+            if job.get('hold') and not wait_in_pool: continue
+            pool_jobs.setdefault(job['pool'],{})[jid]=job
+        routed=0
+        wait=0 #longest a routed job waited since submit
+        for pool,pjobs in pool_jobs.items():
+            try:
+                queue=self.scheduler.queue(pjobs)
+                placement=self.scheduler.placement(pools.get(pool,{}),node_status,resources.get(pool))
+                #place jobs until we run out of jobs or nodes to place them on
+                while queue and placement:
+                    jid,job=queue.pop()
+                    node=placement.place(job)
+                    if node is None: #needs resources no node has free
+                        queue.unplaced(jid,job)
+                        continue
+                    self.logger.debug('assign %s to %s@%s',jid,pool,node)
+                    updates.setdefault(jid,{})['node']=node
+                    routed+=1
+                    wait=max(wait,t-job['submit_ts'])
+            except Exception as e: self.logger.warning(e,exc_info=True)
+        #jobs we can't route yet are assigned to us for now
+        for jid,job in jobs.items():
+            if not job['node'] and 'node' not in updates.get(jid,{}): updates.setdefault(jid,{})['node']=self.name
+
+        #assign the jobs
+        self.state.update_jobs(updates)
+        elapsed=time.time()-t
+        if routed:
+            self.logger.info('routed %s of %s jobs in %.3fs',routed,len(jobs),elapsed)
+            self.routed={'jobs':routed,'pending':len(jobs)-routed,'seconds':elapsed,'rate':routed/max(elapsed,1e-6),'wait':wait,'ts':t}
+        return routed
 
     def run(self):
         while not self.shutdown.is_set():  #existence is pain!
@@ -172,7 +275,11 @@ class Meeseeks:
                         addrs=(t[4][0] for t in socket.getaddrinfo(socket.gethostname(),port))
                         for addr in addrs:
                             if addr.startswith(prefix): address=addr
-                self.listener=RequestListener((address,port),RequestHandler)
+                #serve all connections from one event loop, or with a thread per connection
+                if lcfg.get('async',True): self.listener=AsyncListener((address,port),**lcfg)
+                else: 
+                    self.listener=RequestListener((address,port),RequestHandler)
+                    if 'max_inflight' in lcfg: self.listener.max_inflight=int(lcfg['max_inflight'])
                 if 'ssl' in lcfg: self.listener.ssl_context=create_ssl_context(lcfg['ssl'])
                 self.listener.handler=self
                 self.listener.server_thread=threading.Thread(target=self.listener.serve_forever)
@@ -181,15 +288,26 @@ class Meeseeks:
                 self.logger.info('listening on %s:%s',*self.listener.server_address)
 
             self.restart.clear() #startup finished, clear event
+
+            #wake the scheduler when new jobs are submitted or assigned to us
+            changed=self.state.subscribe(node=frozenset((self.name,None,False)),state='new')
             
             while not self.shutdown.is_set() and not self.restart.is_set():
-                #update our node status
-                #we can route to nodes we see via our connected nodes
+                #update our node status, State maintains our routing
+                status={}
+                if self.state.history: status.update(history=self.state.history.stats())
+                compression=STATS.get() #compression totals of our connections
+                if compression: status.update(compression=compression)
+                if self.routed: status.update(routed=self.routed)
+                usage=self.scheduler.stats() #fair share usage by uid
+                if usage: status.update(usage=usage)
+                #sync rate and backlog of the nodes we connect to
+                status.update(peers=dict((n,node.stats()) for (n,node) in list(self.nodes.items())))
                 self.state.update_node( self.name,
                     online=True,
                     ts=time.time(),
                     loadavg=self.get_loadavg(),
-                    routing=list(self.state.get_nodes().keys())) 
+                    **status) 
 
                 #scheduling logic
                 try:
@@ -203,58 +321,21 @@ class Meeseeks:
                             #return current config in args
                             self.state.update_job(jid,args=self.cfg.copy(),state='done')
 
-                    #get cluster state
-                    node_status=self.state.get_nodes()
-                    #get new jobs assigned to us but to a pool we don't have
-                    #these need to be assigned to a node that can service them
-                    jobs=dict( (jid,job) for (jid,job) in \
-                        self.state.get(state='new',node=self.name).items() \
-                        if job['pool'] not in self.pools.keys() )
-                    #add new jobs without node assigned, these were just submitted and need routing
-                    jobs.update(self.state.get(state='new',node=False))
-                    
-                    #process jobs by oldest to newest submitted
-                    for jid,job in sorted(jobs.items(),key=lambda j:j[1]['submit_ts']):
-                        try:
-                            #if no submit node, it must have been submitted to us
-                            if not job.get('submit_node'): self.state.update_job(jid,submit_node=self.name)
-                            pool=job['pool']
-                            pool_status=self.state.get_pools().get(pool,{})
-                            #we need to select nodes:
-                            # with open slots (slots > 0)
-                            # or full (slots is < 1) 
-                            # or without defined slots (slots is True)
-                            # or we are configured to assign jobs to full nodes
-                            nodes=[node for node,free_slots in pool_status.items() if \
-                                free_slots > 0 or self.cfg.get('wait_in_pool')]
-
-                            #if no nodes or job in hold, we can't route this job yet
-                            #unless we are confirured to assign to full
-                            if not nodes or (job.get('hold') and not self.cfg.get('wait_in_pool')):
-                                #assign to us for now
-                                if not job['node']: self.state.update_job(jid,node=self.name) 
-                                continue 
-
-                            #select a node for the job
-                            if self.cfg.get('use_loadavg'): node=self.select_by_loadavg(node_status,nodes)
-                            else: node=self.select_by_available(pool_status,nodes)
-
-                            #assign the job
-                            self.logger.info('assign %s to %s@%s',jid,pool,node)
-                            self.state.update_job(jid,node=node)
-                            
-                        except Exception as e: self.logger.warning(e,exc_info=True)
-                    
-                    time.sleep(1)
+                    #assign new jobs to nodes
+                    self.route_jobs()
+
+                    changed.wait(1)
 
                 except Exception as e: 
                     self.logger.error(e,exc_info=True)
                     self.shutdown.set()
+            self.state.unsubscribe(changed)
 
         self.logger.info('shutting down')
         #will stop all pools/nodes
         self.cfg.update(pools={},nodes={})
         self.apply_config() 
+        if self.node_manager: self.node_manager.stop()
 
         #stop state manager
         self.state.shutdown.set()
@@ -265,35 +346,104 @@ class Meeseeks:
         self.listener.shutdown()
         self.listener.server_thread.join()
 
+    def get_output(self,id=None,stream='stdout',hash=None,node=None,offset=0,length=None):
+        '''return {hash,size,offset,data} of job id's output, or of output hash on node.
+        data is base64 encoded and at most the spool's chunk size, request more from offset+len(data).
+        if the output is on another node the request is relayed towards it'''
+        if id:
+            job=self.state.get_job(id)
+            ref=job and job.get(stream+'_ref')
+            if not ref: return False
+            hash,node=ref['hash'],ref['node']
+        if node==self.name:
+            if not self.state.spool: return False
+            size,data=self.state.spool.read(hash,offset,length)
+            return {'hash':hash,'size':size,'offset':offset,'data':base64.b64encode(data).decode()}
+        #relay to the connected node the output node is routed through
+        version,routes=self.state.get_routes()
+        for n in routes.get(node,()):
+            remote=self.nodes.get(n)
+            if remote:
+                r=remote.request([{'output':{'hash':hash,'node':node,'offset':offset,'length':length}}])
+                if r: return r[0].get('output',False)
+        return False
+
+    def get_nodes(self,query,peer):
+        '''node status for a nodes request
+        if the peer asked for digests, routing is only sent if it changed since it was last sent on this connection'''
+        nodes=self.state.get_nodes()
+        if not query.get('digest'): return nodes
+        sent=peer.setdefault('routing',{}) #node:routing digest the peer has
+        for node in query.get('resend',[]): sent.pop(node,None)
+        for node,status in nodes.items():
+            digest=status.get('routing_digest')
+            if digest and sent.get(node)==digest:
+                nodes[node]=dict((k,v) for (k,v) in status.items() if k != 'routing')
+            else: sent[node]=digest
+        return nodes
+
     #handle incoming request
-    def handle(self,request):
+    #peer is a dict kept for the connection the request came in on
+    def handle(self,request,peer=None):
         response={}
+        if peer is None: peer={}
+        #the Delta of what the peer has, if it has asked for deltas
+        delta=peer.get('delta')
         #we're being pushed state from upstream node and should return ours
         if 'sync' in request:
-            #sync incoming state, return updated job ids
-            response['sync']=self.state.sync(request['sync'])
+            #sync incoming state, return updated job ids and the jobs we need in full
+            missing=[]
+            response['sync']=self.state.sync(request['sync'],missing=missing)
+            if missing: response['resend']=missing
+            if delta is not None and response['sync']: delta.received(self.state.get(ids=response['sync'],records=True))
         #return our state
         if 'get' in request:
-            response['get']=self.state.get(**request['get'])
+            query=dict(request['get'])
+            wait=query.pop('wait',None)
+            if wait: 
+                #long-poll, hold the request until there are changes after seq
+                #return the seq the peer has seen up to, as the changes may all be filtered out
+                response['seq']=self.state.wait_changes(query.get('seq',0),min(float(wait),MAX_WAIT))
+            if query.pop('delta',None):
+                #send only changes to jobs the peer has, and resend the jobs it asked for in full
+                if delta is None: delta=peer['delta']=Delta()
+                resend=query.pop('resend',[])
+                delta.forget(resend)
+                jobs=self.state.get(records=True,**query)
+                if resend: jobs.update(self.state.get(ids=resend,records=True))
+                response['get']=delta.encode(jobs)
+            else: response['get']=self.state.get(**query)
         #submit or modify a job
         if 'submit' in request: 
-            response['submit']=self.state.submit_job(**request['submit'])
+            #a list of specs is submitted under one lock
+            if type(request['submit']) is list: response['submit']=self.state.submit_jobs(request['submit'])
+            else: response['submit']=self.state.submit_job(**request['submit'])
         #get job by id
         if 'job' in request:
             response['job']=self.state.get_job(request['job'])
         #modify job - this bypasses all checks, use submit with id=existing if possible
         if 'modify' in request:
-            for jid,data in request['modify'].items():
-                response.setdefault('modify',{})[jid]=self.state.update_job(jid,**data)
+            mods=request['modify']
+            if type(mods) is list: #[{query:{...},data:{...}},...], the jobs matching each query are modified under one lock
+                response['modify']={}
+                for mod in mods: response['modify'].update(self.state.modify_jobs(mod.get('data',{}),**mod.get('query',{})))
+            else: #{jid:data,...} is applied under one lock
+                updated=self.state.update_jobs(mods)
+                jobs=self.state.get(ids=updated) if updated else {} #no ids gets all jobs
+                response['modify']=dict((jid,jobs.get(jid,False)) for jid in mods)
         #kill job
         if 'kill' in request:
             response['kill']=self.state.kill_jobs(request['kill'])
+        #get job output from the spool of the node that ran it
+        if 'output' in request:
+            response['output']=self.get_output(**request['output'])
         # List all jobs
         if 'ls' in request:
             response['ls']=self.state.list_jobs(**request['ls'])
         #return the status of us and downstream nodes
-        if 'nodes' in request: response['nodes']=self.state.get_nodes()  
+        if 'nodes' in request: response['nodes']=self.get_nodes(request['nodes'] or {},peer)
         if 'pools' in request: response['pools']=self.state.get_pools()  
+        if 'resources' in request: response['resources']=self.state.get_resources()
         #get/set config
         if 'config' in request:
             cfg=request['config']
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import tempfile
+import hashlib
+
+class Spool:
+    '''node-local content-addressed store for job output
+        Tasks write output to a temp file in the spool, add() moves it to <path>/<hash[:2]>/<hash>
+        so the job only carries a reference to it. Identical output is stored once.
+        Output is fetched with read(), see the 'output' request.
+        config is:
+            path: <dir> spool directory
+            max_size: <bytes> if set, output is truncated to this size
+            quota: <bytes> if set, the least recently added output is removed when the spool is larger than this
+            expire: 86400 seconds output is kept after it was last added
+            chunk: 1048576 max bytes returned by one read
+    '''
+
+    def __init__(self,path,max_size=None,quota=None,expire=86400,chunk=2**20,name='Spool'):
+        self.logger=logging.getLogger(name)
+        self.path=path
+        self.max_size=int(max_size) if max_size else None
+        self.quota=int(quota) if quota else None
+        self.expire=int(expire)
+        self.chunk=int(chunk)
+        self.__tmp=os.path.join(self.path,'tmp')
+        os.makedirs(self.__tmp,exist_ok=True)
+
+    def create(self):
+        '''return a new temp file for a task to write output to'''
+        return tempfile.NamedTemporaryFile(dir=self.__tmp,prefix='out.',delete=False)
+
+    def add(self,tmp):
+        '''move the temp file into the spool, returns {hash,size[,truncated]} or None if it was empty'''
+        size=os.path.getsize(tmp)
+        if not size:
+            os.remove(tmp)
+            return None
+        ref={}
+        if self.max_size and size > self.max_size:
+            os.truncate(tmp,self.max_size)
+            ref['truncated']=size
+            size=self.max_size
+        h=hashlib.sha256()
+        with open(tmp,'rb') as fh:
+            for data in iter(lambda:fh.read(2**20),b''): h.update(data)
+        ref.update(hash=h.hexdigest(),size=size)
+        path=self.__path(ref['hash'])
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        os.replace(tmp,path) #same content, so replacing an existing blob is harmless and resets its mtime
+        return ref
+
+    def __path(self,h):
+        if len(h)!=64 or h.strip('0123456789abcdef'): raise ValueError('invalid output hash %s'%h)
+        return os.path.join(self.path,h[:2],h)
+
+    def read(self,h,offset=0,length=None):
+        '''return (size,data) of up to length bytes (at most chunk) of output h from offset'''
+        length=min(int(length),self.chunk) if length else self.chunk
+        with open(self.__path(h),'rb') as fh:
+            size=os.fstat(fh.fileno()).st_size
+            fh.seek(int(offset))
+            return size,fh.read(length)
+
+    def clean(self):
+        '''remove expired output, then the oldest output if over quota'''
+        now=time.time()
+        blobs=[]
+        for d in os.scandir(self.path):
+            if d.name=='tmp' or not d.is_dir(): continue
+            for f in os.scandir(d.path):
+                try:
+                    st=f.stat()
+                    if now-st.st_mtime > self.expire: os.remove(f.path)
+                    else: blobs.append((st.st_mtime,st.st_size,f.path))
+                except FileNotFoundError: pass
+        if self.quota:
+            total=sum(size for (mtime,size,path) in blobs)
+            for mtime,size,path in sorted(blobs):
+                if total <= self.quota: break
+                self.logger.debug('spool over quota, removing %s',path)
+                try: os.remove(path)
+                except FileNotFoundError: pass
+                total-=size
+        #remove temp files that have not been written to, their task has gone away
+        for f in os.scandir(self.__tmp):
+            try:
+                if now-f.stat().st_mtime > self.expire: os.remove(f.path)
+            except FileNotFoundError: pass
@@ -5,7 +5,53 @@ import time
 import threading
 import logging
 import uuid
-import json
+import collections
+import heapq
+import hashlib
+
+from .index import Index
+from .history import History
+from .spool import Spool
+from .wal import WAL
+from .codec import get_codec,loads_any
+from .record import JobRecord
+from .array import Array
+from .util import RWLock,get_resources,add_resources
+
+class Subscription:
+    '''subscription to job changes in State, see State.subscribe'''
+    def __init__(self,ids=None,event=None,**match):
+        if ids and type(ids) is not list: ids=[ids]
+        self.ids=set(ids) if ids else None
+        self.match=match
+        self.event=event or threading.Event() #set on a matching change
+
+    def keys(self):
+        '''keys this subscription is registered under in State'''
+        if self.ids: return [('id',jid) for jid in self.ids]
+        for k,v in self.match.items():
+            if k in Index.FIELDS: 
+                if isinstance(v,(set,frozenset)): return [(k,i) for i in v]
+                try: 
+                    hash(v)
+                    return [(k,v)]
+                except TypeError: pass
+        return [None]
+
+    def matches(self,jid,job):
+        if job is None or (self.ids is not None and jid not in self.ids): return False
+        for k,v in self.match.items():
+            if isinstance(v,(set,frozenset)): 
+                if job.get(k) not in v: return False
+            elif job.get(k)!=v: return False
+        return True
+
+    def wait(self,timeout=None):
+        '''wait for a matching change, returns True if there was one
+        a change made before wait returns will still be seen by a query made after it'''
+        r=self.event.wait(timeout)
+        self.event.clear()
+        return r
 
 class State(threading.Thread):
     '''cluster state interface
@@ -26,6 +72,9 @@ class State(threading.Thread):
             resubmit: if true, when job is restarted/retried, send back to the submit_node vs. restarting locally 
             runtime: job maximum runtime in seconds. job will be killed and marked as failed if exceeded.
             hold: if true, job will not run until cleared
+            priority: higher priority jobs are routed and started first, see the scheduler module
+            resources: {resource:count} the job uses while active, such as {cpus:16,mem_mb:64000}, see update_pool
+            array: first-last:step makes an array job, which runs a task for each index, see the array module
             config: job task configuration dict. for Task spawned by Pool, sets popen args.
             tags: list of tags, can be matched in query with tag=
 
@@ -37,8 +86,10 @@ class State(threading.Thread):
                     To move a job: kill the job, wait for active=False, then reassign and set state='new'.
             rc: exit code if job done/failed
             error: error details if job did not spawn or exit
-            stdout: base64 encoded stdout after exit if not redirected to a file
-            stdout: base64 encoded stderr after exit if not redirected to a file
+            stdout_ref: {node,hash,size} of stdout in the node's spool if not redirected to a file
+            stderr_ref: {node,hash,size} of stderr in the node's spool if not redirected to a file
+            stdout_data: base64 encoded stdout after exit if not redirected and the node has no spool
+            stderr_data: base64 encoded stderr after exit if not redirected and the node has no spool
             ts: update timestamp
             seq: sync sequence number. Jobs with the highest seq are most recently updated on this node.
             submit_ts: submit timestamp
@@ -46,6 +97,8 @@ class State(threading.Thread):
             end_ts: job end timestamp
             start_count: count of time job has started
             fail_count: count of times job has failed
+            array_runs: for array jobs, the index states as runs of [first,last,state]
+            array_counts: for array jobs, state:count of the indices
     '''
 
     #only allow these keys to prevent shenanigans
@@ -67,6 +120,9 @@ class State(threading.Thread):
                 'resubmit',
                 'runtime',
                 'hold',
+                'priority',
+                'resources',
+                'array',
                 'config',
                 'tags'
             ]
@@ -81,53 +137,179 @@ class State(threading.Thread):
         threading.Thread.__init__(self,daemon=True,name=name,target=self.__state_run)
         self.logger=logging.getLogger(self.name)
         self.shutdown=threading.Event()
-        self.__lock=threading.Lock() #lock on __jobs dict
+        self.__lock=RWLock() #lock on __jobs dict, queries take the shared read lock
         self.__jobs={} #(partial) cluster job state, this is private because we lock during any changes
-        self.__status={} #map of node:{online:bool, routing:[nodes seen], pools:{pool:slots} }
+        self.__index=Index(inactive=self.JOB_INACTIVE) #secondary indexes and active job counts on __jobs
+        self.__changes=collections.OrderedDict() #jid:seq ordered by seq, for getting jobs changed since a seq
+        self.__expiry=[] #heap of (ts,jid), entries are stale if the job ts has changed
+        self.__restarts=set() #jids of jobs that need to be restarted or resubmitted
+        self.__subs={} #key:set of Subscriptions, see Subscription.keys
+        self.__status={} #map of node:{online:bool, routing:[nodes seen], routing_digest:str, pools:{pool:slots}, resources:{pool:{resource:count}} }
+        self.__peers=() #nodes we connect to directly
+        self.__routes={} #node:(peers it is routed through), recomputed when the topology changes
+        self.__routing_version=0 #incremented when __routes changes
         self.__seq=1 #update sequence number. Always increments.
-        self.hist_fh=None
+        #seqs are only meaningful to peers for the life of this process (changes after the last save are lost),
+        #peers that see a new epoch must resync everything
+        self.epoch=str(uuid.uuid4())
+        self.history=None #history writer thread
+        self.spool=None #job output store
         self.__hist_seq=0 #history sequence number.
         self.state_file=None
+        self.codec=get_codec() #state file codec
         self.checkpoint=None
+        self.wal_file=None
+        self.fsync=False
+        self.__wal=None #write-ahead log, opened when state is loaded
+        self.check_index=False
         self.config(**cfg)
         self.__load_state()
         self.start()
 
-    def config(self,expire=300,expire_active_jobs=True,timeout=60,history=None,file=None,checkpoint=None,**cfg):
+    def config(self,expire=300,expire_active_jobs=True,timeout=60,history=None,spool=None,file=None,codec=None,checkpoint=None,wal=None,fsync=None,check=None,**cfg):
         with self.__lock:
+            if check is not None: self.check_index=check
             if expire: self.expire=int(expire)
             if timeout: self.timeout=int(timeout)
             self.expire_active_jobs=expire_active_jobs
             if file: self.state_file=file
+            if codec: self.codec=get_codec(codec)
             if checkpoint is not None: self.checkpoint=checkpoint
+            #the log is opened at startup, so changes to these will only apply after a restart
+            if wal is True and self.state_file: self.wal_file=self.state_file+'.wal'
+            elif wal: self.wal_file=wal
+            if self.wal_file and not self.state_file:
+                #the log is only truncated once a snapshot is saved, without a file it would grow forever
+                self.logger.warning('wal %s needs a state file, not logging',self.wal_file)
+                self.wal_file=None
+            if self.wal_file and not self.checkpoint:
+                self.logger.info('wal %s without checkpoint, checkpointing every 60s',self.wal_file)
+                self.checkpoint=60
+            if fsync is not None: self.fsync=fsync
             if history:
-                try: self.hist_fh=open(history,'a')
-                except Exception as e: self.logger.warning('%s:%s',history,e)
-            elif self.hist_fh: 
-                self.hist_fh.close()
-                self.hist_fh=None
+                if type(history) is not dict: history={'file':history}
+                if self.history: self.history.config(**history)
+                else: self.history=History(self.name+'.History',**history)
+            elif self.history: 
+                self.history.close()
+                self.history=None
+            if spool:
+                if type(spool) is not dict: spool={'path':spool}
+                self.spool=Spool(name=self.name+'.Spool',**spool)
+            else: self.spool=None
 
     def write_history(self,jid):
-        if self.hist_fh:
-            json.dump({jid:self.__jobs[jid]},self.hist_fh)
-            self.hist_fh.write('\n')
-            self.hist_fh.flush()
+        '''queue job jid for the history writer'''
+        #job records are replaced, not modified, on update so the writer can have the job without a copy
+        if self.history: self.history.put(jid,self.__jobs[jid])
+
+    def __snapshot(self): #call with lock held
+        '''return a view of the jobs to save and start a new log'''
+        #job records are replaced on update, so a shallow copy of __jobs will not change under us
+        jobs=self.__jobs.copy()
+        if self.__wal and self.state_file: #the rotated log is removed once the snapshot is saved
+            try: self.__wal.rotate()
+            except Exception as e: self.logger.warning('%s:%s',self.wal_file,e)
+        return jobs
 
-    def __save_state(self):
+    def __save_state(self,jobs): #call without lock held
         if self.state_file:
             try:
-                with open(self.state_file,'w') as fh: 
-                    json.dump(self.__jobs,fh)
-                    self.logger.info('saved state to %s',self.state_file)
+                #write to a temp file and rename so a crash can't leave a partial state file
+                tmp=self.state_file+'.tmp'
+                with open(tmp,'wb') as fh: 
+                    fh.write(self.codec.dumps(jobs))
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.replace(tmp,self.state_file)
+                self.logger.info('saved state to %s',self.state_file)
+                if self.__wal: self.__wal.truncate() #records are in the snapshot now
             except Exception as e: self.logger.warning('%s:%s',self.state_file,e)
 
     def __load_state(self):
         if self.state_file:
             try:
-                with open(self.state_file) as fh: 
-                    self.__jobs=json.load(fh)
+                #the file may have been saved with a different codec
+                with open(self.state_file,'rb') as fh: 
+                    self.__jobs=loads_any(fh.read(),self.codec)
                     self.logger.info('loaded state from %s',self.state_file)
             except Exception as e: self.logger.warning('%s:%s',self.state_file,e)
+        if self.wal_file:
+            #apply changes made since the snapshot
+            count,seq=WAL.replay(self.wal_file,self.__jobs,self.logger)
+            self.__seq=max(self.__seq,seq+1)
+            if count: self.logger.info('replayed %s changes from %s',count,self.wal_file)
+            try: self.__wal=WAL(self.wal_file,self.fsync,name=self.name+'.WAL')
+            except Exception as e: self.logger.warning('%s:%s',self.wal_file,e)
+        self.__jobs=dict( (jid,JobRecord(job)) for (jid,job) in self.__jobs.items() )
+        self.__rebuild()
+
+    def __commit(self): #call with lock held
+        '''write logged changes'''
+        if self.__wal:
+            try: self.__wal.commit()
+            except Exception as e: self.logger.warning('%s:%s',self.wal_file,e)
+
+    def __rebuild(self):
+        '''rebuild indexes, change order, expiry heap and restarts from __jobs'''
+        self.__index=Index(self.__jobs,self.JOB_INACTIVE)
+        #rebuild change order and continue the sequence from the jobs
+        self.__changes=collections.OrderedDict( (jid,job['seq']) for (jid,job) in \
+            sorted(self.__jobs.items(),key=lambda j:j[1]['seq']) )
+        if self.__jobs: self.__seq=max(self.__seq,max(self.__changes.values())+1)
+        self.__expiry=[(job['ts'],jid) for (jid,job) in self.__jobs.items()]
+        heapq.heapify(self.__expiry)
+        self.__restarts=set(jid for (jid,job) in self.__jobs.items() if self.__restartable(job))
+
+    def subscribe(self,ids=None,event=None,**match):
+        '''return a Subscription that is woken when a job in ids or matching key=value in match changes
+        a set of values matches any of the values
+        jobs are matched before and after the change, so jobs leaving a node/pool also wake the subscriber
+        subscriptions can share an Event by passing event=
+        call Subscription.wait(timeout) to wait for changes'''
+        sub=Subscription(ids,event,**match)
+        with self.__lock:
+            for key in sub.keys(): self.__subs.setdefault(key,set()).add(sub)
+        return sub
+    def unsubscribe(self,sub):
+        with self.__lock:
+            for key in sub.keys():
+                subs=self.__subs.get(key)
+                if subs is None: continue
+                subs.discard(sub)
+                if not subs: del self.__subs[key]
+    def __notify(self,jid,old,new): #nolock for internal use
+        if not self.__subs: return
+        keys=[None,('id',jid)]
+        for job in (old,new):
+            if job is not None: keys.extend((k,job.get(k)) for k in Index.FIELDS)
+        woken=set()
+        for key in keys:
+            try: subs=self.__subs.get(key)
+            except TypeError: continue #unhashable value
+            if not subs: continue
+            for sub in subs:
+                if sub not in woken and (sub.matches(jid,old) or sub.matches(jid,new)):
+                    sub.event.set()
+                    woken.add(sub)
+
+    def last_seq(self):
+        '''seq of the latest job change, or 0'''
+        with self.__lock.read(): return next(reversed(self.__changes.values())) if self.__changes else 0
+
+    def wait_changes(self,seq,timeout):
+        '''block until a job changed after seq exists or timeout seconds pass
+        returns the seq of the latest change, query with get(seq=seq) after this returns'''
+        sub=self.subscribe() #subscribe before checking so a change in between still wakes us
+        try:
+            deadline=time.time()+timeout
+            while not self.shutdown.is_set():
+                last=self.last_seq()
+                remaining=deadline-time.time()
+                if last > seq or remaining <= 0: return last
+                sub.wait(min(remaining,1)) #check for shutdown every second
+            return self.last_seq()
+        finally: self.unsubscribe(sub)
 
     #these return a copy of the state, use update_ methods to modify it
 
@@ -138,70 +320,190 @@ class State(threading.Thread):
         '''set node status, remove node pools if node offline'''
         with self.__lock: self.__update_node(node,**node_status)
     def __update_node(self,node,**node_status): 
+        current=self.__status.get(node)
+        routing=node_status.get('routing')
+        digest=node_status.get('routing_digest')
+        if current is None: changed=True
+        elif routing is None: #status without routing, or just the digest of routing we should already have
+            changed=False
+            if digest and current.get('routing_digest') != digest and 'routing' in current:
+                del current['routing'] #we don't have this routing, see routing_missing
+                changed=True
+        elif digest: changed=current.get('routing_digest') != digest
+        else: changed=current.get('routing') != routing #from a node that does not send digests
         self.__status.setdefault(node,{'pools':{}}).update(**node_status)
         #remove offline nodes from pools
-        if not self.__status[node].get('online'): self.__status[node]['pools']={}
+        if not self.__status[node].get('online'): self.__status[node].update(pools={},resources={})
+        if changed: self.__route()
+
+    def update_peers(self,peers):
+        '''set the nodes we connect to directly, jobs for nodes in their routing are synced to them'''
+        with self.__lock:
+            if set(peers) != set(self.__peers):
+                self.__peers=tuple(peers)
+                self.__route()
+
+    def get_routes(self):
+        '''returns (version,{node:(peers it is routed through)}), the version changes when the routes do
+        the routes are not modified after they are returned'''
+        return self.__routing_version,self.__routes
+
+    def routing_missing(self):
+        '''nodes we have the routing digest of but not the routing for, see Meeseeks.handle'''
+        return [node for (node,status) in self.__status.items() if 'routing_digest' in status and 'routing' not in status]
+
+    def __route(self): #call with lock held
+        '''recompute our routing and the routes after the topology changed'''
+        if self.node in self.__status:
+            #we can route to nodes we see via our connected nodes
+            routing=sorted(self.__status)
+            if routing != self.__status[self.node].get('routing'):
+                self.__status[self.node].update(routing=routing,
+                    routing_digest=hashlib.blake2b('\n'.join(routing).encode(),digest_size=8).hexdigest())
+        routes=self.__compute_routes()
+        if routes != self.__routes:
+            self.__routes=routes
+            self.__routing_version+=1
+    def __compute_routes(self):
+        routes={}
+        for peer in self.__peers:
+            for node in [peer]+list(self.__status.get(peer,{}).get('routing') or []):
+                hops=routes.get(node,())
+                if node != self.node and peer not in hops: routes[node]=hops+(peer,)
+        return routes
+
+    def active_jobs(self,nodes):
+        '''count of active jobs on nodes'''
+        with self.__lock.read(): return sum(self.__index.active(node) for node in nodes)
 
     def get_pools(self): 
         '''get a pool:node:slots_free map of pool availability'''
-        with self.__lock: return self.__get_pools()
+        with self.__lock.read(): return self.__get_pools()
     def __get_pools(self):
         pools={}
-        for n,node in self.get_nodes().items():
+        for n,node in self.__status.items():
             for pool,slots in node['pools'].items():
                 if slots is not True: #if limit set, subtract pending/running jobs
-                    slots-=len( [ job for job in self.__get(node=n,pool=pool).values() \
-                        if job['state'] not in self.JOB_INACTIVE ] )
+                    slots-=self.__index.active(n,pool)
                 pools.setdefault(pool,{})[n]=slots
         return pools
-    def update_pool(self,pool,node,slots): 
-        '''set slots in pool for node'''
-        with self.__lock: self.__update_pool(pool,node,slots)
-    def __update_pool(self,pool,node,slots):
-        if slots: self.__status.setdefault(node,{'pools':{}})['pools'][pool]=slots
-        elif node in self.__status and pool in self.__status[node]['pools']: 
-            del self.__status[node]['pools'][pool]
-
-    def get(self,ids=[],ts=None,seq=None,**query):
-        '''dump a list of jobs or all jobs for a node/pool/state/or updated after a certain ts/seq'''
-        with self.__lock: return self.__get(ids,ts,seq,**query)
-    def __get(self,ids=[],ts=None,seq=None,tag=None,**query):
+
+    def get_resources(self):
+        '''get a pool:node:{resource:free} map of the resources not used by active jobs, for nodes with pool resources'''
+        with self.__lock.read():
+            resources={}
+            for n,node in self.__status.items():
+                for pool,total in (node.get('resources') or {}).items():
+                    resources.setdefault(pool,{})[n]=add_resources(dict(total),self.__index.used(n,pool),-1)
+            return resources
+
+    def check(self):
+        '''recompute the indexes and active job counts and compare them to the maintained ones
+        returns a list of inconsistencies, which will be empty if all is well'''
+        with self.__lock.read(): return self.__check()
+    def __check(self):
+        r=self.__index.check(self.__jobs)
+        changes=[jid for (jid,job) in sorted(self.__jobs.items(),key=lambda j:j[1]['seq'])]
+        if changes != list(self.__changes.keys()): r.append('change order does not match job seq')
+        restarts=set(jid for (jid,job) in self.__jobs.items() if self.__restartable(job))
+        if restarts != self.__restarts: r.append('restarts: %s != %s'%(self.__restarts,restarts))
+        expiry=set(self.__expiry)
+        if any((job['ts'],jid) not in expiry for (jid,job) in self.__jobs.items()): 
+            r.append('expiry heap is missing jobs')
+        if self.__compute_routes() != self.__routes: r.append('routes do not match node routing')
+        for e in r: self.logger.error(e)
+        return r
+
+    def update_pool(self,pool,node,slots,resources=None): 
+        '''set slots in pool for node, and the {resource:count} the active jobs in the pool can use
+        a job can only use resources its pool has'''
+        with self.__lock: self.__update_pool(pool,node,slots,resources)
+    def __update_pool(self,pool,node,slots,resources=None):
+        if slots: 
+            if node not in self.__status: self.__update_node(node) #new node, so we route to it
+            self.__status[node]['pools'][pool]=slots
+            if resources: self.__status[node].setdefault('resources',{})[pool]=resources
+            else: self.__status[node].get('resources',{}).pop(pool,None)
+        elif node in self.__status:
+            self.__status[node]['pools'].pop(pool,None)
+            self.__status[node].get('resources',{}).pop(pool,None)
+
+    def get(self,ids=[],ts=None,seq=None,records=False,**query):
+        '''dump a list of jobs or all jobs for a node/pool/state/or updated after a certain ts/seq
+        if records=True, the read-only JobRecords are returned instead of copies
+        copies of array jobs have the array_counts but not the array_runs, unless indices=True'''
+        with self.__lock.read(): return self.__get(ids,ts,seq,records=records,**query)
+    def __get(self,ids=[],ts=None,seq=None,tag=None,records=False,indices=False,**query):
         try: 
             #turn single job id into list
             if ids and type(ids) is not list: ids=[ids]
-            #filter by jid list and/or ts/seq greater than
-            #filter by tag in tags if specified
-            #if we're on a node, do not return jobs without node unless seq/ts/node specified
-            # (prevents propagation of unrouted jobs)
-            r=dict( (jid,job.copy()) for (jid,job) in self.__jobs.items() if \
-                    (jid in ids) or ( not ids \
-                        and (not ts or job['ts']>ts) \
-                        and (not seq or job['seq']>seq) \
-                        and (not tag or tag in job['tags']) \
-                        and (not self.node or job['node'] or 'node' in query) ) )
-            for (k,v) in query.items(): #filter by other criteria
-                if type(v) is str and v.endswith('*'): #wildcard on string attrs
-                    r=dict((jid,job) for (jid,job) in r.items() if \
-                        type(job.get(k)) is str and job.get(k).startswith(v[:-1]))
-                else: r=dict((jid,job) for (jid,job) in r.items() if job.get(k)==v)
+            if ids: jids=[jid for jid in ids if jid in self.__jobs] #only the jobs in the list
+            else:
+                #walk back the change order if seq specified
+                #else use the indexes to get candidate jobs, scan all jobs if the query isn't indexed
+                if seq: jids=self.__changed_since(seq)
+                else: jids=self.__index.select(tag=tag,**query)
+                if jids is None: jids=self.__jobs.keys()
+                #filter by ts/seq greater than
+                #filter by tag in tags if specified
+                #if we're on a node, do not return jobs without node unless seq/ts/node specified
+                # (prevents propagation of unrouted jobs)
+                jids=[ jid for jid in jids if self.__match(self.__jobs[jid],ts,seq,tag,'node' in query) ]
+            r={}
+            for jid in jids: 
+                job=self.__jobs[jid]
+                for (k,v) in query.items(): #filter by other criteria
+                    if type(v) is str and v.endswith('*'): #wildcard on string attrs
+                        if not (type(job.get(k)) is str and job.get(k).startswith(v[:-1])): break
+                    elif job.get(k)!=v: break
+                else: 
+                    if records: r[jid]=job
+                    else:
+                        r[jid]=job.copy()
+                        if not indices: r[jid].pop('array_runs',None)
             return r
         except Exception as e: self.logger.warning(e,exc_info=True)
         return None
 
-    def sync(self,jobs={},status={}):
+    def __changed_since(self,seq):
+        '''return ids of jobs with seq > seq, oldest change first'''
+        jids=[]
+        for jid,job_seq in reversed(self.__changes.items()):
+            if job_seq <= seq: break
+            jids.append(jid)
+        jids.reverse()
+        return jids
+
+    def __match(self,job,ts,seq,tag,node):
+        return (not ts or job['ts']>ts) \
+            and (not seq or job['seq']>seq) \
+            and (not tag or tag in job['tags']) \
+            and (not self.node or job['node'] or node)
+
+    def sync(self,jobs={},status={},missing=None):
         '''update local status cache with incoming status 
-        and jobs not in local state or job ts >= local jobs ts'''
+        and jobs not in local state or job ts >= local jobs ts
+        jobs can be deltas of the changed keys (see Delta), 
+        the ids of deltas that do not apply to our version of the job are appended to missing'''
         with self.__lock:
             updated=[]
             try:
                 for jid,job in jobs.items():
-                    if jid not in self.__jobs or self.__jobs[jid]['ts'] < job['ts']:
-                        self.__update_job(jid,**job)
-                        updated.append(jid)
+                    current=self.__jobs.get(jid)
+                    if current is not None and current['ts'] >= job['ts']: continue
+                    if 'delta' in job:
+                        if current is None or current['ts'] != job['delta']:
+                            if missing is not None: missing.append(jid)
+                            continue
+                        job=dict(job)
+                        del job['delta']
+                    self.__update_job(jid,**job)
+                    updated.append(jid)
                 #update our status from incoming status data
                 for node,node_status in status.items():
                     self.__update_node(node,**node_status)
             except Exception as e: self.logger.warning(e,exc_info=True)
+            self.__commit()
         #return updated items
         return updated
 
@@ -211,20 +513,78 @@ class State(threading.Thread):
             if jid in self.__jobs: return self.__jobs.get(jid).copy()
         except Exception as e: self.logger.warning(e,exc_info=True)
 
+    def missing(self,jids):
+        '''returns the jids that are not in state'''
+        with self.__lock.read(): return [jid for jid in jids if jid not in self.__jobs]
+
     def update_job(self,jid,**data):
         '''update job jid with k/v in data, no sanity checks are performed'''
         with self.__lock: 
-            if jid in self.__jobs: return self.__update_job(jid,**data)
-            else: return False
+            if jid not in self.__jobs: return False
+            job=self.__update_job(jid,**data)
+            self.__commit()
+            return job and job.copy()
+    def update_jobs(self,updates):
+        '''update jobs from a jid:data map under one lock, see update_job. returns the ids of the jobs updated'''
+        with self.__lock:
+            r=[jid for (jid,data) in updates.items() if jid in self.__jobs and self.__update_job(jid,**data)]
+            self.__commit()
+            return r
     def __update_job(self,jid,**data): #nolock for internal use
             try:
                 if 'seq' in data: del data['seq'] #replace seq but preserve ts if set
                 if 'ts' not in data: data['ts']=time.time() #if no timestamp, set current
-                self.__jobs.setdefault(jid,{}).update(seq=self.__seq,**data)
+                job=self.__jobs.get(jid)
+                #reindex if an indexed field is changing
+                reindex=job is None or any(k in data for k in Index.KEYS)
+                if job is not None and reindex: self.__index.remove(jid,job)
+                if self.__wal: self.__wal.append(jid,self.__seq,job['seq'] if job else 0,data)
+                #replace the job record instead of modifying it, so snapshots/history can share the old one
+                old=job
+                if job is None: job=JobRecord(data,seq=self.__seq)
+                else: job=job.replace(seq=self.__seq,**data)
+                self.__jobs[jid]=job
+                if reindex: self.__index.add(jid,job)
+                self.__notify(jid,old,job)
+                self.__changes[jid]=self.__seq
+                self.__changes.move_to_end(jid)
                 self.__seq+=1
-                return self.__jobs.get(jid)
+                heapq.heappush(self.__expiry,(job['ts'],jid))
+                if self.__restartable(job): self.__restarts.add(jid)
+                else: self.__restarts.discard(jid)
+                return job
             except Exception as e: self.logger.warning(e,exc_info=True)
 
+    def __delete_job(self,jid): #nolock for internal use
+        job=self.__jobs.pop(jid,None)
+        if job is not None: 
+            if self.__wal: self.__wal.append(jid,self.__seq,job['seq'],None)
+            self.__seq+=1
+            self.__index.remove(jid,job)
+            del self.__changes[jid]
+            self.__restarts.discard(jid)
+            self.__notify(jid,job,None)
+        return job
+
+    def __restartable(self,job):
+        '''returns 'restart' if this node should restart the job, 'resubmit' if it should resubmit it, else None'''
+        #resubmit kicks done/fail jobs back to the submit node for pool reassignment
+        #is this our job (assigned to us and not set to resubmit)
+        this_node=( self.node and job.get('node')==self.node ) and not job.get('resubmit') #job on this node
+        #resubmittable and not claimed 
+        #and not new or killed 
+        #and we are the node that will resubmit it
+        resubmit=(  job.get('resubmit') and not job.get('active') \
+                    and job.get('state') not in ['new','killed'] \
+                    and (self.node and job.get('submit_node') == self.node) )
+        if resubmit or this_node: #only check jobs we may be restarting/resubmitting
+            #if we restart and this job is done
+            #if we retry on fail and we have retries remaining
+            if (job.get('restart') and job.get('state') == 'done') or \
+                (job.get('state') == 'failed' and (job.get('fail_count') or 0) <= (job.get('retries') or 0)):
+                    if resubmit: return 'resubmit'
+                    return 'restart'
+
     def kill_jobs(self,*args,**kwargs):
         '''kill jobs, args can be a job id, a list of jobids, or a query dict'''
         resp={}
@@ -232,11 +592,27 @@ class State(threading.Thread):
         if kwargs: arg=kwargs
         elif args: arg=args[0]
         if arg: #don't let kill run without an arg
-            if type(arg) is list: jids=arg
-            elif type(arg) is dict: jids=self.list_jobs(**arg)
-            else: jids=args #single job id or list of ids
-            for jid in jids: resp[jid]=self.update_job(jid,state='killed')
+            with self.__lock: #kill them all under one lock
+                if type(arg) is list: jids=arg
+                elif type(arg) is dict: jids=list(self.__get(records=True,**arg) or {})
+                else: jids=args #single job id or list of ids
+                for jid in jids: 
+                    job=jid in self.__jobs and self.__update_job(jid,state='killed')
+                    resp[jid]=job and job.copy()
+                self.__commit()
         return resp
+
+    def modify_jobs(self,data,**query):
+        '''update the jobs matching query with data under one lock, no sanity checks are performed (see update_job)
+        returns the jid:job map of the jobs updated'''
+        if not query: return {} #don't let modify run without a query
+        with self.__lock:
+            r={}
+            for jid in list(self.__get(records=True,**query) or {}):
+                job=self.__update_job(jid,**data)
+                r[jid]=job and job.copy()
+            self.__commit()
+            return r
         
     def list_jobs(self,**kwargs):
         '''return list of job ids'''
@@ -244,81 +620,104 @@ class State(threading.Thread):
         
     def submit_job(self,**jobargs):
         '''add or change a job, see job spec for proper key=values'''
-        r={} #returned jid:job info map
         with self.__lock:
-            try:
-                #filter job to spec keys
-                jobargs=dict((k,v) for (k,v) in jobargs.items() if (v is not None) and (k in self.JOB_SPEC))
-
-                #handle multi-node spec
-                if jobargs.get('node'):
-                    nodes=jobargs['node']
-                    del jobargs['node']
-                    if type(nodes) is not list: #if nodes is already a list of nodenames, use it
-                        if nodes.endswith("*"): #wildcard specified
-                            #get all nodes in the pool matching the pattern. 
-                            nodes=[ node for node in \
-                                    self.__get_pools().get(jobargs['pool'],{}).keys() \
-                                    if node.startswith(nodes[:-1]) ]
-                        else: nodes=[nodes] #single node specifies
-                else: nodes=[None] #nothing specified
-
-                #create a job for each node
-                for node in nodes:
-                    if node: jobargs['node']=node
-                    jid=jobargs.get('id',str(uuid.uuid1())) #use preset id or generate one
-                    job=self.__jobs.get(jid)
-                    if job: #modifying an existing job
-                        del jobargs['id'] #unset incoming id
-                        del job['ts'] #unset ts to ensure update 
-                        #do sanity checks on state changes
-                        #inactive jobs can only reset
-                        if job['state'] in self.JOB_INACTIVE:
-                            if 'state' in jobargs:
-                                if jobargs['state']=='new': 
-                                    #if no node specified, routing logic will set one
-                                    if jobargs.get('node'): jobargs['submit_node']=jobargs['node'] #change submit node if set
-                                    else: 
-                                        jobargs.update( 
-                                            node=job.get('submit_node',False), #reset to submit node if set
-                                            active=False, # clear active state if removed from node
-                                            error=None, #clear error state
-                                            start_count=0,fail_count=0, #reset counts
-                                            submit_ts=time.time() #reset submit ts
-                                        )
-                                else: del jobargs['state'] #other state change not allowed
-                        #active jobs can only be killed, and cannot be moved
-                        else:
-                            if 'state' in jobargs and jobargs['state'] != 'killed': del jobargs['state']
-                            if 'node' in jobargs: del jobargs['node']
-                            if 'pool' in jobargs: del jobargs['pool']
-                    else: #this is a new job
-                        if not jobargs.get('pool'): return {jid:False} #jobs have to have a pool to run in
-                        if 'state' in jobargs: del jobargs['state'] #new jobs can't have a state
-                        #tags must be a list
-                        if type(jobargs.get('tags')) is not list: jobargs['tags']=[jobargs.get('tags')]
-                        job={  
-                                'submit_ts':time.time(),    #submit timestamp
-                                'node':jobargs.get('node',False),               #no node assigned unless jobargs set one
-                                'submit_node':jobargs.get('node',False),        #node job was submitted to, we reset to this
-                                'state':'new',
-                                'start_count':0,             
-                                'fail_count':0,
-                                'error':None,
-                                'active':False,
-                                'uid':os.geteuid()
-                            }
-                    job.update(**jobargs)
-                    self.__update_job(jid,**job)
-                    self.logger.info('submit job %s',jid)
-                    r[jid]=job.copy()
+            r=self.__submit_job(**jobargs)
+            self.__commit()
+            return r
 
-            except Exception as e: self.logger.warning(e,exc_info=True)
+    def submit_jobs(self,specs):
+        '''add or change jobs from a list of specs under one lock, see submit_job
+        returns the jid:job map of all the specs'''
+        with self.__lock:
+            r={}
+            for jobargs in specs: r.update(self.__submit_job(**jobargs))
+            self.__commit()
             return r
 
+    def __submit_job(self,**jobargs): #nolock for internal use
+        r={} #returned jid:job info map
+        try:
+            #filter job to spec keys
+            jobargs=dict((k,v) for (k,v) in jobargs.items() if (v is not None) and (k in self.JOB_SPEC))
+            if 'priority' in jobargs: jobargs['priority']=int(jobargs['priority']) #schedulers compare priorities
+            if 'resources' in jobargs: jobargs['resources']=get_resources(jobargs['resources']) #resources are counted
+
+            #handle multi-node spec
+            if jobargs.get('node'):
+                nodes=jobargs['node']
+                del jobargs['node']
+                if type(nodes) is not list: #if nodes is already a list of nodenames, use it
+                    if nodes.endswith("*"): #wildcard specified
+                        #get all nodes in the pool matching the pattern. 
+                        nodes=[ node for node in \
+                                self.__get_pools().get(jobargs['pool'],{}).keys() \
+                                if node.startswith(nodes[:-1]) ]
+                    else: nodes=[nodes] #single node specifies
+            else: nodes=[None] #nothing specified
+
+            #create a job for each node
+            for node in nodes:
+                if node: jobargs['node']=node
+                jid=jobargs.get('id',str(uuid.uuid1())) #use preset id or generate one
+                job=self.__jobs.get(jid)
+                if job: #modifying an existing job
+                    job=job.copy() #indexed fields may change, __update_job will apply it
+                    del jobargs['id'] #unset incoming id
+                    del job['ts'] #unset ts to ensure update 
+                    jobargs.pop('array',None) #the indices of an array can't change
+                    #do sanity checks on state changes
+                    #inactive jobs can only reset
+                    if job['state'] in self.JOB_INACTIVE:
+                        if 'state' in jobargs:
+                            if jobargs['state']=='new': 
+                                #if no node specified, routing logic will set one
+                                if jobargs.get('node'): jobargs['submit_node']=jobargs['node'] #change submit node if set
+                                else: 
+                                    jobargs.update( 
+                                        node=job.get('submit_node',False), #reset to submit node if set
+                                        active=False, # clear active state if removed from node
+                                        error=None, #clear error state
+                                        start_count=0,fail_count=0, #reset counts
+                                        submit_ts=time.time() #reset submit ts
+                                    )
+                                if job.get('array'): jobargs.update(Array(job['array']).update()) #run all indices again
+                            else: del jobargs['state'] #other state change not allowed
+                    #active jobs can only be killed, and cannot be moved
+                    else:
+                        if 'state' in jobargs and jobargs['state'] != 'killed': del jobargs['state']
+                        if 'node' in jobargs: del jobargs['node']
+                        if 'pool' in jobargs: del jobargs['pool']
+                else: #this is a new job
+                    if not jobargs.get('pool'): return {jid:False} #jobs have to have a pool to run in
+                    if 'state' in jobargs: del jobargs['state'] #new jobs can't have a state
+                    #tags must be a list
+                    if type(jobargs.get('tags')) is not list: jobargs['tags']=[jobargs.get('tags')]
+                    if 'array' in jobargs: 
+                        array=Array(jobargs['array'])
+                        jobargs.update(array=array.spec(),**array.update())
+                    job={  
+                            'submit_ts':time.time(),    #submit timestamp
+                            'node':jobargs.get('node',False),               #no node assigned unless jobargs set one
+                            'submit_node':jobargs.get('node',False),        #node job was submitted to, we reset to this
+                            'state':'new',
+                            'start_count':0,             
+                            'fail_count':0,
+                            'error':None,
+                            'active':False,
+                            'uid':os.geteuid()
+                        }
+                job.update(**jobargs)
+                job=self.__update_job(jid,**job)
+                self.logger.info('submit job %s',jid)
+                r[jid]=job.copy()
+
+        except Exception as e: self.logger.warning(e,exc_info=True)
+        return r
+
     def __state_run(self):
         self.logger.info('started')
         checkpoint_count=0
+        spool_ts=0 #last time the spool was cleaned
 
         while not self.shutdown.is_set():
             with self.__lock:
@@ -326,54 +725,54 @@ class State(threading.Thread):
                     #snapshot node status so we can modify it
                     nodes=self.__status.copy()
 
-                    #write recently finished jobs to history
-                    for jid,job in self.__jobs.items():
-                        if job['seq'] > self.__hist_seq and job['state'] in self.JOB_INACTIVE:
-                            self.write_history(jid)
-                    self.__hist_seq=self.__seq
-
-                    #scan for expired jobs
-                    for jid,job in self.__jobs.copy().items():
-                        if time.time()-job['ts'] > self.expire: 
-                            #jobs that have ended will no longer be updated, so expire them.
-                            if job['state'] in self.JOB_INACTIVE:
-                                self.logger.debug('expiring inactive job %s',jid)
-                                del self.__jobs[jid]
-                            #if we expire active jobs and the job's node is down
-                            elif self.expire_active_jobs and not nodes.get(job.get('node'),{}).get('online'):
-                                #this job *should* have been updated by the node
-                                self.logger.warning('expiring active job %s on %s',jid,job.get('node'))
-                                #set job to failed
-                                self.__update_job(jid,state='failed',error='expired',fail_count=job.get('fail_count',0)+1)
-                            #bump the timestamp on the job to ensure it has been forwarded to the proper node
-                            else: self.__update_job(jid)
-                            
-                    #scan for recurring jobs
-                    for jid,job in self.__jobs.items():
-                        #resubmit kicks done/fail jobs back to the submit node for pool reassignment
-                        #is this our job (assigned to us and not set to resubmit)
-                        this_node=( self.node and job.get('node')==self.node ) and not job.get('resubmit') #job on this node
-                        #resubmittable and not claimed 
-                        #and not new or killed 
-                        #and we are the node that will resubmit it
-                        resubmit=(  job.get('resubmit') and not job.get('active') \
-                                    and job['state'] not in ['new','killed'] \
-                                    and (self.node and job.get('submit_node') == self.node) )
-                        if resubmit or this_node: #only check jobs we may be restarting/resubmitting
-                            restart=False
-                            #if we restart and this job is done
-                            if job.get('restart') and job['state'] == 'done': restart=True
-                            #if we retry on fail and we have retries remaining
-                            elif job['state'] == 'failed' and job.get('fail_count') <= job.get('retries',0):
+                    #queue recently finished jobs for history
+                    if self.history:
+                        for jid in self.__changed_since(self.__hist_seq):
+                            if self.__jobs[jid]['state'] in self.JOB_INACTIVE: self.write_history(jid)
+                    self.__hist_seq=self.__seq-1
+
+                    #expire jobs from the heap until we find one that is not past the deadline
+                    now=time.time()
+                    while self.__expiry and now-self.__expiry[0][0] > self.expire:
+                        ts,jid=heapq.heappop(self.__expiry)
+                        job=self.__jobs.get(jid)
+                        if not job or job['ts'] != ts: continue #job updated or removed since this entry
+                        #jobs that have ended will no longer be updated, so expire them.
+                        if job['state'] in self.JOB_INACTIVE:
+                            self.logger.debug('expiring inactive job %s',jid)
+                            self.__delete_job(jid)
+                        #if we expire active jobs and the job's node is down
+                        elif self.expire_active_jobs and not nodes.get(job.get('node'),{}).get('online'):
+                            #this job *should* have been updated by the node
+                            self.logger.warning('expiring active job %s on %s',jid,job.get('node'))
+                            #set job to failed
+                            self.__update_job(jid,state='failed',error='expired',fail_count=job.get('fail_count',0)+1)
+                        #bump the timestamp on the job to ensure it has been forwarded to the proper node
+                        else: self.__update_job(jid)
+                    #drop stale entries if the heap has grown too large
+                    if len(self.__expiry) > 2*len(self.__jobs)+1024:
+                        self.__expiry=[(job['ts'],jid) for (jid,job) in self.__jobs.items()]
+                        heapq.heapify(self.__expiry)
+
+                    #restart/resubmit recurring jobs
+                    for jid in list(self.__restarts):
+                        job=self.__jobs[jid]
+                        restart=self.__restartable(job)
+                        update={}
+                        if restart and job.get('array'):
+                            array=Array.from_job(job)
+                            #retry the indices that did not finish, or restart them all
+                            if job['state'] == 'failed': array.replace(('running','failed','killed'),'new')
+                            else: array.replace(Array.STATES,'new')
+                            update=array.update()
+                        if restart == 'resubmit': #claim this job to resubmit it
+                            self.logger.info('resubmit job %s',jid)
+                            self.__update_job(jid, submit_ts=time.time(), state='new', node=self.node, **update)
+                        elif restart: #restart locally 
+                            if job['state'] == 'failed': 
                                 self.logger.info('retry job %s (%s of %s)',jid,job.get('fail_count'),job.get('retries'))
-                                restart=True
-                            if restart: 
-                                if resubmit: #claim this job to resubmit it 
-                                    self.logger.info('resubmit job %s',jid)
-                                    self.__update_job(jid, submit_ts=time.time(), state='new', node=self.node)
-                                else: #restart locally 
-                                    self.logger.info('restart job %s',jid)
-                                    self.__update_job(jid, state='new')
+                            self.logger.info('restart job %s',jid)
+                            self.__update_job(jid, state='new', **update)
 
                     #set nodes that have not sent status to offline
                     for node,node_status in nodes.items():
@@ -384,18 +783,35 @@ class State(threading.Thread):
                             elif node_status.get('remove'): #offline node is marked for upstream removal
                                 self.logger.info('removing node %s',node)
                                 del self.__status[node]
+                                self.__route()
+
+                    #verify the indexes if configured
+                    if self.check_index: self.__check()
 
                 except Exception as e: self.logger.warning(e,exc_info=True)
+                self.__commit()
 
-                #save to state file if checkpointing set
+                #snapshot state if checkpointing set
+                snapshot=None
                 if self.checkpoint:
                     checkpoint_count=(checkpoint_count+1) % self.checkpoint
-                    if not checkpoint_count: self.__save_state()
+                    if not checkpoint_count: snapshot=self.__snapshot()
+
+            #save the snapshot without holding the lock
+            if snapshot is not None: self.__save_state(snapshot)
+
+            #clean the spool every minute
+            if self.spool and time.time()-spool_ts > 60:
+                spool_ts=time.time()
+                try: self.spool.clean()
+                except Exception as e: self.logger.warning(e,exc_info=True)
 
             time.sleep(1)
 
-        #close history file if we have one
-        if self.hist_fh: self.hist_fh.close()
+        #write out history and close history file if we have one
+        if self.history: self.history.close()
 
         #save state at shutdown
-        with self.__lock: self.__save_state()
+        with self.__lock: snapshot=self.__snapshot()
+        self.__save_state(snapshot)
+        if self.__wal: self.__wal.close()
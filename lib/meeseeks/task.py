@@ -35,6 +35,7 @@ class Task(Process):
         self.info=Manager().dict() #task info readable by pool
         #thread will wait on subprocess
         Process.__init__(self,target=self.__task_run)
+        self.logger=logging.getLogger(self.name) #kill is called from the pool
         self.start() 
     
     def __task_run(self):
@@ -43,6 +44,13 @@ class Task(Process):
         try:
             popen_args={}
             popen_args.update(self.job.get('config',{})) #add config if any
+            spool=self.job.get('spool') #output store, if the node has one
+            spooled={} #stream:temp file for output written to the spool
+
+            #create spool files as the meeseeks user, before we switch
+            if spool:
+                for stream in ('stdout','stderr'):
+                    if not self.job.get(stream): spooled[stream]=spool.create()
 
             #switch to the user who will be running this job
             su(self.job.get('uid'),self.job.get('gid'))
@@ -53,23 +61,23 @@ class Task(Process):
                 stdin=open(stdin,'rb')
                 popen_args.update(stdin=stdin)
 
-            # stdout to whatever is passed in, else defaults to PIPE
+            # stdout to whatever is passed in, else to the spool or a PIPE
             stdout=self.job.get('stdout')
             if stdout: 
                 stdout=open(stdout,'ab')
                 popen_args.update(stdout=stdout)
             else:
-                popen_args.update(stdout=subprocess.PIPE)
+                popen_args.update(stdout=spooled.get('stdout',subprocess.PIPE))
 
-            # stderr to whatever is passed in, else defaults to PIPE
+            # stderr to whatever is passed in, else to the spool or a PIPE
             stderr=self.job.get('stderr')
             if stderr: 
                 stderr=open(stderr,'ab')
                 popen_args.update(stderr=stderr)
             else:
-                popen_args.update(stderr=subprocess.PIPE)
+                popen_args.update(stderr=spooled.get('stderr',subprocess.PIPE))
 
-            env=self.job.get('env',{}) #get environ as dict
+            env=dict(self.job.get('env',{})) #get environ as dict, copy it as it may be shared with other jobs
             #set meeseeks env vars
             env.update(
                 MEESEEKS_JOB_ID=self.job.get('id',''),
@@ -78,6 +86,8 @@ class Task(Process):
                 MEESEEKS_SUBMIT_NODE=self.job.get('submit_node'),
                 MEESEEKS_TAGS=','.join(t for t in self.job.get('tags',[]) if t is not None)
             )
+            #the index of the task of an array job
+            if 'array_index' in self.job: env.update(MEESEEKS_ARRAY_INDEX=str(self.job['array_index']))
             
             #kick it! *guitar riff*
             self.__sub=subprocess.Popen( self.job.get('args'), env=env, **popen_args)
@@ -99,7 +109,13 @@ class Task(Process):
             if stdout: stdout.close()
             if stderr: stderr.close()
 
-            # return output as a base64 string if we got any
+            # return a reference to spooled output, it is fetched from this node with the output request
+            for stream,fh in spooled.items():
+                fh.close()
+                ref=spool.add(fh.name)
+                if ref: self.info[stream+'_ref']=dict(ref,node=self.job.get('node'))
+
+            # if not spooled, return output as a base64 string if we got any
             if stdout_data: self.info['stdout_data']=base64.b64encode(stdout_data).decode()
             if stderr_data: self.info['stderr_data']=base64.b64encode(stderr_data).decode()
 
@@ -6,6 +6,7 @@ import pwd, grp
 import json
 import ssl
 import importlib
+import threading
 
 from .config import Config
 
@@ -19,6 +20,23 @@ def import_plugin(plugin):
         return None
     return getattr (m,plugin.split('.')[-1])
 
+def get_resources(resources):
+    '''returns a name:count map from a resources spec (pool or job), counts are ints'''
+    if not isinstance(resources,dict): return {}
+    return dict((str(k),int(v)) for (k,v) in resources.items() if v)
+
+def add_resources(total,resources,n=1):
+    '''add n times the counts of resources to the total map, names that reach 0 are removed'''
+    for k,v in resources.items():
+        c=total.get(k,0)+v*n
+        if c: total[k]=c
+        else: del total[k]
+    return total
+
+def fits(need,free):
+    '''True if all counts in need are available in free, resources not in free are not available'''
+    return all(free.get(k,0) >= v for (k,v) in need.items())
+
 def read_cfg_files(args):
     cfg=Config()
     if type(args) is not list: args=[args]
@@ -84,4 +102,55 @@ def su(uid=None,gid=None,sub=False):
             os.seteuid(os.getuid())
             os.setegid(gid)
             os.seteuid(uid)
-            return os.getresuid(),os.getresgid()
\ No newline at end of file
+            return os.getresuid(),os.getresgid()
+
+class RWLock:
+    '''reader/writer lock
+    with lock: holds the lock exclusively (writer)
+    with lock.read(): holds the lock shared with other readers
+    a waiting writer blocks new readers, and readers waiting when a writer releases go before the next writer,
+    so neither side is starved. Not reentrant.'''
+    def __init__(self):
+        self.__cond=threading.Condition(threading.Lock())
+        self.__readers=0 #count of readers holding the lock
+        self.__writer=False #True if a writer holds the lock
+        self.__waiting=0 #count of writers waiting for the lock
+        self.__waiting_readers=0 #count of readers waiting for the lock
+        self.__admit=0 #count of readers let in ahead of waiting writers
+        self.__read=_ReadLock(self)
+
+    def read(self): return self.__read
+
+    def acquire_read(self):
+        with self.__cond:
+            self.__waiting_readers+=1
+            while self.__writer or (self.__waiting and not self.__admit): self.__cond.wait()
+            self.__waiting_readers-=1
+            if self.__admit: self.__admit-=1
+            self.__readers+=1
+
+    def release_read(self):
+        with self.__cond:
+            self.__readers-=1
+            if not self.__readers: self.__cond.notify_all()
+
+    def acquire(self):
+        with self.__cond:
+            self.__waiting+=1
+            while self.__writer or self.__readers or self.__admit: self.__cond.wait()
+            self.__waiting-=1
+            self.__writer=True
+
+    def release(self):
+        with self.__cond:
+            self.__writer=False
+            self.__admit=self.__waiting_readers #let the readers that waited on us go first
+            self.__cond.notify_all()
+
+    def __enter__(self): self.acquire()
+    def __exit__(self,*args): self.release()
+
+class _ReadLock:
+    def __init__(self,lock): self.__lock=lock
+    def __enter__(self): self.__lock.acquire_read()
+    def __exit__(self,*args): self.__lock.release_read()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import json
+
+class WAL:
+    '''write-ahead log of job changes
+        each line is a JSON [jid,seq,base,data] record
+            seq: the seq of the change
+            base: the seq of the job the change was applied to, 0 if the change created the job
+            data: the changed keys, or null if the job was deleted
+        at a checkpoint the log is rotated to <file>.old, which is removed after the snapshot is saved.
+        replay() only applies a change to the job version it was made against,
+        so replaying records already in the snapshot is harmless.
+    '''
+
+    def __init__(self,file,fsync=False,name='WAL'):
+        self.logger=logging.getLogger(name)
+        self.file=file
+        self.fsync=fsync
+        self.__buffer=[] #records not yet written
+        self.__fh=open(self.file,'a')
+
+    def append(self,jid,seq,base,data):
+        '''buffer a record, it will be written on commit()'''
+        self.__buffer.append(json.dumps([jid,seq,base,data])+'\n')
+
+    def commit(self):
+        '''write buffered records to the log'''
+        if self.__buffer:
+            self.__fh.write(''.join(self.__buffer))
+            self.__buffer=[]
+            self.__fh.flush()
+            if self.fsync: os.fsync(self.__fh.fileno())
+
+    def rotate(self):
+        '''start a new log, the previous records will be kept in <file>.old until truncate()'''
+        self.commit()
+        self.__fh.close()
+        old=self.file+'.old'
+        if os.path.exists(old): #previous snapshot did not complete, keep those records too
+            with open(old,'a') as fh, open(self.file) as log: fh.write(log.read())
+            os.remove(self.file)
+        else: os.rename(self.file,old)
+        self.__fh=open(self.file,'a')
+
+    def truncate(self):
+        '''remove the records saved before the last rotate(), call after the snapshot is saved'''
+        try: os.remove(self.file+'.old')
+        except FileNotFoundError: pass
+
+    def close(self):
+        self.commit()
+        self.__fh.close()
+
+    @staticmethod
+    def replay(file,jobs,logger=None):
+        '''apply records from file.old and file to jobs, returns count of records applied and the highest seq seen'''
+        count=max_seq=0
+        for path in (file+'.old',file):
+            try:
+                with open(path) as fh:
+                    for line in fh:
+                        try: jid,seq,base,data=json.loads(line)
+                        except ValueError: break #partial record at the end of the log
+                        max_seq=max(max_seq,seq)
+                        job=jobs.get(jid)
+                        #only apply a change to the job version it was made from
+                        if (job['seq'] if job else 0) != base: continue
+                        if data is None: del jobs[jid]
+                        else: jobs[jid]=dict(job or {},seq=seq,**data)
+                        count+=1
+            except FileNotFoundError: pass
+            except Exception as e:
+                if logger: logger.warning('%s:%s',path,e)
+        return count,max_seq
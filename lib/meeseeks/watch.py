@@ -20,6 +20,8 @@ class Watch(threading.Thread):
         self.__jobs={} #map of index_filename to job object
         self.__files={} #map of glob -> files matching
         self.__cache=[] #cached DirEntries
+        self.__subs={} #map of index_filename to Subscription for the job
+        self.__changed=threading.Event() #set when a running job changes
         self.cfg=Config()
         self.config(**cfg)
         self.cfg.update(name=name)
@@ -32,7 +34,7 @@ class Watch(threading.Thread):
         self.cfg.update(cfg)
         self.path=self.cfg.get('path')
         self.refresh=int(cfg.get('refresh',10))
-        self.rescan=int(cfg.get('rescan',60))/self.refresh
+        self.rescan=int(cfg.get('rescan',60))
 
     def set_file_status(self,index,filename,job=None,status=None):
         '''set the file processing status and last modified time
@@ -100,6 +102,7 @@ class Watch(threading.Thread):
                 job=Job(client=self.client,**jobspec)
                 if job.start(): 
                     self.__jobs[jid]=job
+                    self.__subs[jid]=job.client.subscribe(ids=job.jid,event=self.__changed)
                     return True
                 else: 
                     self.logger.warning('submit %s:%s %s failed',index,subindex,jobspec.get('tags'))
@@ -128,7 +131,7 @@ class Watch(threading.Thread):
     def run(self):
         self.__files={}
         
-        rescan_count=-1
+        rescan_ts=0
         job_count=0
         try:
             while not self.shutdown.is_set():
@@ -164,6 +167,8 @@ class Watch(threading.Thread):
                                 #file was probably deleted, just log it
                                 except Exception as e: self.logger.warning('%s %s',filename,e)
                             del self.__jobs[jid]
+                            sub=self.__subs.pop(jid,None)
+                            if sub: job.client.unsubscribe(sub)
                             #if no failure and all jobs have exited
                             if not self.__jobs and done is None: done=True 
                 #if we have a max_count set and jobs have run at least max_count times
@@ -172,10 +177,9 @@ class Watch(threading.Thread):
                     if max_count and job_count>=max_count: break
                 
                 if globs: #if we are tracking files
-                    rescan_count=(rescan_count+1) % self.rescan
-
                     #rescan files, start jobs on unprocessed files
-                    if not rescan_count: #scan files
+                    if time.time()-rescan_ts >= self.rescan: #scan files
+                        rescan_ts=time.time()
                         try: 
                             n=self.rescan_path()
                             self.logger.debug('%s: %s files',self.path,n)
@@ -249,11 +253,11 @@ class Watch(threading.Thread):
                         if str(index) in self.__jobs: continue #still running
                         self.start_job(index) #start it
 
-                c=0
-                while not self.shutdown.is_set():
-                    c+=1
-                    time.sleep(1)
-                    if c > self.refresh: break
+                #wait for a job to change, check shutdown every second
+                t=time.time()+self.refresh
+                while not self.shutdown.is_set() and time.time() < t:
+                    if self.__changed.wait(1): break
+                self.__changed.clear()
         
         #something really bad happened, log it and shut down gracefully
         except Exception as e: self.logger.error(e,exc_info=True)
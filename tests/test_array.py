@@ -0,0 +1,43 @@
+import unittest
+from meeseeks.array import Array
+
+class TestArray(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(Array.parse('1-100000:1'), (1, 100000, 1))
+        self.assertEqual(Array.parse('0-10:3'), (0, 9, 3))
+        self.assertEqual(Array.parse(5), (5, 5, 1))
+        for spec in ('10-1', '1-10:0', 'x', '-1-5'):
+            self.assertRaises(ValueError, Array.parse, spec)
+        self.assertEqual(len(Array('1-10:2')), 5)
+
+    def test_runs(self):
+        a = Array('1-10')
+        for i in (1, 2, 3):
+            self.assertEqual(a.next(), i)
+            a.set(i, 'running')
+        self.assertEqual(a.runs, [[1, 3, 'running'], [4, 10, 'new']])
+        a.set(2, 'done')
+        a.set(1, 'failed')
+        self.assertEqual(a.runs, [[1, 1, 'failed'], [2, 2, 'done'], [3, 3, 'running'], [4, 10, 'new']])
+        a.set(3, 'done')
+        a.set(1, 'done')
+        self.assertEqual(a.runs, [[1, 3, 'done'], [4, 10, 'new']])
+        self.assertEqual(a.get(7), 'new')
+        self.assertEqual(a.counts(), {'done': 3, 'new': 7})
+        self.assertRaises(IndexError, a.set, 11, 'done')
+        a.replace(('new',), 'killed')
+        self.assertEqual(list(a.indices('done')), [1, 2, 3])
+        self.assertEqual(a.next(), None)
+        a.replace(Array.STATES, 'new')
+        self.assertEqual(a.runs, [[1, 10, 'new']])
+
+    def test_step(self):
+        a = Array('0-8:2', [[0, 8, 'new']])
+        a.set(4, 'running')
+        self.assertEqual(a.runs, [[0, 2, 'new'], [4, 4, 'running'], [6, 8, 'new']])
+        self.assertRaises(IndexError, a.set, 3, 'done')
+        self.assertEqual(a.update(), {'array_runs': a.runs, 'array_counts': {'new': 4, 'running': 1}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from meeseeks.state import State
+from meeseeks.node import Node
+
+class TestNode(unittest.TestCase):
+
+    def setUp(self):
+        self.state = State('head')
+        self.state.update_peers(['remote'])
+        self.node = Node('head', 'remote', self.state, refresh=0)  # no thread, we drive it
+        self.node.config(refresh=1, max_refresh=8, max_backoff=10)
+        self.node.resync({})
+
+    def tearDown(self):
+        self.state.shutdown.set()
+
+    def test_next_sync(self):
+        # idle, the interval doubles up to max_refresh
+        self.assertEqual([self.node.next_sync() for i in range(5)], [2, 4, 8, 8, 8])
+        # syncing jobs makes the remote node busy for one interval
+        self.node.sync_response({}, {}, {'j': {}}, 0)
+        self.assertEqual(self.node.next_sync(), 1)
+        self.assertEqual(self.node.next_sync(), 2)
+        # active jobs routed through the remote node keep it busy, unless we watch it
+        jid = list(self.state.submit_job(pool='p1', args=['true'], node='remote').keys())[0]
+        self.state.update_job(jid, active=True)
+        self.node.sync_request()
+        self.assertEqual(self.node.next_sync(), 1)
+        self.assertEqual(self.node.next_sync(watch=True), 2)
+        self.assertEqual(self.node.stats()['pending'], 1)
+
+    def test_backoff(self):
+        self.assertEqual(self.node.backoff(), 1)
+        self.node.failures = 3
+        self.assertTrue(2 <= self.node.backoff() <= 4)
+        # capped at max_backoff, jittered down to half of it
+        self.node.failures = 20
+        for i in range(10): self.assertTrue(5 <= self.node.backoff() <= 10)
+
+    def test_resync(self):
+        self.node.resync({'epoch': 'a', 'delta': 1})
+        peer, delta = self.node.peer, self.node.peer['delta']
+        self.assertIsNotNone(delta)
+        peer.update(local_seq=5, remote_seq=7)
+        # a reconnect to the same epoch resumes the sync and keeps the delta
+        self.node.resync({'epoch': 'a', 'delta': 1})
+        self.assertIs(self.node.peer, peer)
+        self.assertEqual((self.node.peer['local_seq'], self.node.peer['remote_seq']), (5, 7))
+        self.assertIs(self.node.peer['delta'], delta)
+        # the remote node restarted, its seqs start over and it may not have what we sent
+        self.node.resync({'epoch': 'b', 'delta': 1})
+        self.assertEqual((self.node.peer['local_seq'], self.node.peer['remote_seq']), (0, 0))
+        self.assertIsNot(self.node.peer['delta'], delta)
+        # the same epoch without deltas is a full resync too
+        self.node.peer['local_seq'] = 5
+        self.node.resync({'epoch': 'b'})
+        self.assertEqual(self.node.peer['local_seq'], 0)
+        self.assertIsNone(self.node.peer['delta'])
+        # a peer that does not send an epoch is always resynced
+        self.node.peer['local_seq'] = 5
+        self.node.resync({})
+        self.assertEqual(self.node.peer['local_seq'], 0)
+
+    def test_stats(self):
+        self.assertEqual(self.node.stats()['rate'], 0)
+        self.node.sync_response({}, {}, {}, 0)
+        self.assertEqual(self.node.stats()['rate'], 1 / 60)
+
+if __name__ == '__main__':
+    unittest.main()
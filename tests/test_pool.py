@@ -0,0 +1,49 @@
+import unittest
+import time
+import threading
+from meeseeks.state import State
+from meeseeks.pool import Pool
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.state = State('n1')
+
+    def tearDown(self):
+        self.pool.shutdown.set()
+        self.pool.join(5)
+        self.state.shutdown.set()
+
+    def wait_done(self, jid, timeout=5):
+        end = time.time() + timeout
+        while self.state.get_job(jid)['state'] not in self.state.JOB_INACTIVE and time.time() < end: time.sleep(0.05)
+        return self.state.get_job(jid)
+
+    def submit(self, **kwargs):
+        kwargs.setdefault('args', ['true'])
+        return list(self.state.submit_job(pool='p1', node='n1', **kwargs).keys())[0]
+
+    def test_resources(self):
+        self.pool = Pool('n1', 'p1', self.state, resources={'cpus': 2})
+        self.assertEqual(self.wait_done(self.submit(resources={'cpus': 2}))['state'], 'done')
+        job = self.wait_done(self.submit(resources={'gpus': 1}))
+        self.assertEqual((job['state'], job['error']), ('failed', 'resources'))
+
+    def test_unconfigured_resources(self):
+        #a pool with no resources configured does not account them
+        self.pool = Pool('n1', 'p1', self.state)
+        self.assertEqual(self.wait_done(self.submit(resources={'gpus': 1}))['state'], 'done')
+        self.assertEqual(self.wait_done(self.submit(array='1-3', resources={'gpus': 1}))['state'], 'done')
+
+    def test_task_exit_wakes(self):
+        #a slot is reused as soon as its task exits, not on the next tick
+        self.pool = Pool('n1', 'p1', self.state, slots=1)
+        threads = threading.active_count()
+        t = time.time()
+        jids = [self.submit(args=['sleep', '0.1']) for i in range(4)]
+        for jid in jids: self.assertEqual(self.wait_done(jid)['state'], 'done')
+        self.assertLess(time.time() - t, 2)
+        self.assertLessEqual(threading.active_count(), threads) #no thread per task
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+import unittest
+import time
+import socket
+import threading
+import asyncio
+from meeseeks.service import RequestListener, RequestHandler, Meeseeks
+from meeseeks.manager import NodeManager, AsyncNode
+from meeseeks.listener import AsyncListener
+from meeseeks.state import State
+from meeseeks.protocol import Connection, AsyncConnection, Frames, STATS
+
+class Handler:
+    '''answers echo requests, sleeps if asked to, get requests query state'''
+    def __init__(self):
+        self.shutdown = threading.Event()
+        self.state = State('test')
+
+    def handle(self, request, peer=None):
+        if 'sleep' in request: time.sleep(request['sleep'])
+        if 'get' in request: return {'get': self.state.get(**request['get'])}
+        return {'echo': request}
+
+class TestProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = RequestListener(('localhost', 0), RequestHandler)
+        self.listener.handler = Handler()
+        threading.Thread(target=self.listener.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.listener.shutdown()
+        self.listener.server_close()
+        self.listener.handler.state.shutdown.set()
+
+    def connect(self, **kwargs):
+        return Connection(socket.create_connection(self.listener.server_address, timeout=5), timeout=5, **kwargs)
+
+    def test_frames(self):
+        a, b = socket.socketpair()
+        fa, fb = Frames(a, size=4), Frames(b, size=4)
+        fa.send(1, b'x' * 100)
+        fa.send(2, b'', flags=1)
+        self.assertEqual(fb.recv(), (1, 0, b'x' * 100))
+        self.assertEqual(fb.buffer_size(), 4) #the buffer grown for the frame is dropped
+        self.assertEqual(fb.recv(), (2, 1, b''))
+        a.close()
+        self.assertIsNone(fb.recv())
+
+    def test_line_mode(self):
+        conn = self.connect(frame=False)
+        self.assertFalse(conn.framed)
+        self.assertEqual(conn.request([{'a': 1}, {'b': 2}]), [{'echo': {'a': 1}}, {'echo': {'b': 2}}])
+        conn.close()
+
+    def test_disconnect(self):
+        sock = socket.create_connection(self.listener.server_address, timeout=5)
+        sock.sendall(b'[{"a": 1}]\n\n')  # a blank line disconnects
+        with sock.makefile('rb') as fh:
+            self.assertEqual(fh.readline(), b'[{"echo":{"a":1}}]\n')
+            self.assertEqual(fh.readline(), b'')
+        sock.close()
+
+    def test_old_peer(self):
+        # a peer that does not know hello answers {} and we stay in line mode
+        sock, peer = socket.socketpair()
+        def old_node():
+            with peer.makefile('rwb') as fh:
+                for l in fh:
+                    fh.write(b'[{}]\n')
+                    fh.flush()
+        threading.Thread(target=old_node, daemon=True).start()
+        conn = Connection(sock, timeout=5)
+        self.assertFalse(conn.framed)
+        self.assertEqual(conn.request([{'a': 1}]), [{}])
+        conn.close()
+
+    def test_pipelined(self):
+        conn = self.connect()
+        self.assertTrue(conn.framed)
+        results = {}
+        def slow(): results['slow'] = (conn.request([{'sleep': 0.5}]), time.time())
+        t = threading.Thread(target=slow)
+        t.start()
+        time.sleep(0.1)
+        self.assertEqual(conn.request([{'a': 1}]), [{'echo': {'a': 1}}])
+        done = time.time()
+        t.join()
+        self.assertEqual(results['slow'][0], [{'echo': {'sleep': 0.5}}])
+        self.assertLess(done, results['slow'][1])  # was not held up by the slow request
+        big = {'data': 'x' * 2**20}
+        self.assertEqual(conn.request([big]), [{'echo': big}])
+        conn.close()
+        self.assertRaises(ConnectionError, conn.request, [{'a': 1}])
+
+    def test_max_inflight(self):
+        self.listener.max_inflight = 1
+        conn = self.connect()
+        t = time.time()
+        threads = [threading.Thread(target=conn.request, args=([{'sleep': 0.3}],)) for i in range(2)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertGreater(time.time() - t, 0.55)  # the requests ran one at a time
+        conn.close()
+
+    def test_codec(self):
+        conn = self.connect(codec=['nope', 'json'])
+        self.assertEqual(conn.codec.name, 'json')
+        self.assertEqual(conn.request([{'a': [1, 2.5, None]}]), [{'echo': {'a': [1, 2.5, None]}}])
+        conn.close()
+
+    def test_compress(self):
+        conn = self.connect(compress=['nope', 'zlib'], compress_min=100)
+        self.assertEqual(conn.options.get('compress'), 'zlib')
+        wire = STATS.wire
+        self.assertEqual(conn.request([{'a': 1}]), [{'echo': {'a': 1}}])
+        self.assertEqual(STATS.wire, wire)  # small frames are not compressed
+        for i in range(3):
+            big = {'env': dict(('VAR_%s' % j, '/some/path/%s' % i) for j in range(100))}
+            self.assertEqual(conn.request([big]), [{'echo': big}])
+        self.assertGreater(STATS.get()['ratio'], 5)
+        conn.close()
+
+    def test_async(self):
+        async def run():
+            conn = await AsyncConnection.open(*self.listener.server_address, timeout=5, compress='zlib', compress_min=100)
+            self.assertTrue(conn.framed)
+            big = {'data': 'x' * 2**20}
+            slow, fast, echo = await asyncio.gather(conn.request([{'sleep': 0.5}]), conn.request([{'a': 1}]), conn.request([big]))
+            self.assertEqual((slow, fast, echo), ([{'echo': {'sleep': 0.5}}], [{'echo': {'a': 1}}], [{'echo': big}]))
+            with self.assertRaises(asyncio.TimeoutError): await conn.request([{'sleep': 0.5}], timeout=0.1)
+            conn.close()
+            with self.assertRaises(ConnectionError): await conn.request([{'a': 1}])
+            line = await AsyncConnection.open(*self.listener.server_address, timeout=5, frame=False)
+            self.assertEqual(await line.request([{'a': 1}]), [{'echo': {'a': 1}}])
+            line.close()
+        asyncio.run(run())
+
+class TestAsyncListener(TestProtocol):
+    '''the protocol tests against the asyncio listener'''
+
+    def setUp(self):
+        self.listener = AsyncListener(('localhost', 0), max_inflight=2)
+        self.listener.handler = Handler()
+        threading.Thread(target=self.listener.serve_forever, daemon=True).start()
+
+    def test_long_poll(self):
+        state = self.listener.handler.state
+        jid = list(state.submit_job(pool='p1', args=['true'], node='n1').keys())[0]
+        seq = state.last_seq()
+        conn = self.connect()
+        threading.Timer(0.3, state.update_job, (jid,), {'state': 'done'}).start()
+        t = time.time()
+        # more long-polls than worker slots, they wait in the event loop
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(conn.request([{'get': {'seq': seq, 'wait': 5}}]))) for i in range(3)]
+        for thread in threads: thread.start()
+        self.assertEqual(conn.request([{'a': 1}]), [{'echo': {'a': 1}}])  # not held up by the long-polls
+        self.assertLess(time.time() - t, 0.3)
+        for thread in threads: thread.join()
+        self.assertLess(time.time() - t, 2)
+        for r in results:
+            self.assertEqual(list(r[0]['get']), [jid])
+            self.assertEqual(r[0]['seq'], state.last_seq())
+        conn.close()
+
+    def test_long_poll_locked(self):
+        # a long-poll waiting for the State lock does not hold up the event loop
+        state = self.listener.handler.state
+        conn = self.connect()
+        seq = state.last_seq()
+        locked = threading.Event()
+        def writer():
+            with state._State__lock:
+                locked.set()
+                time.sleep(0.5)
+        threading.Thread(target=writer).start()
+        locked.wait()
+        poll = threading.Thread(target=conn.request, args=([{'get': {'seq': seq, 'wait': 0.1}}],))
+        t = time.time()
+        poll.start()
+        time.sleep(0.05)
+        self.assertEqual(conn.request([{'a': 1}]), [{'echo': {'a': 1}}])
+        self.assertLess(time.time() - t, 0.3)
+        poll.join()
+        conn.close()
+
+class TestAsyncNode(unittest.TestCase):
+    '''AsyncNode syncs two States over a loopback AsyncListener'''
+
+    def setUp(self):
+        self.remote = Meeseeks(name='remote')
+        self.remote.state = State('remote')
+        self.listener = AsyncListener(('localhost', 0))
+        self.listener.handler = self.remote
+        threading.Thread(target=self.listener.serve_forever, daemon=True).start()
+        self.state = State('head')
+        self.state.update_peers(['remote'])
+        self.manager = NodeManager()
+
+    def tearDown(self):
+        self.node.shutdown.set()
+        self.node.join(5)
+        self.manager.stop()
+        self.listener.shutdown()
+        self.listener.server_close()
+        for state in (self.state, self.remote.state): state.shutdown.set()
+
+    def wait_for(self, f, timeout=5):
+        end = time.time() + timeout
+        while not f() and time.time() < end: time.sleep(0.05)
+        return f()
+
+    def test_sync(self):
+        port = self.listener.server_address[1]
+        self.node = AsyncNode('head', 'remote', self.state, self.manager, address='localhost', port=port, refresh=0.1, poll=1, wait=5)
+        jid = list(self.state.submit_job(pool='p1', args=['true'], node='remote').keys())[0]
+        # our jobs are sent to the remote node
+        self.assertTrue(self.wait_for(lambda: self.remote.state.get_job(jid)))
+        # remote changes are long-polled back
+        self.remote.state.update_job(jid, state='done')
+        self.assertTrue(self.wait_for(lambda: self.state.get_job(jid)['state'] == 'done'))
+        self.assertEqual(self.node.stats()['failures'], 0)
+
+    def test_shutdown(self):
+        # an idle node stops within a second, not after its sync interval
+        port = self.listener.server_address[1]
+        self.node = AsyncNode('head', 'remote', self.state, self.manager, address='localhost', port=port, refresh=0.1, max_refresh=30, wait=0)
+        self.assertTrue(self.wait_for(lambda: self.node.interval and self.node.interval > 2))
+        t = time.time()
+        self.node.shutdown.set()
+        self.node.join(5)
+        self.assertFalse(self.node.is_alive())
+        self.assertLess(time.time() - t, 1.5)
@@ -0,0 +1,91 @@
+import unittest
+from meeseeks.scheduler import Scheduler
+
+class TestScheduler(unittest.TestCase):
+
+    def jobs(self, *specs):
+        return dict(('j%s' % i, dict(submit_ts=i, **spec)) for i, spec in enumerate(specs))
+
+    def order(self, scheduler, jobs):
+        queue = scheduler.queue(jobs)
+        r = []
+        while queue: r.append(queue.pop()[0])
+        return r
+
+    def test_fifo(self):
+        s = Scheduler('head')
+        jobs = self.jobs({'priority': 5}, {}, {'priority': 1})
+        self.assertEqual(self.order(s, jobs), ['j0', 'j1', 'j2'])
+
+    def test_priority(self):
+        s = Scheduler('head', order='priority')
+        jobs = self.jobs({}, {'priority': 5}, {'priority': 1}, {'priority': 5})
+        self.assertEqual(self.order(s, jobs), ['j1', 'j3', 'j2', 'j0'])
+
+    def test_fairshare(self):
+        s = Scheduler('head', order='fairshare')
+        jobs = self.jobs({'uid': 'a'}, {'uid': 'a'}, {'uid': 'a'}, {'uid': 'b'}, {'uid': 'b', 'priority': 1})
+        #uids alternate, b's higher priority job first
+        self.assertEqual(self.order(s, jobs), ['j0', 'j4', 'j1', 'j3', 'j2'])
+        #a used more, so b goes first next pass
+        self.assertGreater(s.usage('a'), s.usage('b'))
+        self.assertEqual(self.order(s, self.jobs({'uid': 'a'}, {'uid': 'b'})), ['j1', 'j0'])
+        #shares divide usage
+        s.config(order='fairshare', shares={'b': 10})
+        self.assertEqual(self.order(s, self.jobs({'uid': 'a'}, {'uid': 'b'}, {'uid': 'b'})), ['j1', 'j2', 'j0'])
+        self.assertRaises(ValueError, s.config, order='nope')
+
+    def place(self, scheduler, pool_status, n):
+        placement = scheduler.placement(pool_status, {})
+        r = []
+        while placement and len(r) < n: r.append(placement.place({}))
+        return r
+
+    def test_pack(self):
+        s = Scheduler('head', place='pack')
+        self.assertEqual(self.place(s, {'n1': 3, 'n2': 2, 'n3': 0}, 10), ['n2', 'n2', 'n1', 'n1', 'n1'])
+        #unlimited nodes take what is left
+        self.assertEqual(self.place(s, {'n1': 1, 'n2': True}, 3), ['n1', 'n2', 'n2'])
+
+    def test_spread(self):
+        s = Scheduler('head', place='spread')
+        self.assertEqual(self.place(s, {'n1': 3, 'n2': 2, 'n3': 0}, 10), ['n1', 'n2', 'n1', 'n2', 'n1'])
+        #unlimited nodes are used evenly once limited nodes are full
+        self.assertEqual(sorted(self.place(s, {'n1': 1, 'n2': True, 'n3': True}, 5)), ['n1', 'n2', 'n2', 'n3', 'n3'])
+        #with wait_in_pool, full nodes are used evenly
+        s.config(place='spread', wait_in_pool=True)
+        self.assertEqual(sorted(self.place(s, {'n1': 0, 'n2': 0}, 4)), ['n1', 'n1', 'n2', 'n2'])
+
+    def test_resources(self):
+        s = Scheduler('head')
+        resources = {'n1': {'cpus': 32}, 'n2': {'cpus': 8, 'gpus': 1}}
+        placement = s.placement({'n1': True, 'n2': True}, {}, resources)
+        self.assertEqual(placement.place({'resources': {'gpus': 1}}), 'n2')
+        self.assertEqual(placement.place({'resources': {'gpus': 1}}), None)
+        self.assertEqual(placement.place({'resources': {'cpus': 16}}), 'n1')
+        self.assertEqual(placement.place({'resources': {'cpus': 16}}), 'n1')
+        self.assertEqual(placement.place({'resources': {'cpus': 16}}), None)
+        self.assertEqual(placement.place({'resources': {'cpus': 8}}), 'n2')
+        self.assertEqual(resources, {'n1': {}, 'n2': {}})
+        #pack fills the node with the least free first
+        s.config(place='pack')
+        placement = s.placement({'n1': 2, 'n2': 2}, {}, {'n1': {'cpus': 32}, 'n2': {'cpus': 8}})
+        self.assertEqual([placement.place({'resources': {'cpus': 4}}) for i in range(4)], ['n2', 'n2', 'n1', 'n1'])
+        self.assertFalse(placement)
+        #a pool with no resources configured does not account them
+        placement = s.placement({'n1': 2}, {}, None)
+        self.assertEqual([placement.place({'resources': {'gpus': 1}}) for i in range(2)], ['n1', 'n1'])
+        #in a mixed pool, nodes without resources take the jobs no node with resources fits
+        placement = s.placement({'n1': 2, 'n2': 1, 'n3': 3}, {}, {'n1': {'gpus': 1}})
+        self.assertEqual([placement.place({'resources': {'gpus': 1}}) for i in range(4)], ['n1', 'n3', 'n3', 'n2'])
+        self.assertEqual(placement.place({'resources': {'gpus': 1}}), 'n3')
+        self.assertIsNone(placement.place({'resources': {'gpus': 1}}))  # n1 has a slot but no gpus left
+        self.assertEqual(placement.place({}), 'n1')
+
+    def test_available(self):
+        s = Scheduler('head')
+        placed = self.place(s, {'n1': 2, 'n2': 1, 'n3': 0}, 10)
+        self.assertEqual(sorted(placed), ['n1', 'n1', 'n2'])
+
+if __name__ == '__main__':
+    unittest.main()
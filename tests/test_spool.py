@@ -0,0 +1,39 @@
+import unittest
+import os
+import time
+import tempfile
+from meeseeks.spool import Spool
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.spool = Spool(tempfile.mkdtemp(), max_size=10, chunk=4)
+
+    def add(self, data):
+        with self.spool.create() as fh: fh.write(data)
+        return self.spool.add(fh.name)
+
+    def test_add_and_read(self):
+        ref = self.add(b'hello')
+        self.assertEqual(ref['size'], 5)
+        self.assertEqual(self.add(b'hello'), ref)  # same output is stored once
+        self.assertEqual(self.spool.read(ref['hash']), (5, b'hell'))
+        self.assertEqual(self.spool.read(ref['hash'], 4), (5, b'o'))
+        self.assertIsNone(self.add(b''))
+        self.assertRaises(ValueError, self.spool.read, '../../etc/passwd')
+
+    def test_max_size(self):
+        ref = self.add(b'0123456789abcdef')
+        self.assertEqual((ref['size'], ref['truncated']), (10, 16))
+
+    def test_clean(self):
+        old, new = self.add(b'old'), self.add(b'new')
+        path = os.path.join(self.spool.path, old['hash'][:2], old['hash'])
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        self.spool.quota = 3
+        self.spool.clean()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.spool.read(new['hash']), (3, b'new'))
+        self.spool.expire = -1
+        self.spool.clean()
+        self.assertRaises(FileNotFoundError, self.spool.read, new['hash'])
@@ -0,0 +1,363 @@
+import unittest
+import time
+import os
+import json
+import pickle
+import tempfile
+import threading
+from meeseeks.state import State
+from meeseeks.record import JobRecord
+from meeseeks.codec import CODECS
+from meeseeks.delta import Delta
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = State('head')
+
+    def tearDown(self):
+        self.state.shutdown.set()
+
+    def submit(self, **kwargs):
+        kwargs.setdefault('pool', 'p1')
+        kwargs.setdefault('args', ['true'])
+        return list(self.state.submit_job(**kwargs).keys())
+
+    def test_query_by_node_and_pool(self):
+        a = self.submit(node='n1')
+        b = self.submit(node='n2')
+        c = self.submit(node='n1', pool='p2')
+        self.assertEqual(list(self.state.get(node='n1', pool='p1').keys()), a)
+        self.assertEqual(set(self.state.get(node='n1').keys()), set(a + c))
+        self.assertEqual(set(self.state.get(pool='p1').keys()), set(a + b))
+
+    def test_query_wildcard(self):
+        a = self.submit(node='node-a1')
+        b = self.submit(node='node-a2')
+        self.submit(node='other')
+        self.assertEqual(set(self.state.get(node='node-a*').keys()), set(a + b))
+        self.assertEqual(set(self.state.get(node='*').keys()), set(self.state.get().keys()))
+
+    def test_query_tag_and_state(self):
+        a = self.submit(node='n1', tags=['x', 'y'])
+        b = self.submit(node='n1', tags='y')
+        self.assertEqual(set(self.state.get(tag='y').keys()), set(a + b))
+        self.assertEqual(list(self.state.get(tag='x').keys()), a)
+        self.state.update_job(a[0], state='done')
+        self.assertEqual(list(self.state.get(state='new', tag='y').keys()), b)
+        self.assertEqual(list(self.state.get(state='done').keys()), a)
+
+    def test_index_follows_updates(self):
+        a = self.submit(node='n1')
+        self.state.update_job(a[0], node='n2')
+        self.assertEqual(self.state.get(node='n1'), {})
+        self.assertEqual(list(self.state.get(node='n2').keys()), a)
+        self.state.submit_job(id=a[0], state='killed')
+        self.assertEqual(list(self.state.get(node='n2', state='killed').keys()), a)
+
+    def test_unrouted_jobs(self):
+        a = self.submit()
+        self.assertEqual(self.state.get(), {})
+        self.assertEqual(list(self.state.get(node=False).keys()), a)
+
+    def test_query_by_seq(self):
+        a = self.submit(node='n1')
+        b = self.submit(node='n1')
+        seq = self.state.get_job(b[0])['seq']
+        self.assertEqual(self.state.get(seq=seq), {})
+        self.state.update_job(a[0], state='running')
+        changed = self.state.get(seq=seq)
+        self.assertEqual(list(changed.keys()), a)
+        self.assertEqual(list(self.state.get(seq=seq, state='new').keys()), [])
+        self.assertEqual(list(self.state.get(seq=0).keys()), a + b)
+        self.assertEqual(list(self.state.get(seq=1).keys()), b + a)
+
+    def test_sync(self):
+        a = self.submit(node='n1')
+        job = self.state.get_job(a[0])
+        job.update(node='n2', ts=job['ts'] + 1)
+        self.assertEqual(self.state.sync({a[0]: job}), a)
+        self.assertEqual(list(self.state.get(node='n2', pool='p1').keys()), a)
+        self.assertEqual(self.state.get(node='n1', pool='p1'), {})
+
+    def test_update_jobs(self):
+        a = self.submit(node='n1')
+        b = self.submit(node='n1')
+        self.assertEqual(self.state.update_jobs({a[0]: {'node': 'n2'}, b[0]: {'state': 'done'}, 'x': {'node': 'n2'}}), a + b)
+        self.assertEqual(list(self.state.get(node='n2').keys()), a)
+        self.assertEqual(self.state.get_job(b[0])['state'], 'done')
+        self.assertEqual(self.state.check(), [])
+
+    def test_bulk(self):
+        seq = self.state.last_seq()
+        r = self.state.submit_jobs([{'pool': 'p1', 'args': ['true'], 'node': 'n1', 'tags': ['a']} for i in range(5)] +
+            [{'args': ['true']}, {'pool': 'p2', 'args': ['true'], 'node': 'n2'}])
+        jids = [jid for jid, job in r.items() if job]
+        self.assertEqual(len(r), 7)
+        self.assertEqual(len(jids), 6)
+        #one seq range
+        self.assertEqual(sorted(self.state.get(ids=jids)[jid]['seq'] for jid in jids), list(range(seq + 1, seq + 7)))
+        r = self.state.modify_jobs({'hold': True}, node='n1')
+        self.assertEqual(sorted(r), sorted(jids[:5]))
+        self.assertTrue(all(job['hold'] for job in self.state.get(node='n1').values()))
+        self.assertEqual(self.state.modify_jobs({'hold': True}), {})
+        r = self.state.kill_jobs({'tag': 'a'})
+        self.assertEqual(sorted(r), sorted(jids[:5]))
+        self.assertEqual(self.state.kill_jobs([jids[5], 'x']), {jids[5]: self.state.get_job(jids[5]), 'x': False})
+        self.assertEqual(len(self.state.get(state='killed')), 6)
+        self.assertEqual(self.state.check(), [])
+
+    def test_subscribe(self):
+        sub = self.state.subscribe(node='n1', pool='p1')
+        a = self.submit(node='n2')
+        self.assertFalse(sub.event.is_set())
+        b = self.submit(node='n1')
+        self.assertTrue(sub.wait(0))
+        self.assertFalse(sub.event.is_set())
+        self.state.update_job(b[0], node='n2')  # leaving the node still wakes
+        self.assertTrue(sub.wait(0))
+        ids = self.state.subscribe(ids=a, event=sub.event)
+        self.state.update_job(a[0], state='done')
+        self.assertTrue(sub.wait(0))
+        self.state.unsubscribe(sub)
+        self.state.unsubscribe(ids)
+        self.submit(node='n1')
+        self.assertFalse(sub.event.is_set())
+
+    def test_wait_changes(self):
+        a = self.submit(node='n1')
+        seq = self.state.get_job(a[0])['seq']
+        self.assertEqual(self.state.wait_changes(seq - 1, 5), seq)  # already changed
+        t = time.time()
+        self.assertEqual(self.state.wait_changes(seq, 0.2), seq)  # times out
+        self.assertGreaterEqual(time.time() - t, 0.2)
+        threading.Timer(0.2, self.state.update_job, (a[0],), {'state': 'done'}).start()
+        t = time.time()
+        self.assertEqual(self.state.wait_changes(seq, 5), self.state.get_job(a[0])['seq'])
+        self.assertLess(time.time() - t, 1)
+
+    def test_routes(self):
+        self.state.update_node('head', online=True)
+        self.state.update_peers(['a', 'b'])
+        # a routes to c, c routes to d, b also routes to d
+        self.state.sync(status={'a': {'routing': ['a', 'c', 'd']}, 'b': {'routing': ['b', 'd']}, 'c': {'routing': ['c', 'd']}})
+        version, routes = self.state.get_routes()
+        self.assertEqual(routes, {'a': ('a',), 'b': ('b',), 'c': ('a',), 'd': ('a', 'b')})
+        self.assertEqual(self.state.get_nodes()['head']['routing'], ['a', 'b', 'c', 'head'])
+        # status updates that do not change the topology keep the version
+        self.state.sync(status={'a': {'online': True, 'routing': ['a', 'c', 'd']}})
+        self.assertEqual(self.state.get_routes()[0], version)
+        self.state.sync(status={'b': {'routing': ['b']}})
+        version, routes = self.state.get_routes()
+        self.assertEqual(routes['d'], ('a',))
+        # a digest of routing we have is kept, a digest we don't have drops the routing until it is resent
+        self.state.sync(status={'e': {'routing': ['e'], 'routing_digest': '1'}})
+        self.state.sync(status={'e': {'routing_digest': '1'}})
+        self.assertEqual(self.state.get_nodes()['e']['routing'], ['e'])
+        self.state.sync(status={'e': {'routing_digest': '2'}})
+        self.assertEqual(self.state.routing_missing(), ['e'])
+        self.state.sync(status={'e': {'routing': ['e', 'f'], 'routing_digest': '2'}})
+        self.assertEqual(self.state.routing_missing(), [])
+        self.assertEqual(self.state.check(), [])
+
+    def test_pool_slots(self):
+        self.state.update_node('n1', online=True)
+        self.state.update_pool('p1', 'n1', 4)
+        self.state.update_pool('p2', 'n1', True)
+        a = self.submit(node='n1')
+        b = self.submit(node='n1')
+        self.submit(node='n1', pool='p2')
+        self.assertEqual(self.state.get_pools(), {'p1': {'n1': 2}, 'p2': {'n1': True}})
+        self.assertEqual(self.state.active_jobs(['n1', 'n2']), 3)
+        self.state.update_job(a[0], state='done')
+        self.assertEqual(self.state.get_pools()['p1']['n1'], 3)
+        self.state.update_job(b[0], node='n2')
+        self.assertEqual(self.state.get_pools()['p1']['n1'], 4)
+        self.state.submit_job(id=a[0], state='new')
+        self.assertEqual(self.state.check(), [])
+
+    def test_pool_resources(self):
+        self.state.update_node('n1', online=True)
+        self.state.update_pool('p1', 'n1', True, {'cpus': 32, 'mem_mb': 1000})
+        a = self.submit(node='n1', resources={'cpus': '16'})
+        self.submit(node='n1', resources={'cpus': 8, 'mem_mb': 500})
+        self.assertEqual(self.state.get_resources(), {'p1': {'n1': {'cpus': 8, 'mem_mb': 500}}})
+        self.state.update_job(a[0], state='done')
+        self.assertEqual(self.state.get_resources()['p1']['n1'], {'cpus': 24, 'mem_mb': 500})
+        self.state.update_job(a[0], state='new', resources={'cpus': 24})
+        self.assertEqual(self.state.get_resources()['p1']['n1'], {'mem_mb': 500}) #none free
+        self.assertEqual(self.state.check(), [])
+        self.state.update_node('n1', online=False)
+        self.assertEqual(self.state.get_resources(), {})
+
+    def test_array(self):
+        self.state.update_node('n1', online=True)
+        self.state.update_pool('p1', 'n1', 10)
+        jid = self.submit(node='n1', array='1-100000')[0]
+        job = self.state.get(ids=jid)[jid]
+        self.assertEqual(job['array_counts'], {'new': 100000})
+        self.assertNotIn('array_runs', job)
+        self.assertEqual(self.state.get(ids=jid, indices=True)[jid]['array_runs'], [[1, 100000, 'new']])
+        #running tasks each take a slot
+        self.assertEqual(self.state.get_pools()['p1']['n1'], 9)
+        self.state.update_job(jid, state='running', array_runs=[[1, 4, 'running'], [5, 100000, 'new']],
+            array_counts={'running': 4, 'new': 99996})
+        self.assertEqual(self.state.get_pools()['p1']['n1'], 6)
+        self.state.update_job(jid, state='failed', array_runs=[[1, 1, 'failed'], [2, 100000, 'done']],
+            array_counts={'failed': 1, 'done': 99999})
+        self.assertEqual(self.state.get_pools()['p1']['n1'], 10)
+        #resetting the job runs all indices again
+        self.state.submit_job(id=jid, state='new', array='1-5')
+        job = self.state.get(ids=jid, indices=True)[jid]
+        self.assertEqual((job['array'], job['array_runs']), ('1-100000:1', [[1, 100000, 'new']]))
+        self.assertEqual(self.state.check(), [])
+        self.assertEqual(self.submit(array='10-1'), [])
+
+    def test_check(self):
+        for i in range(20):
+            self.submit(node='n%s' % (i % 3), tags=['t%s' % (i % 4)])
+        for jid in self.state.list_jobs(node='n1'):
+            self.state.update_job(jid, state='failed')
+        self.state.kill_jobs(tag='t2')
+        self.state.sync({'x': {'node': 'n4', 'pool': 'p1', 'state': 'new', 'tags': [], 'ts': 1}})
+        self.assertEqual(self.state.check(), [])
+
+    def wait_for(self, f, timeout=5):
+        t = time.time()
+        while not f():
+            if time.time() - t > timeout: return False
+            time.sleep(0.1)
+        return True
+
+    def test_expire(self):
+        a = self.submit(node='n1')
+        b = self.submit(node='n1')
+        self.state.update_job(a[0], state='done', ts=time.time() - 600)
+        self.state.update_job(b[0], state='running', active=True, ts=time.time() - 600)
+        self.assertTrue(self.wait_for(lambda: self.state.get_job(a[0]) is None))
+        #node is not online so the active job fails
+        job = self.state.get_job(b[0])
+        self.assertEqual((job['state'], job['error']), ('failed', 'expired'))
+        self.assertEqual(self.state.check(), [])
+
+    def test_restart(self):
+        a = self.submit(node='head', restart=True)
+        b = self.submit(node='head', retries=1)
+        c = self.submit(node='n1', restart=True)
+        self.state.update_job(a[0], state='done')
+        self.state.update_job(b[0], state='failed', fail_count=1)
+        self.state.update_job(c[0], state='done')
+        self.assertTrue(self.wait_for(lambda: self.state.get_job(a[0])['state'] == 'new'))
+        self.assertTrue(self.wait_for(lambda: self.state.get_job(b[0])['state'] == 'new'))
+        self.state.update_job(b[0], state='failed', fail_count=2)
+        time.sleep(1.5)
+        self.assertEqual(self.state.get_job(b[0])['state'], 'failed')
+        self.assertEqual(self.state.get_job(c[0])['state'], 'done')
+        self.assertEqual(self.state.check(), [])
+
+    def test_history(self):
+        path = os.path.join(tempfile.mkdtemp(), 'history')
+        self.state.config(history={'file': path, 'flush': 0.1})
+        a = self.submit(node='n1')
+        self.state.update_job(a[0], state='done')
+        self.assertTrue(self.wait_for(lambda: self.state.history.stats()['written'] == 1))
+        with open(path) as fh: self.assertEqual(list(json.loads(fh.readline()).keys()), a)
+        self.state.config(history=None)
+        self.assertIsNone(self.state.history)
+
+    def test_wal(self):
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        state = State('head', file=path, wal=True, checkpoint=1)
+        a = list(state.submit_job(pool='p1', args=['true'], node='n1').keys())
+        b = list(state.submit_job(pool='p1', args=['true'], node='n1').keys())
+        #wait for a snapshot, then change state and "crash" without saving
+        self.assertTrue(self.wait_for(lambda: os.path.exists(path)))
+        state.checkpoint = None
+        time.sleep(1.1)
+        state.update_job(a[0], state='done')
+        state.submit_job(pool='p1', args=['false'], node='n2')
+        jobs = state.get()
+        recovered = State('head', file=path, wal=True)
+        self.assertEqual(recovered.get(), jobs)
+        self.assertEqual(recovered.check(), [])
+        recovered.shutdown.set()
+        state.shutdown.set()
+
+    def test_wal_checkpoints(self):
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        state = State('head', file=path, wal=True, checkpoint=1)
+        jid = list(state.submit_job(pool='p1', args=['true'], node='n1').keys())[0]
+        #each checkpoint saves a snapshot and removes the rotated log
+        for i in range(3):
+            mtime = os.path.exists(path) and os.stat(path).st_mtime_ns
+            state.update_job(jid, rc=i)
+            self.assertTrue(self.wait_for(lambda: os.path.exists(path) and os.stat(path).st_mtime_ns != mtime))
+            self.assertTrue(self.wait_for(lambda: not os.path.exists(path + '.wal.old')))
+        self.assertLessEqual(os.path.getsize(path + '.wal'), 1024)
+        state.shutdown.set()
+        #a log needs a state file to be truncated, and checkpoints by default
+        for state, attr, value in ((State('head', wal=path + '.other'), 'wal_file', None), (State('head', file=path, wal=True), 'checkpoint', 60)):
+            self.assertEqual(getattr(state, attr), value)
+            state.shutdown.set()
+
+    def test_state_codec(self):
+        for name in CODECS:
+            path = os.path.join(tempfile.mkdtemp(), 'state')
+            state = State('head', file=path, codec=name)
+            state.submit_job(pool='p1', args=['true'], node='n1', env={'A': '1'})
+            jobs = state.get()
+            state.shutdown.set()
+            state.join()
+            loaded = State('head', file=path)  # json, but loads any codec
+            self.assertEqual(loaded.get(), jobs, name)
+            loaded.shutdown.set()
+
+    def test_delta_sync(self):
+        a = self.submit(node='n1', env={'A': '1' * 1000})
+        remote = State('remote')
+        delta = Delta()
+        self.assertEqual(remote.sync(delta.encode(self.state.get(records=True))), a)
+        self.state.update_job(a[0], state='running', pid=1)
+        sent = delta.encode(self.state.get(ids=a, records=True))[a[0]]
+        self.assertNotIn('env', sent)
+        self.assertEqual(sorted(sent), ['delta', 'pid', 'seq', 'state', 'ts'])
+        self.assertEqual(remote.sync({a[0]: sent}), a)
+        job, synced = self.state.get_job(a[0]), remote.get_job(a[0])
+        del job['seq'], synced['seq']
+        self.assertEqual(synced, job)
+        # a delta against a version the remote does not have is reported missing
+        self.state.update_job(a[0], state='done')
+        sent = delta.encode(self.state.get(ids=a, records=True))
+        sent[a[0]]['delta'] -= 1
+        missing = []
+        self.assertEqual(remote.sync(sent, missing=missing), [])
+        self.assertEqual(missing, a)
+        delta.forget(missing)
+        self.assertIn('env', delta.encode(self.state.get(ids=a, records=True))[a[0]])
+        # prune forgets jobs that are no longer in state
+        b = self.submit(node='n1')
+        delta.encode(self.state.get(ids=b, records=True))
+        self.assertEqual(len(delta), 2)
+        self.assertEqual(remote.missing(a + b), b)
+        delta.prune(remote)
+        self.assertEqual(len(delta), 1)
+        remote.shutdown.set()
+
+    def test_job_record(self):
+        job = {'node': 'n1', 'pool': 'p1', 'state': 'new', 'env': {'A': '1'}, 'tags': ['x'], 'ts': 1.0, 'stdout_data': 'eA=='}
+        a, b = JobRecord(job), JobRecord(dict(job))
+        self.assertEqual(a.copy(), job)
+        self.assertEqual(json.loads(json.dumps(a, default=dict)), job)
+        self.assertIs(a['env'], b['env'])
+        # the shared env can't be changed through one job
+        for change in (lambda env: env.__setitem__('A', 'x'), lambda env: env.update(A='x'), lambda env: env.pop('A')):
+            self.assertRaises(TypeError, change, b.copy()['env'])
+        self.assertEqual(a['env'], {'A': '1'})
+        self.assertEqual(pickle.loads(pickle.dumps(a['env'])), {'A': '1'})
+        self.assertNotIn('rc', a)
+        self.assertIsNone(a.get('rc'))
+        c = a.replace(state='done', rc=0)
+        self.assertEqual((a['state'], c['state'], c['rc'], c['stdout_data']), ('new', 'done', 0, 'eA=='))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import threading
+import time
+from meeseeks.util import RWLock
+
+class TestRWLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = RWLock()
+        self.order = []
+
+    def start(self, name, write=False, hold=None):
+        '''take the lock in a thread, record name when it is taken, hold it until the hold event is set'''
+        def run():
+            with (self.lock if write else self.lock.read()):
+                self.order.append(name)
+                if hold: hold.wait(5)
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        return t
+
+    def wait_for(self, f, timeout=5):
+        end = time.time() + timeout
+        while not f() and time.time() < end: time.sleep(0.01)
+        return f()
+
+    def test_concurrent_readers(self):
+        #both readers must hold the lock at once to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        def run():
+            with self.lock.read(): barrier.wait()
+        threads = [threading.Thread(target=run) for i in range(2)]
+        for t in threads: t.start()
+        for t in threads: t.join(5)
+        self.assertFalse(barrier.broken)
+
+    def test_writer_exclusion(self):
+        hold = threading.Event()
+        w = self.start('w1', write=True, hold=hold)
+        self.assertTrue(self.wait_for(lambda: self.order == ['w1']))
+        r = self.start('r1')
+        w2 = self.start('w2', write=True)
+        time.sleep(0.1)
+        self.assertEqual(self.order, ['w1']) #nothing gets in while the writer holds the lock
+        hold.set()
+        for t in (w, r, w2): t.join(5)
+        self.assertEqual(sorted(self.order), ['r1', 'w1', 'w2'])
+
+    def test_writer_preference(self):
+        hold, hold_writer = threading.Event(), threading.Event()
+        r1 = self.start('r1', hold=hold)
+        self.assertTrue(self.wait_for(lambda: self.order == ['r1']))
+        w = self.start('w', write=True, hold=hold_writer)
+        time.sleep(0.1)
+        #a waiting writer blocks new readers, so readers can't starve it
+        r2 = self.start('r2')
+        time.sleep(0.1)
+        self.assertEqual(self.order, ['r1'])
+        hold.set()
+        self.assertTrue(self.wait_for(lambda: self.order == ['r1', 'w']))
+        #readers that waited on the writer go before the next writer
+        w2 = self.start('w2', write=True)
+        time.sleep(0.1)
+        hold_writer.set()
+        for t in (r1, w, r2, w2): t.join(5)
+        self.assertEqual(self.order, ['r1', 'w', 'r2', 'w2'])
+
+if __name__ == '__main__':
+    unittest.main()